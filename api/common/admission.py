@@ -0,0 +1,276 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, Optional
+
+from aiohttp import web
+from aiohttp.typedefs import Handler
+from aiohttp.web_middlewares import middleware
+from redis.exceptions import RedisError
+
+from api.common.configs import (
+    ADMISSION_MAX_CONCURRENCY,
+    ADMISSION_MAX_QUEUE_SIZE,
+    ADMISSION_MAX_WRITE_CONCURRENCY,
+    ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_LOG_INTERVAL_SECONDS,
+    RATE_LIMIT_MAX_CHECKS,
+    RATE_LIMIT_PER_SECOND,
+    RATE_LIMIT_TIMEOUT_SECONDS,
+)
+from api.common.exceptions import OverloadedError, RateLimitedError
+from api.common.tenants import Tenant, init_tenant_indexes, tenant_of
+from api.common.utils import LuaScript
+
+logger = logging.getLogger("admission")
+
+# Requests priorities, the lower the value the sooner the request is admitted
+AUTHORIZATION = 0
+READ = 1
+WRITE = 2
+
+# These are never limited, otherwise an overloaded worker will fail its health checks as well
+EXEMPT_PATHS = {"/health-check", "/health/live", "/health/ready", "/favicon.ico"}
+# The long polls wait up to CHANGES_MAX_WAIT_SECONDS for new changes, holding admission slots they would starve
+# is_authorized, so they are only rate limited, and bounded by their own limit (see get_changes)
+LONG_POLL_PATHS = {"/changes"}
+
+
+def request_priority(request: web.Request) -> int:
+    if request.path == "/is_authorized":
+        return AUTHORIZATION
+    if request.method in ("GET", "HEAD"):
+        return READ
+    return WRITE
+
+
+# Limits the number of requests that each worker handles concurrently.
+# When MongoDB/Redis slow down, the requests that can't be admitted wait in a queue (is_authorized first, writes last)
+# and are rejected with 503 once they waited more than the queue timeout, or right away when the queue is full.
+# So a slow backend makes the worker reject the excess requests fast, instead of piling up requests until everything times out
+class AdmissionController:
+    def __init__(
+            self,
+            max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+            max_write_concurrency: int = ADMISSION_MAX_WRITE_CONCURRENCY,
+            queue_timeout_seconds: float = ADMISSION_QUEUE_TIMEOUT_SECONDS,
+            max_queue_size: int = ADMISSION_MAX_QUEUE_SIZE
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_write_concurrency = max_write_concurrency
+        self.queue_timeout_seconds = queue_timeout_seconds
+        self.max_queue_size = max_queue_size
+        self.in_flight = 0
+        self.in_flight_writes = 0
+        self.rejected = 0
+        self._queues: Dict[int, Deque[asyncio.Future]] = {priority: deque() for priority in (AUTHORIZATION, READ, WRITE)}
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _can_admit(self, priority: int) -> bool:
+        if self.in_flight >= self.max_concurrency:
+            return False
+        return priority != WRITE or self.in_flight_writes < self.max_write_concurrency
+
+    def _admit(self, priority: int) -> None:
+        self.in_flight += 1
+        if priority == WRITE:
+            self.in_flight_writes += 1
+
+    async def acquire(self, priority: int) -> None:
+        # admitting right away only when no request with the same or higher priority is waiting
+        if self._can_admit(priority) and not any(self._queues[p] for p in range(priority + 1)):
+            self._admit(priority)
+            return
+        if self.queued >= self.max_queue_size:
+            self.rejected += 1
+            raise OverloadedError("Server is overloaded, queue is full")
+
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append(future)
+        try:
+            await asyncio.wait_for(future, self.queue_timeout_seconds)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise OverloadedError(f"Server is overloaded, request waited more than {self.queue_timeout_seconds} seconds")
+        except asyncio.CancelledError:
+            # the slot might have been handed to this request right before it was cancelled
+            if future.done() and not future.cancelled():
+                self.release(priority)
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                try:
+                    self._queues[priority].remove(future)
+                except ValueError:
+                    pass
+
+    def release(self, priority: int) -> None:
+        self.in_flight -= 1
+        if priority == WRITE:
+            self.in_flight_writes -= 1
+        self._wake_up()
+
+    def _wake_up(self) -> None:
+        # handing the free slots to the waiting requests, by their priority
+        for priority, queue in self._queues.items():
+            while queue and self._can_admit(priority):
+                future = queue.popleft()
+                if future.done():  # timed out or cancelled
+                    continue
+                self._admit(priority)
+                future.set_result(None)
+
+
+# The write handlers are a few blocking MongoDB/Redis calls each. On the event loop they would stall every request
+# of the worker while MongoDB is slow, including the admission queue timeouts, so they run in the writes executor.
+# At most max_write_concurrency writes are admitted at once, so there is a thread for each of them
+def write_handler(handler: Callable[[web.Request, str], web.StreamResponse]) -> Handler:
+    """The handler is called with the request and its body (read on the loop), in the writes executor"""
+    @functools.wraps(handler)
+    async def run_in_writes_executor(request: web.Request) -> web.StreamResponse:
+        body = await request.text()
+        init_tenant_indexes(request)
+        return await asyncio.get_running_loop().run_in_executor(request.app["writes_executor"], handler, request, body)
+    return run_in_writes_executor
+
+
+# The same for the GET handlers that read MongoDB directly (the is_authorized reads run in the batch loaders),
+# so while MongoDB stalls the queued requests still get their 503 on time
+def read_handler(handler: Callable[[web.Request], web.StreamResponse]) -> Handler:
+    """The handler is called with the request, in the reads executor"""
+    @functools.wraps(handler)
+    async def run_in_reads_executor(request: web.Request) -> web.StreamResponse:
+        return await asyncio.get_running_loop().run_in_executor(request.app["reads_executor"], handler, request)
+    return run_in_reads_executor
+
+
+async def init_writes_executor(app):
+    # This section is called upon running the application
+    app["writes_executor"] = ThreadPoolExecutor(max_workers=app["admission"].max_write_concurrency, thread_name_prefix="writes")
+    app["reads_executor"] = ThreadPoolExecutor(max_workers=app["admission"].max_concurrency, thread_name_prefix="reads")
+    yield
+    # This section will be called when the server terminates
+    app["writes_executor"].shutdown(wait=False, cancel_futures=True)
+    app["reads_executor"].shutdown(wait=False, cancel_futures=True)
+
+
+# Per client (of each tenant) token bucket, kept in Redis so the limit is shared by all the workers and pods.
+# The refill is calculated using the Redis clock, so it doesn't depend on the clocks of the pods.
+# The check runs before the admission, so it's made in the limiter's own few threads and bounded by a short timeout,
+# and it fails open when Redis is slow or down (the requests that don't need Redis shouldn't be blocked by it).
+# A check that timed out keeps its thread until Redis answers, so when all the threads are busy the check is skipped
+# (instead of queueing more checks behind a stalled Redis, or taking the threads of the batch loaders)
+class RateLimiter:
+    TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+    def __init__(
+            self,
+            rate_per_second: float = RATE_LIMIT_PER_SECOND,
+            burst: int = RATE_LIMIT_BURST,
+            timeout_seconds: float = RATE_LIMIT_TIMEOUT_SECONDS,
+            max_checks: int = RATE_LIMIT_MAX_CHECKS
+    ):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.timeout_seconds = timeout_seconds
+        self.max_checks = max_checks
+        self.checks_in_flight = 0
+        self.failed_open = 0  # since the last log
+        self._last_logged = 0.0
+        self._token_bucket = LuaScript(self.TOKEN_BUCKET_SCRIPT)
+        self._executor = ThreadPoolExecutor(max_workers=max_checks, thread_name_prefix="rate-limit")
+
+    @staticmethod
+    def build_key(tenant: Tenant, client_id: str) -> str:
+        return tenant.key(f"RateLimits:{client_id}")
+
+    @staticmethod
+    def client_id(request: web.Request) -> Optional[str]:
+        return request.headers.get("X-Client-Id") or request.remote
+
+    async def check(self, request: web.Request) -> None:
+        if self.rate_per_second <= 0:  # rate limiting is disabled
+            return
+        client_id = self.client_id(request)
+        if client_id is None:
+            return
+        take_token = functools.partial(
+            self._token_bucket, request.app["redis"],
+            keys=[self.build_key(tenant_of(request), client_id)],
+            args=[self.rate_per_second, self.burst]
+        )
+        if self.checks_in_flight >= self.max_checks:
+            self._fail_open("all the checks are waiting for Redis")
+            return
+        self.checks_in_flight += 1
+        check = asyncio.get_running_loop().run_in_executor(self._executor, take_token)
+        check.add_done_callback(self._check_done)
+        try:
+            # shielded, so the check's thread is counted until it returns even when the request stops waiting for it
+            allowed = await asyncio.wait_for(asyncio.shield(check), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            self._fail_open("Redis didn't answer in time")
+            return
+        except RedisError as e:
+            self._fail_open(str(e))
+            return
+        if not allowed:
+            raise RateLimitedError(f"Too many requests from client '{client_id}'")
+
+    def _check_done(self, check: asyncio.Future) -> None:
+        self.checks_in_flight -= 1
+        if not check.cancelled():
+            check.exception()  # retrieved, a check that timed out isn't awaited
+
+    def _fail_open(self, reason: str) -> None:
+        # on every request while Redis is down, so it's logged once in an interval (without the traceback)
+        self.failed_open += 1
+        now = time.monotonic()
+        if now - self._last_logged >= RATE_LIMIT_LOG_INTERVAL_SECONDS:
+            logger.warning(f"Admitted {self.failed_open} requests without checking their rate limit: {reason}")
+            self.failed_open = 0
+            self._last_logged = now
+
+
+rate_limiter: RateLimiter = RateLimiter()
+
+
+@middleware
+async def admission_control_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    if request.path in EXEMPT_PATHS:
+        return await handler(request)
+
+    await rate_limiter.check(request)
+    if request.path in LONG_POLL_PATHS:
+        return await handler(request)
+    priority = request_priority(request)
+    controller: AdmissionController = request.app["admission"]
+    await controller.acquire(priority)
+    try:
+        return await handler(request)
+    finally:
+        controller.release(priority)
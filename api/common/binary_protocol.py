@@ -0,0 +1,196 @@
+import asyncio
+import itertools
+import struct
+from typing import Dict, List, Optional, Tuple, Union
+
+from bson import ObjectId
+
+# Compact protocol for authorization checks over persistent TCP connections (see binary_handler).
+# Every message is a frame: 4 bytes big endian body length, then the body.
+# Request body:  type (1 byte), request id (4 bytes), then
+#   CHECK: user id (12 bytes), resource id (12 bytes)
+#   BATCH: count (2 bytes), then count * (user id, resource id)
+#   TENANT: utf-8 tenant name (the rest of the body), the following requests of the connection are of this tenant
+# Response body: type (1 byte), same request id (4 bytes), then
+#   CHECK: status (1 byte)
+#   BATCH: count (2 bytes), then count * status (1 byte)
+#   TENANT: nothing
+#   ERROR: status (1 byte), utf-8 message (the rest of the body)
+# A client can send many requests without waiting for the responses, the responses might arrive in a different order,
+# and are matched to the requests by the request id. A request whose body can't be decoded gets an ERROR with its id,
+# and a frame without a request id (or larger than MAX_FRAME_SIZE) gets an ERROR with id 0, and the connection is closed
+CHECK = 1
+BATCH = 2
+TENANT = 3
+ERROR = 255
+
+# Statuses
+DENIED = 0
+ALLOWED = 1
+NOT_FOUND = 2
+BAD_REQUEST = 3
+OVERLOADED = 4
+INTERNAL_ERROR = 5
+
+_frame_length = struct.Struct(">I")
+FRAME_HEADER_SIZE = _frame_length.size
+_header = struct.Struct(">BI")
+_count = struct.Struct(">H")
+_ID_SIZE = 12
+_PAIR_SIZE = _ID_SIZE * 2
+
+MAX_BATCH_SIZE = 1000
+MAX_FRAME_SIZE = _header.size + _count.size + MAX_BATCH_SIZE * _PAIR_SIZE
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _frame(body: bytes) -> bytes:
+    return _frame_length.pack(len(body)) + body
+
+
+def read_frame_length(header: bytes) -> int:
+    length = _frame_length.unpack(header)[0]
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"frame of {length} bytes is larger than {MAX_FRAME_SIZE}")
+    return length
+
+
+def _pack_pairs(pairs: List[Tuple[ObjectId, ObjectId]]) -> bytes:
+    return b"".join(user_id.binary + resource_id.binary for user_id, resource_id in pairs)
+
+
+def encode_check_request(request_id: int, user_id: ObjectId, resource_id: ObjectId) -> bytes:
+    return _frame(_header.pack(CHECK, request_id) + user_id.binary + resource_id.binary)
+
+
+def encode_batch_request(request_id: int, pairs: List[Tuple[ObjectId, ObjectId]]) -> bytes:
+    if len(pairs) > MAX_BATCH_SIZE:
+        raise ProtocolError(f"batch of {len(pairs)} checks is larger than {MAX_BATCH_SIZE}")
+    return _frame(_header.pack(BATCH, request_id) + _count.pack(len(pairs)) + _pack_pairs(pairs))
+
+
+def encode_tenant_request(request_id: int, tenant_name: str) -> bytes:
+    return _frame(_header.pack(TENANT, request_id) + tenant_name.encode())
+
+
+def decode_request_id(body: bytes) -> int:
+    """The request id is read before the rest of the body, so the errors of a request are sent with its id"""
+    if len(body) < _header.size:
+        raise ProtocolError("request is too short")
+    return _header.unpack_from(body)[1]
+
+
+def decode_request(body: bytes) -> Tuple[int, int, Union[List[Tuple[ObjectId, ObjectId]], str]]:
+    """Returns the request type, the request id and the (user id, resource id) pairs (or the tenant name of TENANT requests)"""
+    if len(body) < _header.size:
+        raise ProtocolError("request is too short")
+    message_type, request_id = _header.unpack_from(body)
+    offset = _header.size
+    if message_type == TENANT:
+        try:
+            return message_type, request_id, body[offset:].decode()
+        except UnicodeDecodeError:
+            raise ProtocolError("tenant name is not utf-8")
+    if message_type == CHECK:
+        count = 1
+    elif message_type == BATCH:
+        if len(body) < offset + _count.size:
+            raise ProtocolError("batch request is too short")
+        count = _count.unpack_from(body, offset)[0]
+        offset += _count.size
+    else:
+        raise ProtocolError(f"unknown request type {message_type}")
+    if len(body) != offset + count * _PAIR_SIZE:
+        raise ProtocolError(f"request size doesn't match {count} checks")
+
+    pairs = []
+    for start in range(offset, len(body), _PAIR_SIZE):
+        pairs.append((ObjectId(body[start:start + _ID_SIZE]), ObjectId(body[start + _ID_SIZE:start + _PAIR_SIZE])))
+    return message_type, request_id, pairs
+
+
+def encode_response(message_type: int, request_id: int, statuses: List[int]) -> bytes:
+    if message_type == TENANT:
+        return _frame(_header.pack(TENANT, request_id))
+    if message_type == CHECK:
+        return _frame(_header.pack(CHECK, request_id) + bytes(statuses))
+    return _frame(_header.pack(BATCH, request_id) + _count.pack(len(statuses)) + bytes(statuses))
+
+
+def encode_error(request_id: int, status: int, message: str) -> bytes:
+    return _frame(_header.pack(ERROR, request_id) + bytes((status,)) + message.encode())
+
+
+def decode_response(body: bytes) -> Tuple[int, int, List[int], str]:
+    """Returns the response type, the request id, the statuses and the error message (for ERROR responses)"""
+    message_type, request_id = _header.unpack_from(body)
+    offset = _header.size
+    if message_type == TENANT:
+        return message_type, request_id, [], ""
+    if message_type == CHECK:
+        return message_type, request_id, [body[offset]], ""
+    if message_type == BATCH:
+        count = _count.unpack_from(body, offset)[0]
+        offset += _count.size
+        return message_type, request_id, list(body[offset:offset + count]), ""
+    if message_type == ERROR:
+        return message_type, request_id, [body[offset]], body[offset + 1:].decode()
+    raise ProtocolError(f"unknown response type {message_type}")
+
+
+class BinaryClient:
+    """asyncio client of the binary protocol, many checks can be awaited concurrently over the one connection"""
+    def __init__(self, host: str, port: int, tenant: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.tenant = tenant
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._request_ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._reading: Optional[asyncio.Task] = None
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._reading = asyncio.create_task(self._read_responses())
+        if self.tenant:
+            await self._send(encode_tenant_request, self.tenant)
+
+    async def close(self) -> None:
+        self._writer.close()
+        await self._writer.wait_closed()
+        await asyncio.gather(self._reading, return_exceptions=True)
+
+    async def _read_responses(self) -> None:
+        try:
+            while True:
+                length = _frame_length.unpack(await self._reader.readexactly(FRAME_HEADER_SIZE))[0]
+                message_type, request_id, statuses, message = decode_response(await self._reader.readexactly(length))
+                future = self._pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue
+                if message_type == ERROR:
+                    future.set_exception(ProtocolError(f"status {statuses[0]}: {message}"))
+                else:
+                    future.set_result(statuses)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"connection closed: {e}"))
+            self._pending.clear()
+
+    async def _send(self, frame_fn, *args) -> List[int]:
+        request_id = next(self._request_ids) & 0xFFFFFFFF
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        self._writer.write(frame_fn(request_id, *args))
+        await self._writer.drain()
+        return await future
+
+    async def check(self, user_id: ObjectId, resource_id: ObjectId) -> int:
+        return (await self._send(encode_check_request, user_id, resource_id))[0]
+
+    async def check_many(self, pairs: List[Tuple[ObjectId, ObjectId]]) -> List[int]:
+        return await self._send(encode_batch_request, pairs)
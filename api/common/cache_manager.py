@@ -1,11 +1,174 @@
-from typing import Any, Dict, List
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
 
 from aiohttp import web
 from bson import ObjectId
+from redis.client import Pipeline
 from redis.commands.json.path import Path
+from redis.exceptions import RedisError
 
-from api.common.configs import ATTRIBUTES_COL, DB, POLICIES_COL
-from api.common.exceptions import NotFoundError
+from api.common.configs import (
+    ATTRIBUTES_COL,
+    CACHE_MAX_MEMORY_FRACTION,
+    DEFAULT_TENANT,
+    POLICIES_COL,
+    RESOURCES_COL,
+    TENANTS,
+    USERS_COL,
+    USERS_LOCAL_CACHE_SIZE,
+    USERS_LOCAL_CACHE_TTL_SECONDS,
+)
+from api.common.decision import compile_policy_doc
+from api.common.tenants import Tenant, tenant_db, tenant_of
+from api.common.trace import TRACE
+from api.common.utils import LuaScript
+from redis import Redis
+
+logger = logging.getLogger("cache")
+
+
+# A small in-process LRU in front of Redis, it saves the Redis round trip for the hottest keys.
+# Each gunicorn worker has its own copy, so the entries are kept only for a short TTL
+# in order to bound the staleness caused by updates that were handled by other workers.
+# The batched reads (see BatchLoader) run in executor threads, so the access is guarded by a lock
+class LocalLRUCache:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if self.max_size <= 0:  # local cache is disabled
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+
+# Each tenant's cached entries are limited by the tenant's budget (see Tenant.cache_budget_bytes),
+# so a noisy tenant evicts only its own entries, and never another tenant's hot policies.
+# Every cache fill registers the written keys and their approximate sizes in the tenant's index (sorted by fill time),
+# and when the tenant's total is over its budget its oldest entries are deleted.
+# The reads don't touch the index (so a cache hit stays a single round trip), so the eviction order is by fill time,
+# the entries expire after their TTL anyway and the hot ones are filled again with a new time.
+# The budgets are enforced only when the tenants are listed (ABAC_TENANTS), so a single tenant deployment doesn't pay for the index,
+# and each budget is capped at the tenant's share of Redis maxmemory, so the budgets together fit in Redis
+# and Redis' own eviction (which isn't per tenant) doesn't kick in first
+class CacheBudget:
+    ENTRY_OVERHEAD_BYTES = 64  # approximate Redis overhead per key
+
+    # Returns the evicted keys, which are deleted by the caller: a script accesses only the keys it's given in KEYS,
+    # which on Redis Cluster have to be in the same slot as each other (the budget keys have the tenant's hash tag)
+    ADMIT_SCRIPT = """
+local budget = tonumber(ARGV[1])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+for i = 2, #ARGV, 2 do
+    local old = tonumber(redis.call('HGET', KEYS[2], ARGV[i]) or '0')
+    redis.call('ZADD', KEYS[1], now, ARGV[i])
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+    total = total - old + tonumber(ARGV[i + 1])
+end
+local evicted = {}
+while total > budget do
+    local oldest = redis.call('ZPOPMIN', KEYS[1])
+    if #oldest == 0 then
+        total = 0
+        break
+    end
+    total = total - tonumber(redis.call('HGET', KEYS[2], oldest[1]) or '0')
+    redis.call('HDEL', KEYS[2], oldest[1])
+    evicted[#evicted + 1] = oldest[1]
+end
+redis.call('SET', KEYS[3], total)
+return evicted
+"""
+
+    def __init__(self, tenants: Optional[Set[str]] = TENANTS):
+        # The number of tenants that share Redis, None when they aren't listed (no budgets)
+        self.tenants_count = len(tenants | {DEFAULT_TENANT}) if tenants is not None else None
+        self.max_memory = 0  # Redis maxmemory, 0 is unlimited (see load_max_memory)
+        self._admit = LuaScript(self.ADMIT_SCRIPT)
+
+    @property
+    def enabled(self) -> bool:
+        return self.tenants_count is not None
+
+    def load_max_memory(self, redis: Redis) -> None:
+        try:
+            self.max_memory = int(redis.config_get("maxmemory").get("maxmemory") or 0)
+        except RedisError:
+            # e.g. managed Redis services that don't allow CONFIG, the budgets are used as they are configured
+            logger.warning("Failed to read Redis maxmemory, the tenants cache budgets aren't capped by it", exc_info=True)
+
+    def budget_bytes(self, tenant: Tenant) -> int:
+        if not self.max_memory:
+            return tenant.cache_budget_bytes
+        return min(tenant.cache_budget_bytes, int(self.max_memory * CACHE_MAX_MEMORY_FRACTION / self.tenants_count))
+
+    @staticmethod
+    def build_keys(tenant: Tenant) -> List[str]:
+        return [tenant.key(f"CacheBudget:{{{tenant.name}}}:{name}") for name in ("Index", "Sizes", "Usage")]
+
+    def admit(self, app: web.Application, tenant: Tenant, sizes: Dict[str, int], pipe: Optional[Pipeline] = None) -> None:
+        """
+        Registers the written keys (key -> size in bytes), in the given pipeline or right away.
+        The pipeline's result is the keys that were evicted from the index, and the caller deletes them with evict
+        """
+        if not sizes or not self.enabled:
+            return
+        args = [self.budget_bytes(tenant)]
+        for key, size in sizes.items():
+            args += [key, size + len(key) + self.ENTRY_OVERHEAD_BYTES]
+        evicted = self._admit(app["redis"], keys=self.build_keys(tenant), args=args, pipe=pipe)
+        if pipe is None:
+            self.evict(app, evicted)
+
+    def execute(self, app: web.Application, pipe: Pipeline) -> List[Any]:
+        """Executes a pipeline that admit was called in last, and deletes the keys that it evicted"""
+        results = pipe.execute()
+        if self.enabled:
+            self.evict(app, results.pop())
+        return results
+
+    @staticmethod
+    def evict(app: web.Application, keys: List[Any]) -> None:
+        if keys:
+            app["redis"].delete(*keys)
+
+    @classmethod
+    def usage(cls, app: web.Application, tenant: Tenant) -> int:
+        return int(app["redis"].get(cls.build_keys(tenant)[2]) or 0)
+
+
+cache_budget: CacheBudget = CacheBudget()
 
 
 # Since upon each update (policy/user attribute) we need to check if the attribute exists in the global list
@@ -15,66 +178,335 @@ class AttributesCacheLoader:
     TTL_SECONDS = 60 * 15  # 15 minutes
 
     @staticmethod
-    def build_key() -> str:
-        return "Attributes"
+    def build_key(tenant: Tenant) -> str:
+        return tenant.key("Attributes")
 
     @staticmethod
     def load(request: web.Request) -> Dict[str, str]:
-        attrs_docs = request.app["mongodb"][DB][ATTRIBUTES_COL].find({})
+        attrs_docs = tenant_db(request)[ATTRIBUTES_COL].find({})
         attrs_docs = {d["_id"]: d["attribute_type"] for d in attrs_docs}
         return attrs_docs
 
     def get(self, request: web.Request) -> Dict[str, str]:
-        key = self.build_key()
+        tenant = tenant_of(request)
+        key = self.build_key(tenant)
         res = request.app["redis"].hgetall(key)
         if not res:  # list are not in cache
             # load dict from database
             attrs_docs = self.load(request)
-            # write to Redis
-            request.app["redis"].hset(key, mapping=attrs_docs)
-            # set expiration time
-            request.app["redis"].expire(key, self.TTL_SECONDS)
+            if attrs_docs:
+                # write to Redis with its expiration time in one transaction, Redis evicts only the keys that have a TTL
+                pipe = request.app["redis"].pipeline(transaction=True)
+                pipe.hset(key, mapping=attrs_docs)
+                pipe.expire(key, self.TTL_SECONDS)
+                pipe.execute()
+                cache_budget.admit(request.app, tenant, {key: sum(len(k) + len(v) for k, v in attrs_docs.items())})
             return attrs_docs
         else:
             return res
 
     def invalidate(self, request: web.Request) -> None:
-        request.app["redis"].delete(self.build_key())
+        request.app["redis"].delete(self.build_key(tenant_of(request)))
 
 
 # Getting the policy conditions is also a crucial part of the is_authorized calculation,
-# and since each policy has only 20 conditions, then it fits well in redis and will be lightweight
+# and since each policy has only 20 conditions, then it fits well in redis and will be lightweight.
+# Each policy is saved as a JSON document with its conditions and its signature (see build_policy_signature),
+# so the signatures of all the resource's policies can be fetched in one call before fetching any conditions
 class ConditionsCacheLoader:
     TTL_SECONDS = 60 * 15  # 15 minutes
 
     @staticmethod
-    def build_key(policy_id: ObjectId) -> str:
-        return f"Policies:{policy_id}"
+    def build_key(tenant: Tenant, policy_id: ObjectId) -> str:
+        return tenant.key(f"CompiledPolicies:{policy_id}")
 
     @staticmethod
-    def load(request: web.Request, policy_id: ObjectId) -> List[Dict[str, Any]]:
-        policy_doc = request.app["mongodb"][DB][POLICIES_COL].find_one({"_id": policy_id})
-        if not policy_doc:
-            raise NotFoundError(f"policy: '{policy_id}' was not found")
-        return policy_doc["conditions"]
-
-    def get(self, request: web.Request, policy_id: ObjectId) -> List[Dict[str, Any]]:
-        key = self.build_key(policy_id)
-        res = request.app["redis"].json().get(key)
-        if not res:  # conditions are not in cache
-            # load conditions from database
-            conditions = self.load(request, policy_id)
-            # write to Redis
-            request.app["redis"].json().set(key, Path.root_path(), conditions)
+    def to_cached_policy(policy_doc: Dict[str, Any]) -> Dict[str, Any]:
+        return compile_policy_doc(policy_doc)
+
+    def load_many(self, app: web.Application, tenant: Tenant, policy_ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+        """Returns only the policies that were found"""
+        policy_docs = tenant.db(app)[POLICIES_COL].find({"_id": {"$in": policy_ids}})
+        return {d["_id"]: self.to_cached_policy(d) for d in policy_docs}
+
+    def _get_many(self, app: web.Application, tenant: Tenant, policy_ids: List[ObjectId], field: str) -> Dict[ObjectId, Any]:
+        keys = [self.build_key(tenant, policy_id) for policy_id in policy_ids]
+        res = app["redis"].json().mget(keys, f".{field}")
+        values = {policy_id: value for policy_id, value in zip(policy_ids, res) if value is not None}
+        missing = [policy_id for policy_id in policy_ids if policy_id not in values]
+        if missing:
+            # load the missing policies from database in one query, and write them to Redis
+            loaded = self.load_many(app, tenant, missing)
+            self.set_many(app, tenant, loaded)
+            values.update({policy_id: policy[field] for policy_id, policy in loaded.items()})
+        trace = app.get(TRACE)
+        if trace is not None:
+            trace.record_policy_sources(field, {policy_id: "mongodb" if policy_id in missing else "redis" for policy_id in values})
+        return values
+
+    # Used by the is_authorized reads (see decision_steps), return only the policies that were found.
+    # The signatures of all the resource's policies are read first, and the conditions only of the policies that passed them
+    def get_signatures_many(self, app: web.Application, tenant: Tenant, policy_ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+        return self._get_many(app, tenant, policy_ids, "signature")
+
+    def get_conditions_many(self, app: web.Application, tenant: Tenant, policy_ids: List[ObjectId]) -> Dict[ObjectId, List[Dict[str, Any]]]:
+        return self._get_many(app, tenant, policy_ids, "conditions")
+
+    def set_many(self, app: web.Application, tenant: Tenant, policies: Dict[ObjectId, Dict[str, Any]]) -> None:
+        if not policies:
+            return
+        pipe = app["redis"].pipeline(transaction=False)
+        sizes = {}
+        for policy_id, policy in policies.items():
+            key = self.build_key(tenant, policy_id)
+            pipe.json().set(key, Path.root_path(), policy)
             # set expiration time
-            request.app["redis"].expire(key, self.TTL_SECONDS)
-            return conditions
-        else:
-            return res
+            pipe.expire(key, self.TTL_SECONDS)
+            sizes[key] = len(json.dumps(policy))
+        cache_budget.admit(app, tenant, sizes, pipe)
+        cache_budget.execute(app, pipe)
 
     def invalidate(self, request: web.Request, policy_id: ObjectId) -> None:
-        request.app["redis"].delete(self.build_key(policy_id))
+        request.app["redis"].delete(self.build_key(tenant_of(request), policy_id))
+
+
+# The user attributes are read on every is_authorized call, and updated up to ~10 times per second.
+# Invalidating the user on each update would make the next read go to MongoDB, but the update handlers
+# already know exactly which attribute has changed, so they apply the same delta on the cached hash instead.
+# Each user is a Redis hash (attribute name -> json encoded value), since the values can be string/integer/boolean.
+# Every write increments the user's revision in MongoDB (in the same update), and the cached hash keeps the revision
+# it reflects ($revision), so the fills and the updates of different workers can't overwrite a newer state with an older one:
+# a fill that read an older revision than the cached one is dropped, and an update that isn't the next revision
+# of the cached user (the user isn't cached, or an earlier update wasn't applied yet) leaves only its revision in the hash,
+# which readers treat as a miss. A hash is a cached user only when it has the $filled field
+class UserAttributesCacheLoader:
+    TTL_SECONDS = 60 * 15  # 15 minutes
+    # How long an update that couldn't be applied is remembered, it should be longer than any read from MongoDB
+    REVISION_ONLY_TTL_SECONDS = 60
+    # Attribute names can't start with $ (see AttributeNameField), so these never collide with the attributes
+    REVISION_FIELD = "$revision"
+    FILLED_FIELD = "$filled"
+
+    # ARGV: the revision, the TTL, and then the attributes (name, encoded value) pairs
+    FILL_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], '$revision') or '0')
+if tonumber(ARGV[1]) < current then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], '$revision', ARGV[1], '$filled', '1', unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+    # ARGV: the revision, the TTL of a revision only hash, 'set' or 'unset', the attribute name and its encoded value
+    APPLY_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], '$revision') or '0')
+local revision = tonumber(ARGV[1])
+if revision <= current then
+    return 0
+end
+if revision == current + 1 and redis.call('HEXISTS', KEYS[1], '$filled') == 1 then
+    if ARGV[3] == 'set' then
+        redis.call('HSET', KEYS[1], ARGV[4], ARGV[5])
+    else
+        redis.call('HDEL', KEYS[1], ARGV[4])
+    end
+    redis.call('HSET', KEYS[1], '$revision', revision)
+    return 1
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], '$revision', revision)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 0
+"""
+
+    def __init__(self, local_cache_size: int = USERS_LOCAL_CACHE_SIZE, local_cache_ttl: float = USERS_LOCAL_CACHE_TTL_SECONDS):
+        # keyed by (tenant name, user id)
+        self.local_cache = LocalLRUCache(local_cache_size, local_cache_ttl)
+        self._fill = LuaScript(self.FILL_SCRIPT)
+        self._apply = LuaScript(self.APPLY_SCRIPT)
+
+    @staticmethod
+    def build_key(tenant: Tenant, user_id: ObjectId) -> str:
+        return tenant.key(f"Users:{user_id}")
+
+    @staticmethod
+    def encode(attributes: Dict[str, Any]) -> Dict[str, str]:
+        return {k: json.dumps(v) for k, v in attributes.items()}
+
+    @classmethod
+    def decode(cls, mapping: Dict[str, str]) -> Dict[str, Any]:
+        return {k: json.loads(v) for k, v in mapping.items() if k not in (cls.REVISION_FIELD, cls.FILLED_FIELD)}
+
+    @staticmethod
+    def revision(user_doc: Dict[str, Any]) -> int:
+        # users that were written before the revisions were added have none
+        return user_doc.get("revision", 0)
+
+    # Used by the is_authorized reads, returns the attributes of the users that were found
+    def get_many(self, app: web.Application, tenant: Tenant, user_ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+        users = {}
+        for user_id in user_ids:
+            attributes = self.local_cache.get((tenant.name, user_id))
+            if attributes is not None:
+                users[user_id] = attributes
+        not_local = [user_id for user_id in user_ids if user_id not in users]
+        if not not_local:
+            return users
+
+        pipe = app["redis"].pipeline(transaction=False)
+        for user_id in not_local:
+            pipe.hgetall(self.build_key(tenant, user_id))
+        missing = []
+        for user_id, res in zip(not_local, pipe.execute()):
+            if self.FILLED_FIELD in res:
+                users[user_id] = self.decode(res)
+            else:
+                missing.append(user_id)
+
+        if missing:
+            user_docs = tenant.db(app)[USERS_COL].find({"_id": {"$in": missing}}, {"attributes": 1, "revision": 1})
+            loaded = {d["_id"]: d for d in user_docs}
+            self._fill_many(app, tenant, loaded)
+            users.update({user_id: user_doc["attributes"] for user_id, user_doc in loaded.items()})
+
+        for user_id in not_local:
+            if user_id in users:
+                self.local_cache.set((tenant.name, user_id), users[user_id])
+        return users
+
+    def set_attribute(self, request: web.Request, user_id: ObjectId, revision: int, attribute_name: str, attribute_value: Any) -> None:
+        tenant = tenant_of(request)
+        self._apply(
+            request.app["redis"],
+            keys=[self.build_key(tenant, user_id)],
+            args=[revision, self.REVISION_ONLY_TTL_SECONDS, "set", attribute_name, json.dumps(attribute_value)]
+        )
+        attributes = self.local_cache.get((tenant.name, user_id))
+        if attributes is not None:
+            self.local_cache.set((tenant.name, user_id), {**attributes, attribute_name: attribute_value})
+
+    def delete_attribute(self, request: web.Request, user_id: ObjectId, revision: int, attribute_name: str) -> None:
+        tenant = tenant_of(request)
+        self._apply(
+            request.app["redis"],
+            keys=[self.build_key(tenant, user_id)],
+            args=[revision, self.REVISION_ONLY_TTL_SECONDS, "unset", attribute_name]
+        )
+        attributes = self.local_cache.get((tenant.name, user_id))
+        if attributes is not None:
+            self.local_cache.set((tenant.name, user_id), {k: v for k, v in attributes.items() if k != attribute_name})
+
+    def override(self, request: web.Request, user_id: ObjectId, revision: int, attributes: Dict[str, Any]) -> None:
+        # Replacing the whole cached user, like a fill of the written revision
+        tenant = tenant_of(request)
+        self._fill_many(request.app, tenant, {user_id: {"attributes": attributes, "revision": revision}})
+        self.local_cache.pop((tenant.name, user_id))
+
+    def _fill_many(self, app: web.Application, tenant: Tenant, user_docs: Dict[ObjectId, Dict[str, Any]]) -> None:
+        if not user_docs:
+            return
+        pipe = app["redis"].pipeline(transaction=False)
+        sizes = {}
+        for user_id, user_doc in user_docs.items():
+            key = self.build_key(tenant, user_id)
+            mapping = self.encode(user_doc["attributes"])
+            args = [self.revision(user_doc), self.TTL_SECONDS]
+            for name, value in mapping.items():
+                args += [name, value]
+            self._fill(app["redis"], keys=[key], args=args, pipe=pipe)
+            sizes[key] = sum(len(k) + len(v) for k, v in mapping.items())
+        # only the filled users are counted in the tenant's budget (the dropped fills wrote nothing)
+        filled = {key: sizes[key] for key, written in zip(list(sizes), pipe.execute()) if written}
+        cache_budget.admit(app, tenant, filled)
+
+
+# The resource policy ids are read on every is_authorized call, and there are about 100,000 resources.
+# Each resource is saved as a Redis string of its policy ids packed as raw 12 bytes ObjectIds (instead of 24 hex chars in JSON),
+# so all the resources fit in a few MB. Binary values are read using the app["redis_bytes"] client (without decode_responses)
+# Like the users, every write increments the resource's revision in MongoDB, and the cached value starts with the revision
+# it reflects (8 bytes, big endian), so a fill that read an older revision than the cached one
+# (a write landed between the fill's read and its write) is dropped instead of overwriting the newer policy ids
+class ResourcePoliciesCacheLoader:
+    TTL_SECONDS = 60 * 15  # 15 minutes
+    OBJECT_ID_SIZE = 12
+    REVISION_SIZE = 8
+
+    # ARGV: the revision, the encoded value and the TTL
+    FILL_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current then
+    local revision = 0
+    for i = 1, 8 do
+        revision = revision * 256 + string.byte(current, i)
+    end
+    if tonumber(ARGV[1]) < revision then
+        return 0
+    end
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+    def __init__(self):
+        self._fill = LuaScript(self.FILL_SCRIPT)
+
+    @staticmethod
+    def build_key(tenant: Tenant, resource_id: ObjectId) -> str:
+        # not "Resources:", whose values had no revision
+        return tenant.key(f"ResourcePolicies:{resource_id}")
+
+    @staticmethod
+    def pack(policy_ids: List[ObjectId]) -> bytes:
+        return b"".join(policy_id.binary for policy_id in policy_ids)
+
+    @classmethod
+    def unpack(cls, data: bytes) -> List[ObjectId]:
+        size = cls.OBJECT_ID_SIZE
+        return [ObjectId(data[i:i + size]) for i in range(0, len(data), size)]
+
+    @classmethod
+    def encode(cls, resource_doc: Dict[str, Any]) -> bytes:
+        # resources that were written before the revisions were added have none
+        return resource_doc.get("revision", 0).to_bytes(cls.REVISION_SIZE, "big") + cls.pack(resource_doc["policy_ids"])
+
+    @classmethod
+    def decode(cls, data: bytes) -> List[ObjectId]:
+        return cls.unpack(data[cls.REVISION_SIZE:])
+
+    # Used by the is_authorized reads, returns the policy ids of the resources that were found
+    def get_many(self, app: web.Application, tenant: Tenant, resource_ids: List[ObjectId]) -> Dict[ObjectId, List[ObjectId]]:
+        res = app["redis_bytes"].mget([self.build_key(tenant, resource_id) for resource_id in resource_ids])
+        resources = {resource_id: self.decode(data) for resource_id, data in zip(resource_ids, res) if data is not None}
+        missing = [resource_id for resource_id in resource_ids if resource_id not in resources]
+        if missing:
+            resource_docs = tenant.db(app)[RESOURCES_COL].find({"_id": {"$in": missing}}, {"policy_ids": 1, "revision": 1})
+            loaded = {d["_id"]: d for d in resource_docs}
+            self._fill_many(app, tenant, loaded)
+            resources.update({resource_id: resource_doc["policy_ids"] for resource_id, resource_doc in loaded.items()})
+        return resources
+
+    def set(self, request: web.Request, resource_id: ObjectId, revision: int, policy_ids: List[ObjectId]) -> None:
+        # Write through, like a fill of the written revision
+        self._fill_many(request.app, tenant_of(request), {resource_id: {"policy_ids": policy_ids, "revision": revision}})
+
+    def _fill_many(self, app: web.Application, tenant: Tenant, resource_docs: Dict[ObjectId, Dict[str, Any]]) -> None:
+        if not resource_docs:
+            return
+        pipe = app["redis_bytes"].pipeline(transaction=False)
+        sizes = {}
+        for resource_id, resource_doc in resource_docs.items():
+            key = self.build_key(tenant, resource_id)
+            data = self.encode(resource_doc)
+            self._fill(app["redis_bytes"], keys=[key], args=[resource_doc.get("revision", 0), data, self.TTL_SECONDS], pipe=pipe)
+            sizes[key] = len(data)
+        # only the filled resources are counted in the tenant's budget (the dropped fills wrote nothing)
+        filled = {key: sizes[key] for key, written in zip(list(sizes), pipe.execute()) if written}
+        cache_budget.admit(app, tenant, filled)
 
 
 attributes_cache: AttributesCacheLoader = AttributesCacheLoader()
 conditions_cache: ConditionsCacheLoader = ConditionsCacheLoader()
+users_cache: UserAttributesCacheLoader = UserAttributesCacheLoader()
+resources_cache: ResourcePoliciesCacheLoader = ResourcePoliciesCacheLoader()
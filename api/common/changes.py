@@ -0,0 +1,162 @@
+import json
+import logging
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+from marshmallow import ValidationError
+from pymongo.errors import PyMongoError
+from redis.exceptions import RedisError
+
+from api.common.configs import (
+    CHANGES_COL,
+    CHANGES_RELAY_BATCH_SIZE,
+    CHANGES_STREAM_MAX_LEN,
+)
+from api.common.tenants import Tenant, tenant_db, tenant_of
+from api.common.utils import LuaScript
+from api.common.versions import db_committed_version
+from redis import Redis
+
+logger = logging.getLogger("changes")
+
+# Operations
+INSERT = "insert"
+UPDATE = "update"
+
+
+# Ordered log of all the writes, kept in a Redis Stream per tenant, so other systems (edge caches, sidecars) can keep
+# incremental replicas by reading the changes (GET /changes) instead of refetching the documents.
+# Each change has the entity type, id, version (see new_version) and the changed fields, in the same form as
+# the MongoDB update: "set" maps a field path (e.g. "attributes.age") to its new value, and "unset" lists the removed paths.
+# The stream is trimmed to about CHANGES_STREAM_MAX_LEN changes, a consumer that falls behind it has to reload the documents.
+#
+# A write records its change in the tenant's outbox collection (by its version) while its version is still pending,
+# and the committed changes are relayed from the outbox to the stream in their versions order, right after the write,
+# or in the background when Redis wasn't available (see relay_changes). So a write never fails on the changes log,
+# and its change isn't lost when Redis is down
+class ChangeLog:
+    # Appends a change only when it's newer than the last change in the stream, so relaying a change again
+    # (by two workers at once, or after a relay that failed before removing it from the outbox) doesn't duplicate it.
+    # Each change has the id of the change before it ("prev"), so readers know if changes after theirs were trimmed.
+    # ARGV: the max length, the version, and then the change's fields (name, value) pairs
+    APPEND_SCRIPT = LuaScript("""
+local last = redis.call('XREVRANGE', KEYS[1], '+', '-', 'COUNT', 1)[1]
+local prev = '0-0'
+if last then
+    prev = last[1]
+    for i = 1, #last[2], 2 do
+        if last[2][i] == 'version' and tonumber(last[2][i + 1]) >= tonumber(ARGV[2]) then
+            return false
+        end
+    end
+end
+return redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'prev', prev, 'version', ARGV[2], unpack(ARGV, 3))
+""")
+
+    def __init__(self, max_len: int = CHANGES_STREAM_MAX_LEN):
+        self.max_len = max_len
+        # The tenants whose changes weren't relayed after their writes, retried by relay_changes
+        self.unrelayed: Set[str] = set()
+
+    @staticmethod
+    def build_key(tenant: Tenant) -> str:
+        return tenant.key("Changes")
+
+    @staticmethod
+    def record(
+            request: web.Request,
+            entity: str,
+            entity_id: Any,
+            version: int,
+            operation: str,
+            set_fields: Optional[Dict[str, Any]] = None,
+            unset_fields: Optional[List[str]] = None
+    ) -> None:
+        """Records the change of a write in the outbox, it's called in the write's new_version block after the write"""
+        # ObjectIds (e.g. the resource's policy ids) are written as strings, like in the API responses
+        tenant_db(request)[CHANGES_COL].insert_one({
+            "_id": version,
+            "entity": entity,
+            "entity_id": str(entity_id),
+            "op": operation,
+            "set": json.dumps(set_fields or {}, default=str),
+            "unset": json.dumps(unset_fields or [])
+        })
+
+    def relay(self, app: web.Application, tenant: Tenant) -> bool:
+        """Moves the committed changes from the outbox to the stream, returns False when changes are left in the outbox"""
+        db = tenant.db(app)
+        key = self.build_key(tenant)
+        while True:
+            # Only the committed versions, a change of a lower version might not be recorded yet (see new_version)
+            committed = db_committed_version(db)
+            changes = list(db[CHANGES_COL].find().sort("_id", 1).limit(CHANGES_RELAY_BATCH_SIZE))
+            ready = [change for change in changes if change["_id"] <= committed]
+            if ready:
+                pipe = app["redis"].pipeline(transaction=False)
+                for change in ready:
+                    args = [self.max_len, change["_id"]]
+                    for field in ("entity", "entity_id", "op", "set", "unset"):
+                        args += [field, change[field]]
+                    self.APPEND_SCRIPT(app["redis"], keys=[key], args=args, pipe=pipe)
+                pipe.execute()
+                db[CHANGES_COL].delete_many({"_id": {"$lte": ready[-1]["_id"]}})
+            if len(ready) < CHANGES_RELAY_BATCH_SIZE:
+                return len(ready) == len(changes)
+
+    def try_relay(self, app: web.Application, tenant: Tenant) -> None:
+        """relay that doesn't fail, the tenant's changes are retried in the background when any of them is left (see relay_changes)"""
+        try:
+            if self.relay(app, tenant):
+                self.unrelayed.discard(tenant.name)
+                return
+        except (RedisError, PyMongoError):
+            logger.warning(f"Failed to relay the changes of tenant {tenant.name}", exc_info=True)
+        self.unrelayed.add(tenant.name)
+
+    def publish(self, request: web.Request) -> None:
+        """Relays the changes right after a write (after its new_version block), it never fails the write"""
+        self.try_relay(request.app, tenant_of(request))
+
+    @staticmethod
+    def decode(change_id: str, fields: Dict[str, str]) -> Dict[str, Any]:
+        return {
+            "id": change_id,
+            "entity": fields["entity"],
+            "entity_id": fields["entity_id"],
+            "version": int(fields["version"]),
+            "op": fields["op"],
+            "set": json.loads(fields["set"]),
+            "unset": json.loads(fields["unset"])
+        }
+
+    def read(self, redis: Redis, tenant: Tenant, since: str, count: int, block_ms: Optional[int]) -> Dict[str, Any]:
+        """
+        Returns the changes after the `since` change id (up to `count`), waiting up to `block_ms` for new changes when there are none.
+        This call blocks, so it's called in the changes executor (see changes_handlers)
+        """
+        since_id = _stream_id(since)
+        # Changes after `since` were trimmed when the change right before the first retained one is after `since`
+        # (a consumer that read up to it, and not beyond, hasn't missed anything)
+        key = self.build_key(tenant)
+        first = redis.xrange(key, count=1)
+        truncated = since != "0-0" and bool(first) and _stream_id(first[0][1].get("prev", first[0][0])) > since_id
+
+        response = redis.xread({key: since}, count=count, block=block_ms)
+        changes = [self.decode(change_id, fields) for _, entries in response for change_id, fields in entries]
+        return {
+            "changes": changes,
+            "next": changes[-1]["id"] if changes else since,
+            "truncated": truncated
+        }
+
+
+def _stream_id(change_id: str) -> Tuple[int, int]:
+    ms, _, seq = change_id.partition("-")
+    try:
+        return int(ms), int(seq or 0)
+    except ValueError:
+        raise ValidationError(f"'{change_id}' is not a valid change id")
+
+
+change_log: ChangeLog = ChangeLog()
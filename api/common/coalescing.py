@@ -0,0 +1,78 @@
+import asyncio
+from typing import Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+
+from api.common.configs import COALESCING_MAX_BATCH_SIZE, COALESCING_WINDOW_SECONDS
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+# Under burst load many in flight requests read the same popular keys (users, resources, policies).
+# The BatchLoader makes these requests share one backend read per worker:
+# * requests for a key that is already pending/in flight wait on the same future (single flight)
+# * distinct keys that arrive while a read is in flight (up to a short window) are read together in one call (one MGET / $in query)
+# so the backends load grows with the number of distinct keys and not with the number of requests.
+# When no read is in flight the keys are read right away (on the next loop iteration, with the keys of the same iteration),
+# so at low load a read doesn't wait for the window
+# The batch function is blocking (redis/pymongo clients), so it runs in the loop's default executor
+class BatchLoader(Generic[K, V]):
+    def __init__(
+            self,
+            batch_fn: Callable[[List[K]], Dict[K, V]],
+            window_seconds: float = COALESCING_WINDOW_SECONDS,
+            max_batch_size: int = COALESCING_MAX_BATCH_SIZE
+    ):
+        self.batch_fn = batch_fn
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size
+        self._futures: Dict[K, asyncio.Future] = {}  # pending and in flight keys
+        self._pending: List[K] = []
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._in_flight = 0  # reads that were sent and not resolved yet
+
+    async def load(self, key: K) -> Optional[V]:
+        """Returns None for keys that were not found"""
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._pending.append(key)
+            if len(self._pending) >= self.max_batch_size:
+                self._flush()
+            elif self._flush_handle is None:
+                if self._in_flight:
+                    self._flush_handle = loop.call_later(self.window_seconds, self._flush)
+                else:
+                    self._flush_handle = loop.call_soon(self._flush)
+        # shielding the shared future, so a cancelled request doesn't cancel the read for the other requests
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: List[K]) -> List[Optional[V]]:
+        return list(await asyncio.gather(*(self.load(key) for key in keys)))
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        keys, self._pending = self._pending, []
+        if not keys:
+            return
+        self._in_flight += 1
+        read = asyncio.get_running_loop().run_in_executor(None, self.batch_fn, keys)
+        read.add_done_callback(lambda res: self._resolve(keys, res))
+
+    def _resolve(self, keys: List[K], read: asyncio.Future) -> None:
+        self._in_flight -= 1
+        if not self._in_flight and self._pending:
+            # the keys that were held while the reads were in flight don't wait for the rest of the window
+            self._flush()
+        error = read.exception() if not read.cancelled() else asyncio.CancelledError()
+        values = read.result() if error is None else None
+        for key in keys:
+            future = self._futures.pop(key)
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(values.get(key))
@@ -1,7 +1,9 @@
-
+import os
 
 # API configs
 SERVER_PORT = 9876
+# The swagger UI is built by every worker on startup, so it can be turned off in production
+SWAGGER_ENABLED = os.environ.get("ABAC_SWAGGER_ENABLED", "true").lower() == "true"
 
 
 # MongoDB configs
@@ -11,6 +13,9 @@ ATTRIBUTES_COL = "attributes"
 USERS_COL = "users"
 POLICIES_COL = "policies"
 RESOURCES_COL = "resources"
+COUNTERS_COL = "counters"
+# The outbox of the changes log (see ChangeLog)
+CHANGES_COL = "changes"
 
 
 # Redis configs
@@ -19,3 +24,76 @@ REDIS_PORT = 6379
 REDIS_DB_NUM = 1
 REDIS_PASS = "1234"
 
+# Users cache configs
+# The in-process users cache is disabled by default, since each worker sees only its own delta updates
+USERS_LOCAL_CACHE_SIZE = 0
+USERS_LOCAL_CACHE_TTL_SECONDS = 1
+
+
+# Requests coalescing configs (see BatchLoader)
+# How long a read waits for other keys to be batched with it while another read is in flight, and the max keys in one batch
+COALESCING_WINDOW_SECONDS = 0.001
+COALESCING_MAX_BATCH_SIZE = 100
+
+
+# Admission control configs (per worker)
+ADMISSION_MAX_CONCURRENCY = 64
+ADMISSION_MAX_WRITE_CONCURRENCY = 16  # the rest of the slots are kept for reads, is_authorized first
+ADMISSION_QUEUE_TIMEOUT_SECONDS = 0.5
+ADMISSION_MAX_QUEUE_SIZE = 256
+
+# Per client rate limiting configs (client is the X-Client-Id header, or the remote address)
+# Disabled by default (0), since behind a load balancer all the requests come from the same address
+RATE_LIMIT_PER_SECOND = 0
+RATE_LIMIT_BURST = 100
+RATE_LIMIT_TIMEOUT_SECONDS = 0.05  # the requests are admitted without the check when Redis doesn't answer in time
+RATE_LIMIT_MAX_CHECKS = 4  # checks in flight (threads), the requests are admitted without the check when all of them are busy
+RATE_LIMIT_LOG_INTERVAL_SECONDS = 10  # the checks that failed open are logged at most once in the interval
+
+
+# Health check configs
+# The backends are pinged in the background, and considered down if they didn't answer in the last HEALTH_CHECK_STALE_SECONDS
+HEALTH_CHECK_INTERVAL_SECONDS = 5
+HEALTH_CHECK_STALE_SECONDS = 15
+
+
+# Admin configs
+# Required in the X-Admin-Token header of admin only operations (like /is_authorized?explain=true),
+# these operations are disabled when it's not set
+ADMIN_TOKEN = os.environ.get("ABAC_ADMIN_TOKEN")
+
+
+# Embeddable PDP feed configs (see api.pdp)
+FEED_MAX_PAGE_SIZE = 1000
+# A version that was taken by a write and not released after this long is of a writer that crashed (see new_version)
+VERSION_PENDING_TIMEOUT_SECONDS = 60
+
+
+# Binary protocol configs (see binary_handler), 0 disables the binary listener
+# All the gunicorn workers listen on the same port (SO_REUSEPORT), and the kernel balances the connections between them
+BINARY_PORT = 9877
+BINARY_MAX_IN_FLIGHT_PER_CONNECTION = 256
+
+
+# Changes log configs (see ChangeLog)
+CHANGES_STREAM_MAX_LEN = 100000
+CHANGES_MAX_BATCH_SIZE = 1000
+CHANGES_MAX_WAIT_SECONDS = 30
+# The long polls block a thread each, so they have their own threads and don't hold the default executor's threads.
+# They aren't admitted by the admission control, the polls above the limit are rejected with 503
+CHANGES_MAX_LONG_POLLS = 32
+# The changes that couldn't be relayed right after their write are retried in the background
+CHANGES_RELAY_INTERVAL_SECONDS = 1
+CHANGES_RELAY_BATCH_SIZE = 1000
+
+
+# Tenants configs (see Tenant), the tenant is given in the X-Tenant-Id header
+DEFAULT_TENANT = "default"
+# Comma separated list of the allowed tenants, when it's not set any valid tenant name is accepted
+TENANTS = set(os.environ["ABAC_TENANTS"].split(",")) if os.environ.get("ABAC_TENANTS") else None
+# Max bytes of cached entries per tenant (see CacheBudget), and overrides for specific tenants.
+# The budgets are enforced only when the tenants are listed, and each is capped at the tenant's equal share
+# of this fraction of Redis maxmemory (the rest is kept for the changes log, the rate limits, etc.)
+TENANT_CACHE_BUDGET_BYTES = 32 * 1024 * 1024
+TENANT_CACHE_BUDGETS = {}
+CACHE_MAX_MEMORY_FRACTION = 0.8
@@ -0,0 +1,464 @@
+import re
+import re._parser as _regex_parser
+import time
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from bson import ObjectId
+from marshmallow import ValidationError
+
+# This file contains the decision logic (validators, operators, signatures and decide_if_authorized).
+# It doesn't depend on the server, MongoDB or Redis, so it's shared by the api handlers,
+# the replay tool and the embeddable policy decision point (api.pdp)
+
+if TYPE_CHECKING:
+    from api.common.trace import DecisionTrace
+
+_allowed_operators = {
+    "string": {"=", ">", "<", "starts_with", "in", "not_in", "between", "regex"},
+    "boolean": {"="},
+    "integer": {"=", ">", "<", "in", "not_in", "between"},
+    "list": {"contains"},
+    "list[string]": {"contains"},
+    "list[integer]": {"contains"},
+    "list[boolean]": {"contains"}
+}
+_scalar_types = {"string": str, "integer": int, "boolean": bool}
+# The type of the items of the list attributes, "list" can hold items of any scalar type
+_list_item_types = {"list": None, "list[string]": "string", "list[integer]": "integer", "list[boolean]": "boolean"}
+
+# The regex patterns are compiled once per worker (the conditions are read as plain JSON from the cache)
+_compiled_pattern = lru_cache(maxsize=1024)(re.compile)
+MAX_REGEX_LENGTH = 256
+_REPEATS = (_regex_parser.MAX_REPEAT, _regex_parser.MIN_REPEAT, _regex_parser.POSSESSIVE_REPEAT)
+
+
+def _validate_scalar_type(k: str, attribute_type: str, v: Any) -> None:
+    if type(v) is not _scalar_types[attribute_type]:
+        raise ValidationError(f"attribute '{k}' is not {attribute_type}")
+
+
+def validate_values_types(attributes_conf: Dict[str, str], attributes: Dict[str, Any]) -> None:
+    for k, v in attributes.items():
+        if k not in attributes_conf:
+            raise ValidationError(f"attribute '{k}' was not found in global attributes")
+        attribute_type = attributes_conf[k]
+        match attribute_type:
+            case "string" | "integer" | "boolean":
+                _validate_scalar_type(k, attribute_type, v)
+            case _ if attribute_type in _list_item_types:
+                item_type = _list_item_types[attribute_type]
+                if item_type is None:
+                    if type(v) is not list or any(type(item) not in (str, int, bool) for item in v):
+                        raise ValidationError(f"attribute '{k}' is not list of string, integer or boolean")
+                elif type(v) is not list or any(type(item) is not _scalar_types[item_type] for item in v):
+                    raise ValidationError(f"attribute '{k}' is not list of {item_type}")
+            case _:
+                raise ValidationError(f"attribute '{k}' of type '{attribute_type}' is not supported")
+
+
+# This function validates that the conditions are valid for the attribute's types
+# example if there is a condition on boolean attribute, then it can't use operator 'starts_with' on it
+def validate_conditions_types(attributes_conf: Dict[str, str], conditions: List[Dict[str, Any]]) -> None:
+    for cond in conditions:
+        k = cond["attribute_name"]
+        v = cond["value"]
+        if k not in attributes_conf:
+            raise ValidationError(f"attribute '{k}' was not found in global attributes")
+        attribute_type = attributes_conf[k]
+
+        if cond["operator"] not in _allowed_operators[attribute_type]:
+            raise ValidationError(f'Cant apply operator "{cond["operator"]}" on {attribute_type}')
+
+        match cond["operator"]:
+            case "in" | "not_in":
+                if type(v) is not list or not v:
+                    raise ValidationError(f'operator "{cond["operator"]}" on attribute \'{k}\' requires a non empty list')
+                for item in v:
+                    _validate_scalar_type(k, attribute_type, item)
+            case "between":
+                if type(v) is not list or len(v) != 2:
+                    raise ValidationError(f'operator "between" on attribute \'{k}\' requires a list of [min, max]')
+                for item in v:
+                    _validate_scalar_type(k, attribute_type, item)
+                if v[0] > v[1]:
+                    raise ValidationError(f'operator "between" on attribute \'{k}\' requires min <= max')
+            case "contains":
+                item_type = _list_item_types[attribute_type]
+                if item_type is not None:
+                    _validate_scalar_type(k, item_type, v)
+                elif type(v) not in (str, int, bool):
+                    raise ValidationError(f"attribute '{k}' value is not string, integer or boolean")
+            case "regex":
+                _validate_scalar_type(k, attribute_type, v)
+                _validate_regex(k, v)
+            case _:
+                _validate_scalar_type(k, attribute_type, v)
+
+
+# The characters of a class item (e.g. "a", "a-z", "\d"), as a predicate on the character's code
+_CATEGORY_PATTERNS = {
+    items[0][1]: re.compile(escape) for escape, (op, items) in _regex_parser.CATEGORIES.items() if op is _regex_parser.IN
+}
+
+
+def _class_item_matcher(op, av) -> Optional[Callable[[int], bool]]:
+    if op is _regex_parser.LITERAL:
+        return lambda c: c == av
+    if op is _regex_parser.RANGE:
+        return lambda c: av[0] <= c <= av[1]
+    if op is _regex_parser.CATEGORY and av in _CATEGORY_PATTERNS:
+        return lambda c: _CATEGORY_PATTERNS[av].match(chr(c)) is not None
+    return None
+
+
+def _has_overlapping_items(items: List[Tuple[Any, Any]]) -> bool:
+    """Whether a character can be matched by two items of a class, e.g. "[\\w\\d]" or "(\\w|\\d)" (a single characters alternation)"""
+    if not items or items[0][0] is _regex_parser.NEGATE:
+        return False
+    matchers = [_class_item_matcher(op, av) for op, av in items]
+    if None in matchers:  # unknown item, assumed to overlap the others
+        return len(items) > 1
+    # checking the latin characters, and the ends of the literals and ranges (two ranges overlap only if one has the other's end)
+    chars = set(range(0x250))
+    for op, av in items:
+        chars.update(av if op is _regex_parser.RANGE else [av] if op is _regex_parser.LITERAL else [])
+    return any(sum(matcher(c) for matcher in matchers) > 1 for c in chars)
+
+
+def _has_ambiguous_repeats(items: _regex_parser.SubPattern, in_repeat: bool = False) -> bool:
+    """Whether a repetition can match the same text in more than one way (the cause of exponential backtracking)"""
+    for op, av in items:
+        if op is _regex_parser.GROUPREF:
+            return True
+        if in_repeat and op is _regex_parser.BRANCH:
+            return True
+        if in_repeat and op is _regex_parser.IN and _has_overlapping_items(av):
+            return True
+        if op in _REPEATS:
+            repeats = av[1] > 1
+            if (repeats and in_repeat) or _has_ambiguous_repeats(av[2], in_repeat or repeats):
+                return True
+            continue
+        # the other nodes hold their sub patterns in their arguments (groups, branches, lookarounds)
+        args = av if isinstance(av, (tuple, list)) else [av]
+        for arg in args:
+            for sub in (arg if isinstance(arg, list) else [arg]):
+                if isinstance(sub, _regex_parser.SubPattern) and _has_ambiguous_repeats(sub, in_repeat):
+                    return True
+    return False
+
+
+# The regex conditions are evaluated by Python's backtracking engine, without a timeout, so a pattern like "(a+)+$"
+# can take exponential time on some user values. The patterns are limited in length, and the causes of catastrophic
+# backtracking are rejected when the policy is written: nested repetitions, alternations under a repetition
+# (e.g. "(a|aa)+", a single characters class only when its characters overlap, e.g. "(\w|\d)+") and backreferences
+def _validate_regex(k: str, pattern: str) -> None:
+    if len(pattern) > MAX_REGEX_LENGTH:
+        raise ValidationError(f"attribute '{k}' regex is longer than {MAX_REGEX_LENGTH} characters")
+    try:
+        parsed = _regex_parser.parse(pattern)
+    except re.error as e:
+        raise ValidationError(f"attribute '{k}' has invalid regex: {e}")
+    if _has_ambiguous_repeats(parsed):
+        raise ValidationError(f"attribute '{k}' regex can't have nested repetitions, alternations under repetitions or backreferences")
+    _compiled_pattern(pattern)
+
+
+# The "in"/"not_in" values are preprocessed (when the policy is written to the cache) into a JSON object of value -> true,
+# so after reading the policy from the cache the membership check is a dict lookup instead of scanning the list.
+# JSON keys are strings, but the values of an attribute are all of the same type, so str() keeps them distinct
+def _lookup_key(value: Any) -> str:
+    return value if type(value) is str else str(value)
+
+
+def compile_conditions(conditions: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    compiled = []
+    for cond in conditions:
+        if cond["operator"] in ("in", "not_in") and "lookup" not in cond:
+            cond = {**cond, "lookup": {_lookup_key(v): True for v in cond["value"]}}
+        elif cond["operator"] == "regex":
+            _compiled_pattern(cond["value"])  # compiled by the worker that loads the policy, before it's evaluated
+        compiled.append(cond)
+    return compiled
+
+
+def _in(condition: Dict[str, Any], value: Any) -> bool:
+    lookup = condition.get("lookup")
+    if lookup is None:  # not compiled, see compile_conditions
+        return value in condition["value"]
+    return _lookup_key(value) in lookup
+
+
+# This function applies the condition on the attributes and return True/False accordingly
+def apply(condition: Dict[str, Any], attributes: Dict[str, Any]) -> bool:
+    if condition["attribute_name"] not in attributes:
+        # the schedule of a time bounded policy is not on any attribute (see compile_policy)
+        return condition["operator"] == "schedule" and _apply_schedule(condition, attributes)
+    match condition["operator"]:
+        case "=":
+            return condition["value"] == attributes[condition["attribute_name"]]
+        case ">":
+            return condition["value"] < attributes[condition["attribute_name"]]
+        case "<":
+            return condition["value"] > attributes[condition["attribute_name"]]
+        case "starts_with":
+            return attributes[condition["attribute_name"]].startswith(condition["value"])
+        case "in":
+            return _in(condition, attributes[condition["attribute_name"]])
+        case "not_in":
+            return not _in(condition, attributes[condition["attribute_name"]])
+        case "between":
+            return condition["value"][0] <= attributes[condition["attribute_name"]] <= condition["value"][1]
+        case "contains":
+            return condition["value"] in attributes[condition["attribute_name"]]
+        case "regex":
+            return _compiled_pattern(condition["value"]).search(attributes[condition["attribute_name"]]) is not None
+
+
+# The policy signature holds what a user must have in order for the policy to pass:
+# the names of the attributes used by the conditions (every operator is false on a missing attribute),
+# and the values of the "=" conditions. It's computed once upon writing the policy, and it lets
+# is_authorized reject a policy without fetching and evaluating its conditions
+def build_policy_signature(conditions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "attributes": sorted({cond["attribute_name"] for cond in conditions}),
+        "equals": [[cond["attribute_name"], cond["value"]] for cond in conditions if cond["operator"] == "="]
+    }
+
+
+# The times of the policies (not_before, not_after and the schedule) are unix seconds in the database and the caches,
+# the API takes ISO 8601 times (UTC when there is no timezone) as well
+def parse_timestamp(value: Any) -> float:
+    if type(value) in (int, float):
+        return value
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValidationError(f"{value} is not an ISO 8601 time or unix seconds")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _now() -> float:
+    return time.time()
+
+
+# A policy can be active only within [not_before, not_after), and can have scheduled conditions that replace
+# its conditions from a given time, so nothing has to be written (and no cache invalidated) when the policy changes.
+# All the transitions are precomputed into phases of {"from", "until", "conditions"} (None is unbounded),
+# outside of the phases the policy doesn't pass
+def build_phases(
+        conditions: List[Dict[str, Any]],
+        not_before: Optional[Any] = None,
+        not_after: Optional[Any] = None,
+        schedule: Optional[List[Dict[str, Any]]] = None
+) -> List[Dict[str, Any]]:
+    starts = [(None, conditions)]
+    for scheduled in sorted(schedule or [], key=lambda scheduled: parse_timestamp(scheduled["at"])):
+        starts.append((parse_timestamp(scheduled["at"]), scheduled["conditions"]))
+    not_before = parse_timestamp(not_before) if not_before is not None else None
+    not_after = parse_timestamp(not_after) if not_after is not None else None
+
+    phases = []
+    for i, (start, phase_conditions) in enumerate(starts):
+        end = starts[i + 1][0] if i + 1 < len(starts) else None
+        if not_before is not None:
+            start = not_before if start is None else max(start, not_before)
+        if not_after is not None:
+            end = not_after if end is None else min(end, not_after)
+        if start is not None and end is not None and start >= end:
+            continue  # replaced before it started, or out of the policy's window
+        phases.append({"from": start, "until": end, "conditions": compile_conditions(phase_conditions)})
+    return phases
+
+
+def _apply_schedule(condition: Dict[str, Any], attributes: Dict[str, Any]) -> bool:
+    now = _now()
+    for phase in condition["value"]:
+        if (phase["from"] is None or phase["from"] <= now) and (phase["until"] is None or now < phase["until"]):
+            return all(apply(cond, attributes) for cond in phase["conditions"])
+    return False
+
+
+# What the user must have in every phase, since the signature is checked without the time
+def _phases_signature(phases: List[Dict[str, Any]]) -> Dict[str, Any]:
+    signatures = [build_policy_signature(phase["conditions"]) for phase in phases]
+    if not signatures:
+        return build_policy_signature([])
+    attributes = set.intersection(*(set(signature["attributes"]) for signature in signatures))
+    return {
+        "attributes": sorted(attributes),
+        "equals": [equal for equal in signatures[0]["equals"] if all(equal in signature["equals"] for signature in signatures[1:])]
+    }
+
+
+# The form of a policy in the conditions cache
+def compile_policy(
+        conditions: List[Dict[str, Any]],
+        signature: Optional[Dict[str, Any]] = None,
+        not_before: Optional[Any] = None,
+        not_after: Optional[Any] = None,
+        schedule: Optional[List[Dict[str, Any]]] = None
+) -> Dict[str, Any]:
+    if not_before is not None or not_after is not None or schedule:
+        # one "schedule" condition that holds all the phases, so the cached policy doesn't change with the time
+        phases = build_phases(conditions, not_before, not_after, schedule)
+        return {
+            "conditions": [{"attribute_name": None, "operator": "schedule", "value": phases}],
+            "signature": _phases_signature(phases)
+        }
+    return {
+        # the conditions are kept as is in the database (the lookups keys are user values, which are not always valid field names),
+        # and preprocessed once when they are written to the cache
+        "conditions": compile_conditions(conditions),
+        # policies that were written before the signatures were added don't have it in the database
+        "signature": signature or build_policy_signature(conditions)
+    }
+
+
+# Compiles a policy document, as stored in the database or as returned from the API
+def compile_policy_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    return compile_policy(doc["conditions"], doc.get("signature"), doc.get("not_before"), doc.get("not_after"), doc.get("schedule"))
+
+
+# Serves policies that were already fetched (see compile_policy),
+# e.g. the policies of a snapshot in the replay tool, or the policies held by the embeddable PDP
+class PrefetchedConditionsCache:
+    def __init__(self, policies: Dict[ObjectId, Dict[str, Any]]):
+        self.policies = policies
+
+    def get_signatures(self, policy_ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+        return {policy_id: self.policies[policy_id]["signature"] for policy_id in policy_ids}
+
+    def get_conditions(self, policy_ids: List[ObjectId]) -> Dict[ObjectId, List[Dict[str, Any]]]:
+        return {policy_id: self.policies[policy_id]["conditions"] for policy_id in policy_ids}
+
+
+# Each worker gives every attribute name a small integer id on first sight, so a set of attribute names
+# can be held as a bitset (python int) and compared with a single "&".
+# The ids are never sent outside the process, and there are only about 1000 attributes
+_attribute_ids: Dict[str, int] = {}
+
+
+def intern_attribute(attribute_name: str) -> int:
+    attribute_id = _attribute_ids.get(attribute_name)
+    if attribute_id is None:
+        attribute_id = _attribute_ids[attribute_name] = len(_attribute_ids)
+    return attribute_id
+
+
+def attributes_mask(attribute_names: Iterable[str]) -> int:
+    mask = 0
+    for attribute_name in attribute_names:
+        mask |= 1 << intern_attribute(attribute_name)
+    return mask
+
+
+@lru_cache(maxsize=4096)
+def _required_attributes_mask(attribute_names: Tuple[str, ...]) -> int:
+    return attributes_mask(attribute_names)
+
+
+def signature_matches(signature: Dict[str, Any], user_mask: int, user_attributes: Dict[str, Any]) -> bool:
+    required_mask = _required_attributes_mask(tuple(signature["attributes"]))
+    if required_mask & user_mask != required_mask:
+        return False
+    for attribute_name, value in signature["equals"]:
+        if value != user_attributes[attribute_name]:
+            return False
+    return True
+
+
+# The policies data that the decision asks for (see decision_steps)
+SIGNATURES = "signatures"
+CONDITIONS = "conditions"
+
+DecisionSteps = Generator[Tuple[str, List[ObjectId]], Dict[ObjectId, Any], bool]
+
+
+def evaluate_conditions(conditions: List[Dict[str, Any]], user_attributes: Dict[str, Any], policy_trace: Optional[Dict[str, Any]] = None) -> bool:
+    if policy_trace is None:
+        for cond in conditions:
+            if not apply(cond, user_attributes):
+                return False
+        return True
+
+    started = time.perf_counter()
+    policy_trace["conditions"] = []
+    policy_trace["failed_condition"] = None
+    for cond in conditions:
+        result = apply(cond, user_attributes)
+        # without the preprocessed lookup, it's a copy of the value
+        cond = {k: v for k, v in cond.items() if k != "lookup"}
+        policy_trace["conditions"].append({**cond, "result": result})
+        if not result:
+            policy_trace["failed_condition"] = cond
+            break
+    policy_trace["eval_ms"] = round((time.perf_counter() - started) * 1000, 3)
+    return policy_trace["failed_condition"] is None
+
+
+# The decision logic of is_authorized, written as steps that ask for the policies data they need:
+# it yields (SIGNATURES or CONDITIONS, policy ids) and is sent back a dict of policy id -> signature or conditions.
+# So the same evaluation runs on the worker's batch loaders (see authorize) and on policies that are already in memory
+# (see decide_if_authorized). When a trace is given, what happened to each policy and condition is recorded (?explain=true)
+def decision_steps(policy_ids: List[ObjectId], user_attributes: Dict[str, Any], trace: Optional["DecisionTrace"] = None) -> DecisionSteps:
+    candidates = policy_ids
+    # Filtering the policies by their signatures first (one batch for all of them), and fetching only the conditions
+    # of the policies that passed them. For a single policy it's cheaper to just fetch its conditions
+    if len(policy_ids) > 1:
+        signatures = yield SIGNATURES, policy_ids
+        user_mask = attributes_mask(user_attributes)
+        candidates = [
+            policy_id for policy_id in policy_ids
+            if signature_matches(signatures[policy_id], user_mask, user_attributes)
+        ]
+    conditions = (yield CONDITIONS, candidates) if candidates else {}
+
+    for policy_id in policy_ids:
+        policy_trace = None
+        if trace is not None:
+            policy_trace = {"policy_id": str(policy_id), "prefilter": "passed" if len(policy_ids) > 1 else "skipped"}
+            trace.policies.append(policy_trace)
+        policy_conditions = conditions.get(policy_id)
+        if policy_conditions is None:  # rejected by its signature
+            if policy_trace is not None:
+                policy_trace.update(prefilter="rejected", passed=False)
+            continue
+        passed = evaluate_conditions(policy_conditions, user_attributes, policy_trace)
+        if policy_trace is not None:
+            policy_trace["passed"] = passed
+        if passed:
+            # all conditions are met, stop and return true immediately
+            return True
+    return False
+
+
+# Runs the decision with the policies of the given conditions cache (see PrefetchedConditionsCache)
+def decide_if_authorized(
+        policy_ids: List[ObjectId],
+        user_attributes: Dict[str, Any],
+        conditions_cache: PrefetchedConditionsCache,
+        trace: Optional["DecisionTrace"] = None
+) -> bool:
+    fetch = {SIGNATURES: conditions_cache.get_signatures, CONDITIONS: conditions_cache.get_conditions}
+    steps = decision_steps(policy_ids, user_attributes, trace)
+    try:
+        kind, step_policy_ids = next(steps)
+        while True:
+            kind, step_policy_ids = steps.send(fetch[kind](step_policy_ids))
+    except StopIteration as e:
+        return e.value
@@ -7,3 +7,14 @@ class NotFoundError(Exception):
 class DuplicateKeyError(Exception):
     pass
 
+
+class ForbiddenError(Exception):
+    pass
+
+
+class OverloadedError(Exception):
+    pass
+
+
+class RateLimitedError(Exception):
+    pass
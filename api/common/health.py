@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import os
+import resource
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+from api.common.cache_manager import AttributesCacheLoader, users_cache
+from api.common.configs import HEALTH_CHECK_INTERVAL_SECONDS, HEALTH_CHECK_STALE_SECONDS
+from api.common.tenants import default_tenant
+
+logger = logging.getLogger("health")
+
+
+class BackendStatus:
+    def __init__(self):
+        self.ok = False
+        self.latency_ms: Optional[float] = None
+        self.error: Optional[str] = None
+        self.last_ok_at: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"ok": self.ok, "latency_ms": self.latency_ms, "error": self.error}
+
+
+# The probes (Docker health check, Kubernetes readiness) are called often and by all the workers,
+# so instead of pinging MongoDB and Redis on each probe, the monitor pings them in the background every few seconds
+# (in the executor, so a hanging backend never blocks the event loop) and the probes only read the last results.
+# A backend is considered down when it didn't answer successfully in the last HEALTH_CHECK_STALE_SECONDS
+class BackendsMonitor:
+    def __init__(self, interval_seconds: float = HEALTH_CHECK_INTERVAL_SECONDS, stale_seconds: float = HEALTH_CHECK_STALE_SECONDS):
+        self.interval_seconds = interval_seconds
+        self.stale_seconds = stale_seconds
+        self.backends = {"mongodb": BackendStatus(), "redis": BackendStatus()}
+        self.attributes_cache_loaded = False
+        self.checked_at: Optional[float] = None
+
+    def _check(self, name: str, ping) -> None:
+        status = self.backends[name]
+        started = time.perf_counter()
+        try:
+            ping()
+        except Exception as e:
+            status.error = str(e)
+            logger.warning(f"Health check of {name} failed: {e}")
+        else:
+            status.error = None
+            status.last_ok_at = time.monotonic()
+        status.latency_ms = round((time.perf_counter() - started) * 1000, 3)
+
+    def check_once(self, app: web.Application) -> None:
+        self._check("mongodb", lambda: app["mongodb"].admin.command("ping"))
+        self._check("redis", app["redis"].ping)
+        try:
+            self.attributes_cache_loaded = bool(app["redis"].exists(AttributesCacheLoader.build_key(default_tenant)))
+        except Exception:
+            self.attributes_cache_loaded = False
+        self.checked_at = time.monotonic()
+
+    async def run(self, app: web.Application) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.check_once, app)
+            except Exception:
+                logger.exception("Health check failed")
+            await asyncio.sleep(self.interval_seconds)
+
+    def refresh(self) -> None:
+        now = time.monotonic()
+        for status in self.backends.values():
+            status.ok = status.last_ok_at is not None and now - status.last_ok_at <= self.stale_seconds
+
+    @property
+    def ready(self) -> bool:
+        self.refresh()
+        return all(status.ok for status in self.backends.values())
+
+    def report(self, app: web.Application) -> Dict[str, Any]:
+        ready = self.ready
+        return {
+            "ready": ready,
+            "checked_seconds_ago": round(time.monotonic() - self.checked_at, 3) if self.checked_at is not None else None,
+            "backends": {name: status.to_dict() for name, status in self.backends.items()},
+            "caches": {
+                "attributes_loaded": self.attributes_cache_loaded,
+                "users_local_size": len(users_cache.local_cache)
+            },
+            "worker": {
+                "pid": os.getpid(),
+                "startup_seconds": round(app["ready_at"] - app["started_at"], 3) if "ready_at" in app else None,
+                "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)  # KB on linux
+            },
+            "admission": {
+                "in_flight": app["admission"].in_flight,
+                "queued": app["admission"].queued,
+                "rejected": app["admission"].rejected
+            }
+        }
+
+
+async def init_backends_monitor(app):
+    # This section is called upon running the application (after the connections were initialized)
+    app["monitor"] = BackendsMonitor()
+    task = asyncio.create_task(app["monitor"].run(app))
+    yield
+    # This section will be called when the server terminates
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -1,13 +1,18 @@
+from datetime import datetime, timezone
+
 from bson import ObjectId
 from bson.errors import InvalidId
-from marshmallow import Schema, ValidationError, fields
-from marshmallow.validate import Length, OneOf
+from marshmallow import Schema, ValidationError, fields, validates_schema
+from marshmallow.validate import Length, OneOf, Regexp
+
+from api.common.decision import parse_timestamp
 
 # This file contains all the models of the server
 # It's responsible for parsing and validating the input
 # I chose Marshmallow library because its super fast and its dict to dict
 
 MAX_ID_LENGTH = 256
+MAX_LIST_LENGTH = 10000  # for list values (list attributes, "in" conditions), limiting it for the same reason as MAX_ID_LENGTH
 
 
 class ObjectIdField(fields.Field):
@@ -21,27 +26,50 @@ class ObjectIdField(fields.Field):
             raise ValidationError(f"{attr}={value} is not valid ObjectId")
 
 
+# ISO 8601 time or unix seconds, kept as unix seconds (see parse_timestamp)
+class TimestampField(fields.Field):
+    def _serialize(self, value: float, attr, obj, **kwargs):
+        if value is None:
+            return None
+        return datetime.fromtimestamp(value, timezone.utc).isoformat()
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        if type(value) is bool:
+            raise ValidationError(f"{attr}={value} is not an ISO 8601 time or unix seconds")
+        return parse_timestamp(value)
+
+
 class AttributeNameField(fields.String):
     def __init__(self, **additional_metadata):
-        super().__init__(required=True, validate=Length(max=MAX_ID_LENGTH), **additional_metadata)  # limiting the length to 256 in order to prevent memort crashed (like DDOS attacks)
+        super().__init__(required=True, validate=[
+            Length(max=MAX_ID_LENGTH),  # limiting the length to 256 in order to prevent memort crashed (like DDOS attacks)
+            # MongoDB doesn't accept field paths that start with $, and the cached users use them for their own fields
+            Regexp(r"^(?!\$)", error="Attribute names can't start with $")
+        ], **additional_metadata)
 
 
 class AttributeTypeField(fields.String):
     def __init__(self, **additional_metadata):
-        super().__init__(required=True, validate=OneOf(["boolean", "string", "integer"]), **additional_metadata)
+        super().__init__(required=True, validate=OneOf(["boolean", "string", "integer", "list", "list[string]", "list[integer]", "list[boolean]"]), **additional_metadata)
 
 
 class OperatorField(fields.String):
     def __init__(self, **additional_metadata):
-        super().__init__(required=True, validate=OneOf(["=", ">", "<", "starts_with"]), **additional_metadata)
+        super().__init__(required=True, validate=OneOf(["=", ">", "<", "starts_with", "in", "not_in", "between", "contains", "regex"]), **additional_metadata)
 
 
 class ValueField(fields.Field):
+    @staticmethod
+    def _is_scalar(value) -> bool:
+        return isinstance(value, str) or isinstance(value, bool) or isinstance(value, int)
+
     def _deserialize(self, value, attr, data, **kwargs):
-        if isinstance(value, str) or isinstance(value, bool) or isinstance(value, int):
+        if self._is_scalar(value):
+            return value
+        elif isinstance(value, list) and len(value) <= MAX_LIST_LENGTH and all(self._is_scalar(v) for v in value):
             return value
         else:
-            raise ValidationError('Field should be one of: string, boolean or integer')
+            raise ValidationError(f'Field should be one of: string, boolean, integer or list of them (up to {MAX_LIST_LENGTH} items)')
 
 
 class GetAttributeSchema(Schema):
@@ -69,9 +97,23 @@ class PolicyData(Schema):
     value = ValueField(required=True)
 
 
+class ScheduledConditionsSchema(Schema):
+    at = TimestampField(required=True)
+    conditions = fields.List(fields.Nested(PolicyData()), required=True)
+
+
 class PolicySchema(Schema):
     _id = ObjectIdField(data_key="policy_id", dump_only=True)
     conditions = fields.List(fields.Nested(PolicyData()))
+    # the policy passes only from not_before and until not_after, and its conditions are replaced by the scheduled ones at their times
+    not_before = TimestampField()
+    not_after = TimestampField()
+    schedule = fields.List(fields.Nested(ScheduledConditionsSchema()), validate=Length(max=100))
+
+    @validates_schema
+    def validate_window(self, data, **kwargs):
+        if data.get("not_before") is not None and data.get("not_after") is not None and data["not_before"] >= data["not_after"]:
+            raise ValidationError("not_before should be before not_after")
 
 
 class ResourceSchema(Schema):
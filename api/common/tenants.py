@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import re
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, List, Set, Tuple, TypeVar
+
+from aiohttp import web
+from aiohttp.typedefs import Handler
+from aiohttp.web_middlewares import middleware
+from marshmallow import ValidationError
+from pymongo import MongoClient
+from pymongo.database import Database
+from pymongo.errors import PyMongoError
+
+from api.common.configs import (
+    DB,
+    DEFAULT_TENANT,
+    POLICIES_COL,
+    RESOURCES_COL,
+    TENANT_CACHE_BUDGET_BYTES,
+    TENANT_CACHE_BUDGETS,
+    TENANTS,
+    USERS_COL,
+)
+
+logger = logging.getLogger("tenants")
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+_TENANT_NAME = re.compile(r"^[a-z0-9][a-z0-9_-]{0,31}$")
+
+
+# One deployment serves many tenants, each tenant has its own MongoDB database and its own Redis keys (prefixed by the tenant name),
+# so their data and caches never mix, and each tenant's caches are limited by its own budget (see CacheBudget).
+# The default tenant (requests without X-Tenant-Id) keeps the original database and keys, so single tenant deployments are unchanged
+class Tenant:
+    def __init__(self, name: str):
+        self.name = name
+        self.is_default = name == DEFAULT_TENANT
+        self.db_name = DB if self.is_default else f"{DB}-{name}"
+        self.key_prefix = "" if self.is_default else f"Tenants:{name}:"
+        self.cache_budget_bytes = TENANT_CACHE_BUDGETS.get(name, TENANT_CACHE_BUDGET_BYTES)
+
+    def db(self, app: web.Application) -> Database:
+        return app["mongodb"][self.db_name]
+
+    def key(self, key: str) -> str:
+        return self.key_prefix + key
+
+
+@lru_cache(maxsize=4096)
+def get_tenant(name: str) -> Tenant:
+    if not _TENANT_NAME.match(name):
+        raise ValidationError(f"tenant '{name}' is not valid, it should be lowercase letters, digits, '_' and '-' (up to 32)")
+    if TENANTS is not None and name != DEFAULT_TENANT and name not in TENANTS:
+        raise ValidationError(f"tenant '{name}' is not known")
+    return Tenant(name)
+
+
+default_tenant: Tenant = get_tenant(DEFAULT_TENANT)
+
+
+def tenant_of(request: web.Request) -> Tenant:
+    return request.get("tenant") or default_tenant
+
+
+def tenant_db(request: web.Request) -> Database:
+    return tenant_of(request).db(request.app)
+
+
+def by_tenant(get_many: Callable[[web.Application, Tenant, List[K]], Dict[K, V]], app: web.Application) -> Callable[[List[Tuple[str, K]]], Dict[Tuple[str, K], V]]:
+    """Makes a batch function of (tenant name, key) pairs (see BatchLoader) from a cache loader's get_many"""
+    def batch_fn(keys: List[Tuple[str, K]]) -> Dict[Tuple[str, K], V]:
+        grouped: Dict[str, List[K]] = {}
+        for tenant_name, key in keys:
+            grouped.setdefault(tenant_name, []).append(key)
+        values = {}
+        for tenant_name, tenant_keys in grouped.items():
+            for key, value in get_many(app, get_tenant(tenant_name), tenant_keys).items():
+                values[(tenant_name, key)] = value
+        return values
+    return batch_fn
+
+
+def create_indexes(client: MongoClient, db_name: str) -> None:
+    # The PDP feed reads the changes by their version (see pdp_handlers)
+    try:
+        for col in (USERS_COL, RESOURCES_COL, POLICIES_COL):
+            client[db_name][col].create_index("version")
+    except PyMongoError:
+        logger.exception(f"Failed to create the MongoDB indexes of {db_name}")
+
+
+# The tenants whose indexes were created by this worker
+_initialized_tenants: Set[str] = set()
+
+
+def init_tenant_indexes(request: web.Request) -> None:
+    """
+    Creates the indexes of the request's tenant on its first write in this worker (see write_handler), in the background.
+    Not on its reads, so the requests of unknown tenants (any valid name is accepted without ABAC_TENANTS) don't create databases
+    """
+    tenant = tenant_of(request)
+    # the default tenant's indexes are created on startup
+    if tenant.is_default or tenant.name in _initialized_tenants:
+        return
+    _initialized_tenants.add(tenant.name)
+    # the indexes are only needed by the PDP feed
+    asyncio.get_running_loop().run_in_executor(None, create_indexes, request.app["mongodb"], tenant.db_name)
+
+
+@middleware
+async def tenant_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+    tenant_name = request.headers.get("X-Tenant-Id")
+    if tenant_name:
+        request["tenant"] = get_tenant(tenant_name)
+    return await handler(request)
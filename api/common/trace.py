@@ -0,0 +1,126 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+from aiohttp import web
+from pymongo.collection import Collection
+from pymongo.cursor import Cursor
+from pymongo.database import Database
+from redis.client import Pipeline
+from redis.commands.json import JSON
+
+# This file contains the tracing of the is_authorized decision (/is_authorized?explain=true)
+# Instead of adding tracing code to the cache loaders (and paying for it on every request),
+# the explain mode passes an app whose backends are wrapped, so each MongoDB/Redis call is timed and recorded
+# under the stage (users, resources, signatures, conditions) that is currently running
+
+_BACKENDS = ("mongodb", "redis", "redis_bytes")
+TRACE = "decision_trace"
+# Objects returned from the backends that issue calls by themselves, so they need to be wrapped as well
+_WRAPPED_RESULTS = (Database, Collection, JSON, Pipeline)
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+class DecisionTrace:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: List[Dict[str, Any]] = []
+        self.policies: List[Dict[str, Any]] = []
+        # where each policy's signature/conditions came from, by policy id (see ConditionsCacheLoader._get_many)
+        self.policy_sources: Dict[str, Dict[str, str]] = {}
+        self._current_stage: Optional[Dict[str, Any]] = None
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, Any]]:
+        stage = {"name": name, "backend_calls": []}
+        self._current_stage = stage
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["ms"] = _ms(time.perf_counter() - started)
+            # the data came from MongoDB if any call was made to it, otherwise from the cache
+            backends = {call["backend"] for call in stage["backend_calls"]}
+            if "mongodb" in backends:
+                stage["source"] = "mongodb"
+            elif backends:
+                stage["source"] = "redis"
+            else:
+                stage["source"] = "local"
+            self._current_stage = None
+            self.stages.append(stage)
+
+    def record_backend_call(self, backend: str, command: str, seconds: float) -> None:
+        if self._current_stage is not None:
+            self._current_stage["backend_calls"].append({"backend": backend, "command": command, "ms": _ms(seconds)})
+
+    def record_policy_sources(self, field: str, sources: Dict[Any, str]) -> None:
+        """Records whether each policy's field (signature/conditions) was a cache hit ("redis") or a miss ("mongodb")"""
+        for policy_id, source in sources.items():
+            self.policy_sources.setdefault(str(policy_id), {})[field] = source
+
+    def to_dict(self) -> Dict[str, Any]:
+        for policy in self.policies:
+            policy["sources"] = self.policy_sources.get(policy["policy_id"], {})
+        return {
+            "total_ms": _ms(time.perf_counter() - self.started),
+            "stages": self.stages,
+            "policies": self.policies
+        }
+
+
+class _TracedBackend:
+    def __init__(self, backend: Any, name: str, trace: DecisionTrace):
+        self._backend = backend
+        self._name = name
+        self._trace = trace
+
+    def _wrap(self, value: Any) -> Any:
+        if isinstance(value, _WRAPPED_RESULTS):
+            return _TracedBackend(value, self._name, self._trace)
+        return value
+
+    def __getitem__(self, key: str) -> Any:
+        # client[db_name] and db[collection_name], they don't call the backend
+        return _TracedBackend(self._backend[key], self._name, self._trace)
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._backend, attr)
+        if not callable(value):
+            return self._wrap(value)
+
+        def traced_call(*args, **kwargs):
+            started = time.perf_counter()
+            res = value(*args, **kwargs)
+            if isinstance(res, _WRAPPED_RESULTS):  # no call was made to the backend (e.g. redis.json(), pipeline commands)
+                return self._wrap(res)
+            if isinstance(res, Cursor):
+                res = list(res)  # the documents are fetched only when iterating the cursor
+            self._trace.record_backend_call(self._name, attr, time.perf_counter() - started)
+            return res
+
+        return traced_call
+
+
+# Can be passed instead of the app to anything that reaches the backends through app[...], e.g. the cache loaders.
+# app.get(TRACE) returns the trace, so the loaders can record what isn't visible from the backend calls (None on the real app)
+class TracedApp:
+    def __init__(self, app: web.Application, trace: DecisionTrace):
+        self._app = app
+        self._trace = trace
+
+    def __getitem__(self, key: str) -> Any:
+        if key == TRACE:
+            return self._trace
+        if key in _BACKENDS:
+            return _TracedBackend(self._app[key], key, self._trace)
+        return self._app[key]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -1,16 +1,14 @@
-from typing import Any, Dict, List
+import hmac
+from typing import Any, Dict, List, Optional
+from weakref import WeakKeyDictionary
 
 from aiohttp import web
-from bson import ObjectId
 from marshmallow import ValidationError
+from redis.client import Pipeline
 
-from api.common.cache_manager import ConditionsCacheLoader
-
-_allowed_operators = {
-    "string": {"=", ">", "<", "starts_with"},
-    "boolean": {"="},
-    "integer": {"=", ">", "<"}
-}
+from api.common.configs import ADMIN_TOKEN
+from api.common.exceptions import ForbiddenError
+from redis import Redis
 
 
 def make_error(msg: str) -> Dict[str, Any]:
@@ -31,79 +29,21 @@ def assert_path_param_existence(request: web.Request, path_param: str) -> str:
     return value
 
 
-def validate_values_types(attributes_conf: Dict[str, str], attributes: Dict[str, Any]) -> None:
-    for k, v in attributes.items():
-        if k not in attributes_conf:
-            raise ValidationError(f"attribute '{k}' was not found in global attributes")
-        attribute_type = attributes_conf[k]
-        match attribute_type:
-            case "string":
-                if type(v) is not str:
-                    raise ValidationError(f"attribute '{k}' is not string")
-            case "integer":
-                if type(v) is not int:
-                    raise ValidationError(f"attribute '{k}' is not integer")
-            case "boolean":
-                if type(v) is not bool:
-                    raise ValidationError(f"attribute '{k}' is not boolean")
-            case _:
-                raise ValidationError(f"attribute '{k}' of type '{attribute_type}' is not supported")
-
-
-# This function validates that the conditions are valid for the attribute's types
-# example if there is a condition on boolean attribute, then it can't use operator 'starts_with' on it
-def validate_conditions_types(attributes_conf: Dict[str, str], conditions: List[Dict[str, Any]]) -> None:
-    for cond in conditions:
-        k = cond["attribute_name"]
-        v = cond["value"]
-        if k not in attributes_conf:
-            raise ValidationError(f"attribute '{k}' was not found in global attributes")
-        attribute_type = attributes_conf[k]
-
-        if cond["operator"] not in _allowed_operators[attribute_type]:
-            raise ValidationError(f'Cant apply operator "{cond["operator"]}" on {attribute_type}')
-
-        match attribute_type:
-            case "string":
-                if type(v) is not str:
-                    raise ValidationError(f"attribute '{k}' is not string")
-            case "integer":
-                if type(v) is not int:
-                    raise ValidationError(f"attribute '{k}' is not integer")
-            case "boolean":
-                if type(v) is not bool:
-                    raise ValidationError(f"attribute '{k}' is not boolean")
-
+def assert_admin(request: web.Request) -> None:
+    token = request.headers.get("X-Admin-Token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+        raise ForbiddenError("This operation requires a valid X-Admin-Token header")
 
-# This function applies the condition on the attributes and return True/False accordingly
-def apply(condition: Dict[str, Any], attributes: Dict[str, Any]) -> bool:
-    if condition["attribute_name"] not in attributes:
-        return False
-    match condition["operator"]:
-        case "=":
-            return condition["value"] == attributes[condition["attribute_name"]]
-        case ">":
-            return condition["value"] < attributes[condition["attribute_name"]]
-        case "<":
-            return condition["value"] > attributes[condition["attribute_name"]]
-        case "starts_with":
-            return attributes[condition["attribute_name"]].startswith(condition["value"])
 
+# A Redis Lua script, registered once for each Redis client (register_script builds and hashes a new script on every call),
+# and called with EVALSHA, right away or in the given pipeline of the same client
+class LuaScript:
+    def __init__(self, source: str):
+        self.source = source
+        self._registered: WeakKeyDictionary = WeakKeyDictionary()
 
-# Moved the logic into one function here in order to be able to write a unit test for it
-def decide_if_authorized(
-        policy_ids: List[ObjectId],
-        user_attributes: Dict[str, Any],
-        conditions_cache: ConditionsCacheLoader,
-        request
-) -> bool:
-    for policy_id in policy_ids:
-        # Get the policy conditions from cache
-        for cond in conditions_cache.get(request, policy_id):
-            if not apply(cond, user_attributes):
-                break
-        else:
-            # all conditions are met, stop and return true immediately
-            return True
-    else:
-        return False
+    def __call__(self, redis: Redis, keys: List[Any], args: List[Any], pipe: Optional[Pipeline] = None) -> Any:
+        script = self._registered.get(redis)
+        if script is None:
+            script = self._registered[redis] = redis.register_script(self.source)
+        return script(keys=keys, args=args, client=pipe)
@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
+
+from aiohttp import web
+from pymongo.database import Database
+from pymongo.errors import DuplicateKeyError
+
+from api.common.configs import COUNTERS_COL, VERSION_PENDING_TIMEOUT_SECONDS
+from api.common.tenants import tenant_db
+
+# Every write to users, resources and policies is stamped with a global increasing version.
+# It lets the PDP feed return the changes since a version, and it's returned to the caller
+# as a consistency token, so an embedded PDP can be asked to be at least as fresh as a write (see api.pdp).
+# A write takes its version before it's committed, so a write with a lower version can become visible after a write
+# with a higher one. So the counter also holds the versions that were taken and not committed yet ("pending"),
+# and the feed only goes up to the committed version: the highest version that no pending version is below of
+VERSIONS_COUNTER = "versions"
+
+
+def _live_pending(counter: Dict[str, Any]) -> Dict[str, float]:
+    # a version of a writer that crashed is pending forever, so it's ignored after a while
+    expired_at = time.time() - VERSION_PENDING_TIMEOUT_SECONDS
+    return {version: taken_at for version, taken_at in counter.get("pending", {}).items() if taken_at > expired_at}
+
+
+def _take_version(request: web.Request) -> int:
+    counters = tenant_db(request)[COUNTERS_COL]
+    while True:
+        counter = counters.find_one({"_id": VERSIONS_COUNTER}) or {"seq": 0}
+        version = counter["seq"] + 1
+        # the version and its pending mark are written in one update, conditioned on the version that was read
+        # (so a reader never sees a taken version that isn't pending yet), and retried when another writer took it first
+        update: Dict[str, Any] = {"$set": {"seq": version, f"pending.{version}": time.time()}}
+        expired = counter.get("pending", {}).keys() - _live_pending(counter).keys()
+        if expired:
+            update["$unset"] = {f"pending.{v}": "" for v in expired}
+        try:
+            res = counters.update_one({"_id": VERSIONS_COUNTER, "seq": counter["seq"]}, update, upsert=counter["seq"] == 0)
+        except DuplicateKeyError:  # another writer created the counter
+            continue
+        if res.matched_count or res.upserted_id is not None:
+            return version
+
+
+@contextmanager
+def new_version(request: web.Request) -> Iterator[int]:
+    """The version of a write, it's pending until the write is done (committed or failed)"""
+    version = _take_version(request)
+    try:
+        yield version
+    finally:
+        tenant_db(request)[COUNTERS_COL].update_one({"_id": VERSIONS_COUNTER}, {"$unset": {f"pending.{version}": ""}})
+
+
+def committed_version(request: web.Request) -> int:
+    """All the writes up to this version are committed"""
+    return db_committed_version(tenant_db(request))
+
+
+def db_committed_version(db: Database) -> int:
+    """committed_version of a tenant's database, for the callers that have no request (see ChangeLog.relay)"""
+    counter = db[COUNTERS_COL].find_one({"_id": VERSIONS_COUNTER})
+    if not counter:
+        return 0
+    pending = _live_pending(counter)
+    return min(int(version) for version in pending) - 1 if pending else counter["seq"]
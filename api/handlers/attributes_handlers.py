@@ -1,10 +1,14 @@
 from aiohttp import web
 
+from api.common.admission import read_handler, write_handler
 from api.common.cache_manager import attributes_cache
-from api.common.configs import ATTRIBUTES_COL, DB
+from api.common.changes import INSERT, change_log
+from api.common.configs import ATTRIBUTES_COL
 from api.common.exceptions import NotFoundError
 from api.common.models import CreateAttributeSchema, GetAttributeSchema
+from api.common.tenants import tenant_db
 from api.common.utils import assert_path_param_existence
+from api.common.versions import new_version
 
 routes = web.RouteTableDef()
 get_schema = GetAttributeSchema()
@@ -12,7 +16,8 @@ post_schema = CreateAttributeSchema()
 
 
 @routes.get('/attributes/{attribute_name}', allow_head=False)
-async def get_attribute(request: web.Request):
+@read_handler
+def get_attribute(request: web.Request):
     """
         ---
         description: return attribute details
@@ -40,14 +45,15 @@ async def get_attribute(request: web.Request):
                                     type: string
         """
     attribute_name = assert_path_param_existence(request, "attribute_name")
-    doc = request.app["mongodb"][DB][ATTRIBUTES_COL].find_one({"_id": attribute_name})
+    doc = tenant_db(request)[ATTRIBUTES_COL].find_one({"_id": attribute_name})
     if not doc:
         raise NotFoundError(f"attribute: '{attribute_name}' was not found")
     return web.json_response(get_schema.dump(doc))
 
 
 @routes.post('/attributes')
-async def create_attribute(request: web.Request):
+@write_handler
+def create_attribute(request: web.Request, body: str):
     """
     ---
     description: Create attribute.
@@ -64,7 +70,7 @@ async def create_attribute(request: web.Request):
                             type: string
                         attribute_type:
                             type: string
-                            enum: ["string", "boolean", "integer"]
+                            enum: ["string", "boolean", "integer", "list", "list[string]", "list[integer]", "list[boolean]"]
     responses:
         200:
             description: successful operation.
@@ -73,15 +79,19 @@ async def create_attribute(request: web.Request):
                     schema:
                         type: object
     """
-    json_body = await request.json(loads=post_schema.loads)
+    json_body = post_schema.loads(body)
 
     attribute_name = json_body.pop("attribute_name")
-    doc = {
-        "_id": attribute_name,  # using the _id as unique index, since it's automatically created by mongo
-        "attribute_type": json_body["attribute_type"]
-    }
-    request.app["mongodb"][DB][ATTRIBUTES_COL].insert_one(doc)  # So in case of duplicate _id it will throw pymongo.errors.DuplicateKeyError
+    with new_version(request) as version:
+        doc = {
+            "_id": attribute_name,  # using the _id as unique index, since it's automatically created by mongo
+            "attribute_type": json_body["attribute_type"],
+            "version": version
+        }
+        tenant_db(request)[ATTRIBUTES_COL].insert_one(doc)  # So in case of duplicate _id it will throw pymongo.errors.DuplicateKeyError
+        change_log.record(request, "attribute", attribute_name, version, INSERT, {"attribute_type": json_body["attribute_type"]})
 
     # After modifying the global attributes, the attribute's cache needs to be cleared
     attributes_cache.invalidate(request)
+    change_log.publish(request)
     return web.json_response({attribute_name: json_body["attribute_type"]})
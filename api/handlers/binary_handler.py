@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from functools import partial
+from typing import Set
+
+from aiohttp import web
+from bson import ObjectId
+from marshmallow import ValidationError
+
+from api.common.admission import AUTHORIZATION, AdmissionController
+from api.common.binary_protocol import (
+    ALLOWED,
+    BAD_REQUEST,
+    DENIED,
+    FRAME_HEADER_SIZE,
+    INTERNAL_ERROR,
+    NOT_FOUND,
+    OVERLOADED,
+    TENANT,
+    ProtocolError,
+    decode_request,
+    decode_request_id,
+    encode_error,
+    encode_response,
+    read_frame_length,
+)
+from api.common.configs import BINARY_MAX_IN_FLIGHT_PER_CONNECTION, BINARY_PORT
+from api.common.exceptions import NotFoundError, OverloadedError
+from api.common.tenants import Tenant, default_tenant, get_tenant
+from api.handlers.is_authorized_handler import authorize
+
+logger = logging.getLogger("binary")
+
+
+# Authorization checks over the binary protocol (see binary_protocol), for internal callers that check at a high rate.
+# It skips the HTTP parsing, the query string and the JSON, and the ids are sent as raw 12 bytes,
+# the decision itself is the same as /is_authorized (authorize, with the worker's batch loaders and admission control)
+async def _check(app: web.Application, tenant: Tenant, user_id: ObjectId, resource_id: ObjectId) -> int:
+    try:
+        return ALLOWED if await authorize(app, tenant, user_id, resource_id) else DENIED
+    except NotFoundError:
+        return NOT_FOUND
+
+
+async def _handle_request(app: web.Application, tenant: Tenant, writer: asyncio.StreamWriter, request_id: int, body: bytes) -> None:
+    try:
+        message_type, _, pairs = decode_request(body)
+    except ProtocolError as e:
+        writer.write(encode_error(request_id, BAD_REQUEST, str(e)))
+        return
+
+    # a batch takes one admission slot, like a single /is_authorized request
+    controller: AdmissionController = app["admission"]
+    try:
+        await controller.acquire(AUTHORIZATION)
+    except OverloadedError as e:
+        writer.write(encode_error(request_id, OVERLOADED, str(e)))
+        return
+    try:
+        statuses = await asyncio.gather(*(_check(app, tenant, user_id, resource_id) for user_id, resource_id in pairs))
+    except Exception as e:
+        logger.exception("Error while handling a binary request")
+        writer.write(encode_error(request_id, INTERNAL_ERROR, str(e)))
+        return
+    finally:
+        controller.release(AUTHORIZATION)
+    writer.write(encode_response(message_type, request_id, statuses))
+
+
+def _switch_tenant(writer: asyncio.StreamWriter, request_id: int, body: bytes, tenant: Tenant) -> Tenant:
+    try:
+        _, request_id, tenant_name = decode_request(body)
+        tenant = get_tenant(tenant_name)
+    except (ProtocolError, ValidationError) as e:
+        writer.write(encode_error(request_id, BAD_REQUEST, str(e)))
+        return tenant
+    writer.write(encode_response(TENANT, request_id, []))
+    return tenant
+
+
+async def handle_connection(app: web.Application, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    # The requests of a connection are handled concurrently, up to BINARY_MAX_IN_FLIGHT_PER_CONNECTION,
+    # after that the connection isn't read until some of them finish, so a fast client is slowed down by TCP
+    in_flight = asyncio.Semaphore(BINARY_MAX_IN_FLIGHT_PER_CONNECTION)
+    tasks: Set[asyncio.Task] = set()
+    tenant = default_tenant
+
+    def done(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        in_flight.release()
+
+    try:
+        while True:
+            length = read_frame_length(await reader.readexactly(FRAME_HEADER_SIZE))
+            body = await reader.readexactly(length)
+            request_id = decode_request_id(body)
+            if body[:1] == bytes((TENANT,)):
+                # handled right away, so it applies to all the following requests of the connection
+                tenant = _switch_tenant(writer, request_id, body, tenant)
+                continue
+            await in_flight.acquire()
+            task = asyncio.create_task(_handle_request(app, tenant, writer, request_id, body))
+            tasks.add(task)
+            task.add_done_callback(done)
+            await writer.drain()
+    except asyncio.IncompleteReadError:
+        pass  # the client closed the connection
+    except ProtocolError as e:
+        # the frames can't be parsed anymore (or the frame has no request id to answer to), so the connection is closed
+        writer.write(encode_error(0, BAD_REQUEST, str(e)))
+    except ConnectionError:
+        pass
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        writer.close()
+
+
+async def init_binary_server(app):
+    # This section is called upon running the application (after the batch loaders were initialized)
+    port = app.get("binary_port", BINARY_PORT)
+    if not port:
+        yield
+        return
+    server = await asyncio.start_server(partial(handle_connection, app), port=port, reuse_port=True)
+    logger.info(f"Binary protocol listening on port {port}")
+    yield
+    # This section will be called when the server terminates
+    server.close()
+    await server.wait_closed()
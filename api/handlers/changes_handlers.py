@@ -0,0 +1,112 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from marshmallow import ValidationError
+
+from api.common.changes import change_log
+from api.common.configs import (
+    CHANGES_MAX_BATCH_SIZE,
+    CHANGES_MAX_LONG_POLLS,
+    CHANGES_MAX_WAIT_SECONDS,
+    CHANGES_RELAY_INTERVAL_SECONDS,
+)
+from api.common.exceptions import OverloadedError
+from api.common.tenants import default_tenant, get_tenant, tenant_of
+
+routes = web.RouteTableDef()
+
+
+def _number_query_param(request: web.Request, query_param: str, default: float, max_value: float) -> float:
+    value = request.rel_url.query.get(query_param)
+    if not value:
+        return default
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValidationError(f"query param {query_param}={value} is not a number")
+    if not 0 <= number <= max_value:
+        raise ValidationError(f"query param {query_param} should be between 0 and {max_value}")
+    return number
+
+
+@routes.get('/changes', allow_head=False)
+async def get_changes(request: web.Request):
+    """
+    ---
+    description: Long poll of the changes log. Returns the changes after the `since` change id,
+        or waits up to `wait` seconds for new changes when there are none.
+    tags:
+    - Changes
+    parameters:
+    - in: query
+      name: since
+      description: the `next` of the previous response, "0-0" (the default) reads from the start of the log
+      schema:
+        type: string
+    - in: query
+      name: limit
+      schema:
+        type: integer
+    - in: query
+      name: wait
+      description: seconds to wait for changes, 0 returns right away
+      schema:
+        type: number
+    produces:
+    - application/json
+    responses:
+        200:
+            description: successful operation. Returns the changes, the `next` change id to poll from,
+                and `truncated` when changes after `since` were already trimmed from the log (the replica should be reloaded)
+    """
+    since = request.rel_url.query.get("since") or "0-0"
+    count = int(_number_query_param(request, "limit", CHANGES_MAX_BATCH_SIZE, CHANGES_MAX_BATCH_SIZE)) or 1
+    wait_seconds = _number_query_param(request, "wait", CHANGES_MAX_WAIT_SECONDS, CHANGES_MAX_WAIT_SECONDS)
+    # redis-py doesn't block at all when block is None, and blocks forever when it's 0
+    block_ms = int(wait_seconds * 1000) or None
+
+    # a thread for each long poll, instead of queueing the polls behind the ones that are waiting.
+    # The slot is released when the read returns, even when the client stopped waiting for it (the thread is still busy)
+    long_polls: asyncio.Semaphore = request.app["changes_long_polls"]
+    if long_polls.locked():
+        raise OverloadedError(f"Server is overloaded, more than {CHANGES_MAX_LONG_POLLS} changes long polls")
+    await long_polls.acquire()  # free, doesn't wait
+    read = asyncio.get_running_loop().run_in_executor(
+        request.app["changes_executor"], change_log.read, request.app["redis"], tenant_of(request), since, count, block_ms
+    )
+    read.add_done_callback(lambda _: long_polls.release())
+    result = await asyncio.shield(read)
+    return web.json_response(result)
+
+
+async def init_changes_executor(app):
+    # This section is called upon running the application
+    app["changes_executor"] = ThreadPoolExecutor(max_workers=CHANGES_MAX_LONG_POLLS, thread_name_prefix="changes")
+    app["changes_long_polls"] = asyncio.Semaphore(CHANGES_MAX_LONG_POLLS)
+    yield
+    # This section will be called when the server terminates
+    app["changes_executor"].shutdown(wait=False, cancel_futures=True)
+
+
+async def relay_changes(app) -> None:
+    """Retries relaying the changes of the tenants whose changes were left in the outbox (see ChangeLog)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        for tenant_name in list(change_log.unrelayed):
+            await loop.run_in_executor(None, change_log.try_relay, app, get_tenant(tenant_name))
+        await asyncio.sleep(CHANGES_RELAY_INTERVAL_SECONDS)
+
+
+async def init_changes_relay(app):
+    # This section is called upon running the application (after the connections were initialized)
+    # The changes that a worker that stopped didn't relay are relayed on startup, or by the tenant's next write
+    change_log.unrelayed.add(default_tenant.name)
+    task = asyncio.create_task(relay_changes(app))
+    yield
+    # This section will be called when the server terminates
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
@@ -1,13 +1,92 @@
+import asyncio
+from typing import Any, Dict, List
+
 from aiohttp import web
 from bson import ObjectId
 
-from api.common.cache_manager import conditions_cache
-from api.common.configs import DB, RESOURCES_COL, USERS_COL
+from api.common.cache_manager import conditions_cache, resources_cache, users_cache
+from api.common.decision import CONDITIONS, SIGNATURES, DecisionSteps, decision_steps
 from api.common.exceptions import NotFoundError
-from api.common.utils import assert_query_param_existence, decide_if_authorized
+from api.common.tenants import Tenant, tenant_of
+from api.common.utils import assert_admin, assert_query_param_existence
 
 routes = web.RouteTableDef()
 
+USERS = "users"
+RESOURCES = "resources"
+
+
+# The reads go through the worker's batch loaders (see BatchLoader and init_batch_loaders),
+# so concurrent requests for the same user/resource/policies share one backend read
+class _BatchedReads:
+    def __init__(self, app: web.Application, tenant: Tenant):
+        self.app = app
+        self.tenant = tenant
+
+    async def load(self, name: str, ids: List[ObjectId]) -> Dict[ObjectId, Any]:
+        """Returns only the entities that were found"""
+        res = await self.app[f"{name}_loader"].load_many([(self.tenant.name, entity_id) for entity_id in ids])
+        return {entity_id: value for entity_id, value in zip(ids, res) if value is not None}
+
+
+# The reads of ?explain=true, the same cache loaders are called directly (without batching with other requests)
+# on a traced app, so each stage and every MongoDB/Redis call it made is recorded
+class _TracedReads:
+    def __init__(self, app: web.Application, tenant: Tenant, trace):
+        from api.common.trace import TracedApp
+
+        self.app = TracedApp(app, trace)
+        self.tenant = tenant
+        self.trace = trace
+        self._get_many = {
+            USERS: users_cache.get_many,
+            RESOURCES: resources_cache.get_many,
+            SIGNATURES: conditions_cache.get_signatures_many,
+            CONDITIONS: conditions_cache.get_conditions_many
+        }
+
+    async def load(self, name: str, ids: List[ObjectId]) -> Dict[ObjectId, Any]:
+        # the loaders block, so they run in the executor like the batched reads (the stages run one at a time)
+        with self.trace.stage(name):
+            return await asyncio.get_running_loop().run_in_executor(None, self._get_many[name], self.app, self.tenant, ids)
+
+
+async def _load_one(reads, name: str, entity_id: ObjectId) -> Any:
+    res = await reads.load(name, [entity_id])
+    if entity_id not in res:
+        raise NotFoundError(f"{name[:-1]}: '{entity_id}' was not found")
+    return res[entity_id]
+
+
+async def _run_decision(reads, steps: DecisionSteps) -> bool:
+    try:
+        name, policy_ids = next(steps)
+        while True:
+            res = await reads.load(name, policy_ids)
+            for policy_id in policy_ids:
+                if policy_id not in res:
+                    raise NotFoundError(f"policy: '{policy_id}' was not found")
+            name, policy_ids = steps.send(res)
+    except StopIteration as e:
+        return e.value
+
+
+async def authorize(app: web.Application, tenant: Tenant, user_id: ObjectId, resource_id: ObjectId, trace=None) -> bool:
+    reads = _BatchedReads(app, tenant) if trace is None else _TracedReads(app, tenant, trace)
+    # Get User attributes and Resource policies ids from cache
+    # There are up to 10 changes per second on users, so instead of invalidating the user on each change,
+    # the users handlers apply the changed attribute on the cached user (see UserAttributesCacheLoader).
+    # The policy ids are cached as packed ObjectIds, and updated by the resources handlers on each write
+    if trace is None:
+        user_attributes, policy_ids = await asyncio.gather(_load_one(reads, USERS, user_id), _load_one(reads, RESOURCES, resource_id))
+    else:  # one stage at a time
+        user_attributes = await _load_one(reads, USERS, user_id)
+        policy_ids = await _load_one(reads, RESOURCES, resource_id)
+
+    # The signatures of all the resource's policies are read in one batch,
+    # and then the conditions of the policies that passed them in another batch (see decision_steps)
+    return await _run_decision(reads, decision_steps(policy_ids, user_attributes, trace))
+
 
 @routes.get('/is_authorized')
 async def is_authorized(request: web.Request):
@@ -17,24 +96,19 @@ async def is_authorized(request: web.Request):
     user_id = ObjectId(user_id)
     resource_id = ObjectId(resource_id)
 
-    # Get User attributes from DB
-    # Decided here not to save the users data in Redis cache because there will be up to 10 changes per second,
-    # and it won't be efficient to clear & populate the cache this many times per second, it just will be overhead.
-    # so the system can tolerate querying by _id (its indexed) and there is only about 1000 users in the database
-    user_doc = request.app["mongodb"][DB][USERS_COL].find_one({"_id": user_id})
-    if not user_doc:
-        raise NotFoundError(f"user: '{user_id}' was not found")
-    user_attributes = user_doc["attributes"]
-
-    # Get Resource policies ids from DB
-    # Also here no need to save the resource in redis, since it will be a small document to be fetched (list of ids)
-    resource_doc = request.app["mongodb"][DB][RESOURCES_COL].find_one({"_id": resource_id})
-    if not resource_doc:
-        raise NotFoundError(f"resource: '{resource_id}' was not found")
-    policy_ids = resource_doc["policy_ids"]
-
-    # Note: MongoDB knows to cache the most recently used data set in RAM, so in case we are getting a lot of requests per second,
-    # the results will be fetched from RAM memory (I am mentioning this because of querying users and resources colelctions)
-
-    is_auth = decide_if_authorized(policy_ids, user_attributes, conditions_cache, request)
+    if request.rel_url.query.get("explain") == "true":
+        assert_admin(request)
+        return web.json_response(await _explain(request, user_id, resource_id))
+
+    is_auth = await authorize(request.app, tenant_of(request), user_id, resource_id)
     return web.json_response({"is_authorized": is_auth})
+
+
+# Same flow as is_authorized, but every backend call, stage and condition evaluation is recorded
+# The tracing is admin only, so it's imported on the first explain and not by every worker on startup
+async def _explain(request: web.Request, user_id: ObjectId, resource_id: ObjectId) -> dict:
+    from api.common.trace import DecisionTrace
+
+    trace = DecisionTrace()
+    is_auth = await authorize(request.app, tenant_of(request), user_id, resource_id, trace)
+    return {"is_authorized": is_auth, "explain": trace.to_dict()}
@@ -0,0 +1,95 @@
+from typing import Any, Dict
+
+from aiohttp import web
+from bson import ObjectId
+from marshmallow import ValidationError
+
+from api.common.admission import read_handler
+from api.common.configs import (
+    FEED_MAX_PAGE_SIZE,
+    POLICIES_COL,
+    RESOURCES_COL,
+    USERS_COL,
+)
+from api.common.models import PolicySchema, ResourceSchema, UserSchema
+from api.common.tenants import tenant_db
+from api.common.versions import committed_version
+
+# These endpoints feed the embeddable policy decision points (see api.pdp):
+# a snapshot of each collection (paginated by _id), and then the changes since a version (paginated by version).
+# They are a few MongoDB reads each, so they run in the reads executor (see read_handler)
+routes = web.RouteTableDef()
+_entities = {
+    "users": (USERS_COL, UserSchema()),
+    "resources": (RESOURCES_COL, ResourceSchema()),
+    "policies": (POLICIES_COL, PolicySchema()),
+}
+
+
+def _int_query_param(request: web.Request, query_param: str, default: int) -> int:
+    value = request.rel_url.query.get(query_param)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValidationError(f"query param {query_param}={value} is not integer")
+
+
+def _page_size(request: web.Request) -> int:
+    limit = _int_query_param(request, "limit", FEED_MAX_PAGE_SIZE)
+    if not 0 < limit <= FEED_MAX_PAGE_SIZE:
+        raise ValidationError(f"limit should be between 1 and {FEED_MAX_PAGE_SIZE}")
+    return limit
+
+
+def _dump(entity: str, doc: Dict[str, Any]) -> Dict[str, Any]:
+    # documents that were written before the versions were added have no version
+    return {**_entities[entity][1].dump(doc), "version": doc.get("version", 0)}
+
+
+@routes.get('/pdp/snapshot/{entity}')
+@read_handler
+def get_snapshot(request: web.Request):
+    entity = request.match_info["entity"]
+    if entity not in _entities:
+        raise ValidationError(f"entity should be one of: {', '.join(_entities)}")
+    limit = _page_size(request)
+    after = request.rel_url.query.get("after")
+
+    # Reading the committed version before the page, so any change that is not in the page comes later from the feed
+    token = committed_version(request)
+    query = {"_id": {"$gt": ObjectId(after)}} if after else {}
+    docs = list(tenant_db(request)[_entities[entity][0]].find(query).sort("_id", 1).limit(limit))
+    return web.json_response({
+        "token": token,
+        "items": [_dump(entity, doc) for doc in docs],
+        "next": str(docs[-1]["_id"]) if len(docs) == limit else None
+    })
+
+
+@routes.get('/pdp/feed')
+@read_handler
+def get_feed(request: web.Request):
+    since = _int_query_param(request, "since", 0)
+    limit = _page_size(request)
+
+    # Only the committed changes, a version above it might still be followed by a lower one (see new_version)
+    committed = committed_version(request)
+    pages = {
+        entity: list(tenant_db(request)[col].find({"version": {"$gt": since, "$lte": committed}}).sort("version", 1).limit(limit))
+        for entity, (col, _) in _entities.items()
+    }
+    # When a collection has more changes than the page, the page ends at its last version,
+    # and the changes of the other collections after that version are left for the next page
+    full_pages_ends = [docs[-1]["version"] for docs in pages.values() if len(docs) == limit]
+    if full_pages_ends:
+        token = min(full_pages_ends)
+    else:
+        token = max(since, committed)
+
+    return web.json_response({
+        "token": token,
+        "complete": not full_pages_ends,
+        **{entity: [_dump(entity, doc) for doc in docs if doc["version"] <= token] for entity, docs in pages.items()}
+    })
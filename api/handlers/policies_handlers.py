@@ -4,60 +4,98 @@ from aiohttp import web
 from bson import ObjectId
 from pymongo.results import InsertOneResult, UpdateResult
 
+from api.common.admission import read_handler, write_handler
 from api.common.cache_manager import attributes_cache, conditions_cache
-from api.common.configs import DB, POLICIES_COL
+from api.common.changes import INSERT, UPDATE, change_log
+from api.common.configs import POLICIES_COL
+from api.common.decision import build_policy_signature, validate_conditions_types
 from api.common.exceptions import NotFoundError
 from api.common.models import PolicySchema
-from api.common.utils import assert_path_param_existence, validate_conditions_types
+from api.common.tenants import tenant_db
+from api.common.utils import assert_path_param_existence
+from api.common.versions import new_version
 
 routes = web.RouteTableDef()
 schema = PolicySchema()
 
 
+_TIMING_FIELDS = ("not_before", "not_after", "schedule")
+
+
 # Doing the validations upon the updates to DB,
-# so when we read the data (is_authorized endpoint) we are sure that it's ok and no validation needed there
-def _validate_conditions(request, conditions: List[Dict[str, Any]]) -> None:
+# so when we read the data (is_authorized endpoint) we are sure that it's ok and no validation needed there.
+# Returns the policy signature, which is saved next to the conditions
+def _validate_conditions(request, json_body: Dict[str, Any]) -> Dict[str, Any]:
     attrs_docs = attributes_cache.get(request)
-    validate_conditions_types(attrs_docs, conditions)
+    validate_conditions_types(attrs_docs, json_body["conditions"])
+    for scheduled in json_body.get("schedule", []):
+        validate_conditions_types(attrs_docs, scheduled["conditions"])
+    return build_policy_signature(json_body["conditions"])
+
+
+# The policy's window and scheduled conditions, the missing ones are not set (or removed by PUT)
+def _timing(json_body: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: json_body[k] for k in _TIMING_FIELDS if json_body.get(k) is not None}
 
 
 @routes.post('/policies')
-async def create_policy(request: web.Request):
-    json_body = await request.json(loads=schema.loads)
-    _validate_conditions(request, json_body["conditions"])
+@write_handler
+def create_policy(request: web.Request, body: str):
+    json_body = schema.loads(body)
+    signature = _validate_conditions(request, json_body)
+    timing = _timing(json_body)
 
-    doc = {
-        "conditions": json_body["conditions"]
-    }
-    res: InsertOneResult = request.app["mongodb"][DB][POLICIES_COL].insert_one(doc)
-    return web.json_response({"policy_id": str(res.inserted_id)})
+    with new_version(request) as version:
+        doc = {
+            "conditions": json_body["conditions"],
+            "signature": signature,
+            **timing,
+            "version": version
+        }
+        res: InsertOneResult = tenant_db(request)[POLICIES_COL].insert_one(doc)
+        change_log.record(request, "policy", res.inserted_id, version, INSERT, {"conditions": json_body["conditions"], **timing})
+    change_log.publish(request)
+    return web.json_response({"policy_id": str(res.inserted_id), "consistency_token": version})
 
 
 @routes.get('/policies/{policy_id}')
-async def get_policy(request: web.Request):
+@read_handler
+def get_policy(request: web.Request):
     policy_id = assert_path_param_existence(request, "policy_id")
-    doc = request.app["mongodb"][DB][POLICIES_COL].find_one({"_id": ObjectId(policy_id)})
+    doc = tenant_db(request)[POLICIES_COL].find_one({"_id": ObjectId(policy_id)})
     if not doc:
         raise NotFoundError(f"policy: '{policy_id}' was not found")
     return web.json_response(schema.dump(doc))
 
 
 @routes.put('/policies/{policy_id}')
-async def override_policy_conditions(request: web.Request):
+@write_handler
+def override_policy_conditions(request: web.Request, body: str):
     policy_id = assert_path_param_existence(request, "policy_id")
     policy_id = ObjectId(policy_id)
-    json_body = await request.json(loads=schema.loads)
-    _validate_conditions(request, json_body["conditions"])
+    json_body = schema.loads(body)
+    signature = _validate_conditions(request, json_body)
+    timing = _timing(json_body)
+    unset_fields = [k for k in _TIMING_FIELDS if k not in timing]
 
-    res: UpdateResult = request.app["mongodb"][DB][POLICIES_COL].update_one(
-        filter={"_id": policy_id},
-        update={
+    with new_version(request) as version:
+        update = {
             "$set": {
-                "conditions": json_body["conditions"]
+                "conditions": json_body["conditions"],
+                "signature": signature,
+                **timing,
+                "version": version
             }
         }
-    )
+        if unset_fields:
+            update["$unset"] = {k: "" for k in unset_fields}
+        res: UpdateResult = tenant_db(request)[POLICIES_COL].update_one(filter={"_id": policy_id}, update=update)
+        # Nothing was written, so there is nothing to invalidate, no change to record and no consistency token to return
+        if not res.matched_count:
+            raise NotFoundError(f"policy: '{policy_id}' was not found")
+        change_log.record(request, "policy", policy_id, version, UPDATE, {"conditions": json_body["conditions"], **timing}, unset_fields)
     # After modifying the policy conditions, the policy's conditions cache needs to be cleared
     conditions_cache.invalidate(request, policy_id)
-    return web.json_response({"policy_id": str(policy_id)})
+    change_log.publish(request)
+    return web.json_response({"policy_id": str(policy_id), "consistency_token": version})
 
@@ -3,12 +3,18 @@ from typing import List
 from aiohttp import web
 from bson import ObjectId
 from marshmallow import ValidationError
-from pymongo.results import InsertOneResult, UpdateResult
+from pymongo import ReturnDocument
+from pymongo.results import InsertOneResult
 
-from api.common.configs import DB, POLICIES_COL, RESOURCES_COL
+from api.common.admission import read_handler, write_handler
+from api.common.cache_manager import resources_cache
+from api.common.changes import INSERT, UPDATE, change_log
+from api.common.configs import POLICIES_COL, RESOURCES_COL
 from api.common.exceptions import NotFoundError
 from api.common.models import ResourceSchema
+from api.common.tenants import tenant_db
 from api.common.utils import assert_path_param_existence
+from api.common.versions import new_version
 
 routes = web.RouteTableDef()
 schema = ResourceSchema()
@@ -16,7 +22,7 @@ schema = ResourceSchema()
 
 # Check if policy ids exists in the DB
 def _validate_policy_ids(request, policy_ids: List[ObjectId]) -> None:
-    policies_count = request.app["mongodb"][DB][POLICIES_COL].count_documents({
+    policies_count = tenant_db(request)[POLICIES_COL].count_documents({
         "_id": {"$in": policy_ids}
     })
     if policies_count != len(policy_ids):
@@ -24,22 +30,31 @@ def _validate_policy_ids(request, policy_ids: List[ObjectId]) -> None:
 
 
 @routes.post('/resources')
-async def create_resource(request: web.Request):
-    json_body = await request.json(loads=schema.loads)
+@write_handler
+def create_resource(request: web.Request, body: str):
+    json_body = schema.loads(body)
     _validate_policy_ids(request, json_body["policy_ids"])
 
-    doc = {
-        "policy_ids": json_body["policy_ids"]
-    }
-    res: InsertOneResult = request.app["mongodb"][DB][RESOURCES_COL].insert_one(doc)
-    return web.json_response({"resource_id": str(res.inserted_id)})
+    with new_version(request) as version:
+        doc = {
+            "policy_ids": json_body["policy_ids"],
+            "revision": 1,
+            "version": version
+        }
+        res: InsertOneResult = tenant_db(request)[RESOURCES_COL].insert_one(doc)
+        change_log.record(request, "resource", res.inserted_id, version, INSERT, {"policy_ids": json_body["policy_ids"]})
+    # Write through, since a new resource is likely to be checked right after it's created
+    resources_cache.set(request, res.inserted_id, doc["revision"], json_body["policy_ids"])
+    change_log.publish(request)
+    return web.json_response({"resource_id": str(res.inserted_id), "consistency_token": version})
 
 
 @routes.get('/resources/{resource_id}')
-async def get_resource(request: web.Request):
+@read_handler
+def get_resource(request: web.Request):
     resource_id = assert_path_param_existence(request, "resource_id")
 
-    doc = request.app["mongodb"][DB][RESOURCES_COL].find_one({"_id": ObjectId(resource_id)})
+    doc = tenant_db(request)[RESOURCES_COL].find_one({"_id": ObjectId(resource_id)})
     if not doc:
         raise NotFoundError(f"resource: '{resource_id}' was not found")
 
@@ -47,20 +62,34 @@ async def get_resource(request: web.Request):
 
 
 @routes.put('/resources/{resource_id}')
-async def override_resource_policy_ids(request: web.Request):
+@write_handler
+def override_resource_policy_ids(request: web.Request, body: str):
     resource_id = assert_path_param_existence(request, "resource_id")
 
-    json_body = await request.json(loads=schema.loads)
+    json_body = schema.loads(body)
     _validate_policy_ids(request, json_body["policy_ids"])
 
-    res: UpdateResult = request.app["mongodb"][DB][RESOURCES_COL].update_one(
-        filter={"_id": ObjectId(resource_id)},
-        update={
-            "$set": {
-                "policy_ids": json_body["policy_ids"]
-            }
-        }
-    )
-
-    return web.json_response({"resource_id": resource_id})
+    with new_version(request) as version:
+        # The revision orders the cache writes (see ResourcePoliciesCacheLoader)
+        doc = tenant_db(request)[RESOURCES_COL].find_one_and_update(
+            {"_id": ObjectId(resource_id)},
+            {
+                "$set": {
+                    "policy_ids": json_body["policy_ids"],
+                    "version": version
+                },
+                "$inc": {"revision": 1}
+            },
+            projection={"revision": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        # Nothing was written, so there is nothing to cache, no change to record and no consistency token to return
+        if not doc:
+            raise NotFoundError(f"resource: '{resource_id}' was not found")
+        change_log.record(request, "resource", resource_id, version, UPDATE, {"policy_ids": json_body["policy_ids"]})
+    # Overriding the cached policy ids
+    resources_cache.set(request, ObjectId(resource_id), doc["revision"], json_body["policy_ids"])
+    change_log.publish(request)
+
+    return web.json_response({"resource_id": resource_id, "consistency_token": version})
 
@@ -2,13 +2,19 @@ from typing import Any, Dict
 
 from aiohttp import web
 from bson import ObjectId
-from pymongo.results import InsertOneResult, UpdateResult
-
-from api.common.cache_manager import attributes_cache
-from api.common.configs import DB, USERS_COL
+from pymongo import ReturnDocument
+from pymongo.results import InsertOneResult
+
+from api.common.admission import read_handler, write_handler
+from api.common.cache_manager import attributes_cache, users_cache
+from api.common.changes import INSERT, UPDATE, change_log
+from api.common.configs import USERS_COL
+from api.common.decision import validate_values_types
 from api.common.exceptions import NotFoundError
 from api.common.models import PatchUserAttributeSchema, UserSchema
-from api.common.utils import assert_path_param_existence, validate_values_types
+from api.common.tenants import tenant_db
+from api.common.utils import assert_path_param_existence
+from api.common.versions import new_version
 
 routes = web.RouteTableDef()
 schema = UserSchema()
@@ -20,75 +26,108 @@ def _validate_attributes(request, user_attributes: Dict[str, Any]) -> None:
     validate_values_types(attrs_docs, user_attributes)
 
 
+def _update_user(request, user_id: str, update: Dict[str, Any]) -> int:
+    """Returns the user's revision after the update, the cached user is updated by it (see UserAttributesCacheLoader)"""
+    doc = tenant_db(request)[USERS_COL].find_one_and_update(
+        {"_id": ObjectId(user_id)},
+        {**update, "$inc": {"revision": 1}},
+        projection={"revision": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    # Nothing is cached for users that don't exist, otherwise is_authorized would decide on them
+    if not doc:
+        raise NotFoundError(f"user: '{user_id}' was not found")
+    return doc["revision"]
+
+
 @routes.post('/users')
-async def create_user(request: web.Request):
-    json_body = await request.json(loads=schema.loads)
+@write_handler
+def create_user(request: web.Request, body: str):
+    json_body = schema.loads(body)
     _validate_attributes(request, json_body["attributes"])
-    doc = {
-        "attributes": json_body["attributes"]
-    }
-    res: InsertOneResult = request.app["mongodb"][DB][USERS_COL].insert_one(doc)
-    return web.json_response({"user_id": str(res.inserted_id)})
+    with new_version(request) as version:
+        doc = {
+            "attributes": json_body["attributes"],
+            "version": version
+        }
+        res: InsertOneResult = tenant_db(request)[USERS_COL].insert_one(doc)
+        change_log.record(request, "user", res.inserted_id, version, INSERT, {"attributes": json_body["attributes"]})
+    change_log.publish(request)
+    return web.json_response({"user_id": str(res.inserted_id), "consistency_token": version})
 
 
 @routes.get('/users/{user_id}')
-async def get_user(request: web.Request):
+@read_handler
+def get_user(request: web.Request):
     user_id = assert_path_param_existence(request, "user_id")
 
-    doc = request.app["mongodb"][DB][USERS_COL].find_one({"_id": ObjectId(user_id)})
+    doc = tenant_db(request)[USERS_COL].find_one({"_id": ObjectId(user_id)})
     if not doc:
         raise NotFoundError(f"user: '{user_id}' was not found")
     return web.json_response(schema.dump(doc))
 
 
 @routes.put('/users/{user_id}')
-async def override_user_attributes(request: web.Request):
+@write_handler
+def override_user_attributes(request: web.Request, body: str):
     user_id = assert_path_param_existence(request, "user_id")
-    json_body = await request.json(loads=schema.loads)
+    json_body = schema.loads(body)
     _validate_attributes(request, json_body["attributes"])
 
-    res: UpdateResult = request.app["mongodb"][DB][USERS_COL].update_one(
-        filter={"_id": ObjectId(user_id)},
-        update={
+    with new_version(request) as version:
+        revision = _update_user(request, user_id, {
             "$set": {
-                "attributes": json_body["attributes"]
+                "attributes": json_body["attributes"],
+                "version": version
             }
-        }
-    )
+        })
+        change_log.record(request, "user", user_id, version, UPDATE, {"attributes": json_body["attributes"]})
+    # Replacing the whole cached user atomically, so is_authorized never reads a mix of the old and new attributes
+    users_cache.override(request, ObjectId(user_id), revision, json_body["attributes"])
+    change_log.publish(request)
 
-    return web.json_response({"user_id": user_id})
+    return web.json_response({"user_id": user_id, "consistency_token": version})
 
 
 @routes.patch('/users/{user_id}/attributes/{attribute_name}')
-async def patch_user_attribute(request: web.Request):
+@write_handler
+def patch_user_attribute(request: web.Request, body: str):
     user_id = assert_path_param_existence(request, "user_id")
     attribute_name = assert_path_param_existence(request, "attribute_name")
 
-    json_body = await request.json(loads=patch_user_attribute_schema.loads)
+    json_body = patch_user_attribute_schema.loads(body)
     _validate_attributes(request, {attribute_name: json_body["attribute_value"]})
 
-    res: UpdateResult = request.app["mongodb"][DB][USERS_COL].update_one(
-        filter={"_id": ObjectId(user_id)},
-        update={
+    with new_version(request) as version:
+        revision = _update_user(request, user_id, {
             "$set": {
-                f"attributes.{attribute_name}": json_body["attribute_value"]
+                f"attributes.{attribute_name}": json_body["attribute_value"],
+                "version": version
             }
-        }
-    )
-    return web.json_response({"user_id": user_id})
+        })
+        change_log.record(request, "user", user_id, version, UPDATE, {f"attributes.{attribute_name}": json_body["attribute_value"]})
+    # Applying the same single field update on the cached user, instead of invalidating it
+    users_cache.set_attribute(request, ObjectId(user_id), revision, attribute_name, json_body["attribute_value"])
+    change_log.publish(request)
+    return web.json_response({"user_id": user_id, "consistency_token": version})
 
 
 @routes.delete('/users/{user_id}/attributes/{attribute_name}')
-async def delete_user_attribute(request: web.Request):
+@write_handler
+def delete_user_attribute(request: web.Request, body: str):
     user_id = assert_path_param_existence(request, "user_id")
     attribute_name = assert_path_param_existence(request, "attribute_name")
 
-    res: UpdateResult = request.app["mongodb"][DB][USERS_COL].update_one(
-        filter={"_id": ObjectId(user_id)},
-        update={
+    with new_version(request) as version:
+        revision = _update_user(request, user_id, {
             "$unset": {
                 f"attributes.{attribute_name}": ""
+            },
+            "$set": {
+                "version": version
             }
-        }
-    )
-    return web.json_response({"user_id": user_id})
+        })
+        change_log.record(request, "user", user_id, version, UPDATE, unset_fields=[f"attributes.{attribute_name}"])
+    users_cache.delete_attribute(request, ObjectId(user_id), revision, attribute_name)
+    change_log.publish(request)
+    return web.json_response({"user_id": user_id, "consistency_token": version})
@@ -1,27 +1,66 @@
+import asyncio
 import logging
+import os
+import time
+from typing import Any, Dict, Optional
 
 import pymongo
 from aiohttp import web
 from aiohttp.typedefs import Handler
 from aiohttp.web_app import Application
-from aiohttp.web_exceptions import HTTPBadRequest, HTTPInternalServerError, HTTPNotFound
+from aiohttp.web_exceptions import (
+    HTTPBadRequest,
+    HTTPForbidden,
+    HTTPInternalServerError,
+    HTTPNotFound,
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
+)
 from aiohttp.web_middlewares import middleware
-from aiohttp_swagger import setup_swagger
 from marshmallow import ValidationError
 
+from api.common.admission import (
+    AdmissionController,
+    admission_control_middleware,
+    init_writes_executor,
+)
+from api.common.cache_manager import (
+    cache_budget,
+    conditions_cache,
+    resources_cache,
+    users_cache,
+)
+from api.common.coalescing import BatchLoader
 from api.common.configs import (
+    BINARY_PORT,
     MONGODB_HOST,
     REDIS_DB_NUM,
     REDIS_HOST,
     REDIS_PASS,
     REDIS_PORT,
     SERVER_PORT,
+    SWAGGER_ENABLED,
+)
+from api.common.exceptions import (
+    ForbiddenError,
+    NotFoundError,
+    OverloadedError,
+    RateLimitedError,
+)
+from api.common.health import init_backends_monitor
+from api.common.tenants import (
+    by_tenant,
+    create_indexes,
+    default_tenant,
+    tenant_middleware,
 )
-from api.common.exceptions import NotFoundError
 from api.common.utils import make_error
 from api.handlers import (
     attributes_handlers,
+    binary_handler,
+    changes_handlers,
     is_authorized_handler,
+    pdp_handlers,
     policies_handlers,
     resources_handlers,
     users_handlers,
@@ -30,10 +69,13 @@ from redis import Redis
 
 logger = logging.getLogger("main")
 routes = web.RouteTableDef()
+# When the app is preloaded by the gunicorn master, the imports happen once before the fork,
+# so the workers startup time is measured from the fork (see post_fork in gunicorn.conf.py)
+_imported_at = time.time()
 
 
 # Healthcheck route, called every 15 seconds
-# It just pings Redis and MongoDB to check if its alive
+# It doesn't call Redis and MongoDB, it returns the last status of the backends monitor (see BackendsMonitor)
 @routes.get('/health-check', allow_head=False)
 async def health_check(request: web.Request):
     """
@@ -46,12 +88,52 @@ async def health_check(request: web.Request):
     responses:
         "200":
             description: successful operation. Return "Health Check is OK" text
+        "503":
+            description: MongoDB or Redis are down
     """
-    assert request.app["redis"].ping()
-    assert request.app["mongodb"].admin.command("ping")["ok"] == 1
+    if not request.app["monitor"].ready:
+        return web.Response(text="Health Check failed", status=HTTPServiceUnavailable.status_code)
     return web.Response(text="Health Check is OK")
 
 
+# Liveness probe, the worker is alive as long as its event loop is responsive
+@routes.get('/health/live', allow_head=False)
+async def liveness(request: web.Request):
+    """
+    ---
+    description: Liveness probe, doesn't check the backends.
+    tags:
+    - Health check
+    produces:
+    - text/plain
+    responses:
+        "200":
+            description: successful operation.
+    """
+    return web.Response(text="OK")
+
+
+# Readiness probe, reports the last status of the backends and the caches warm up
+@routes.get('/health/ready', allow_head=False)
+async def readiness(request: web.Request):
+    """
+    ---
+    description: Readiness probe, returns the last status of MongoDB and Redis as checked in the background.
+    tags:
+    - Health check
+    produces:
+    - application/json
+    responses:
+        "200":
+            description: ready to serve requests.
+        "503":
+            description: MongoDB or Redis are down.
+    """
+    report = request.app["monitor"].report(request.app)
+    status = 200 if report["ready"] else HTTPServiceUnavailable.status_code
+    return web.json_response(report, status=status)
+
+
 @routes.get('/favicon.ico')  # This is a dummy endpoint in order to ignore icon requests from browsers
 async def favicon(request: web.Request):
     return web.Response()
@@ -67,14 +149,23 @@ async def safe_execution_middleware(request: web.Request, handler: Handler) -> w
         return web.json_response(make_error(str(e)), status=HTTPNotFound.status_code)
     except ValidationError as e:
         return web.json_response(make_error(str(e)), status=HTTPBadRequest.status_code)
+    except ForbiddenError as e:
+        return web.json_response(make_error(str(e)), status=HTTPForbidden.status_code)
+    except RateLimitedError as e:
+        return web.json_response(make_error(str(e)), status=HTTPTooManyRequests.status_code, headers={"Retry-After": "1"})
+    except OverloadedError as e:
+        return web.json_response(make_error(str(e)), status=HTTPServiceUnavailable.status_code, headers={"Retry-After": "1"})
     except Exception as e:
         logger.exception(f"Error while handling {request=}")
         return web.json_response(make_error(str(e)), status=HTTPInternalServerError.status_code)
 
 
 async def init_mongodb_connection(app):
-    # This section is called upon running the application
-    app['mongodb'] = pymongo.MongoClient(MONGODB_HOST)
+    # This section is called upon running the application (unless the app was given stand-in backends, see api.sim)
+    if 'mongodb' not in app:
+        app['mongodb'] = pymongo.MongoClient(MONGODB_HOST)
+    # In the background, so the worker starts serving (and reporting its health) even when MongoDB is down
+    asyncio.get_running_loop().run_in_executor(None, create_indexes, app['mongodb'], default_tenant.db_name)
     logger.info("MongoDB connection initialized")
     yield
     # This section will be called when the server terminates
@@ -83,36 +174,82 @@ async def init_mongodb_connection(app):
 
 
 async def init_redis_connection(app):
-    # This section is called upon running the application
-    app["redis"] = Redis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=REDIS_DB_NUM,
-        password=REDIS_PASS,
-        decode_responses=True
-    )
+    # This section is called upon running the application (unless the app was given stand-in backends, see api.sim)
+    if "redis" not in app:
+        app["redis"] = Redis(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB_NUM,
+            password=REDIS_PASS,
+            decode_responses=True
+        )
+        # The resources cache keeps raw bytes, so it needs a client that doesn't decode the responses
+        app["redis_bytes"] = Redis(
+            host=REDIS_HOST,
+            port=REDIS_PORT,
+            db=REDIS_DB_NUM,
+            password=REDIS_PASS
+        )
+    if cache_budget.enabled:
+        # In the background like the indexes, until it's read the budgets are used as they are configured
+        asyncio.get_running_loop().run_in_executor(None, cache_budget.load_max_memory, app["redis"])
     logger.info("Redis connection initialized")
     yield
     # This section will be called when the server terminates
     app['redis'].close()
+    app['redis_bytes'].close()
     logger.info("Redis connection closed")
 
 
-async def app_factory() -> Application:
+async def init_batch_loaders(app):
+    # One loader per entity in each worker, all the requests handled by the worker share them.
+    # The keys are (tenant name, id), and each batch reads every tenant's keys separately
+    app["users_loader"] = BatchLoader(by_tenant(users_cache.get_many, app))
+    app["resources_loader"] = BatchLoader(by_tenant(resources_cache.get_many, app))
+    app["signatures_loader"] = BatchLoader(by_tenant(conditions_cache.get_signatures_many, app))
+    app["conditions_loader"] = BatchLoader(by_tenant(conditions_cache.get_conditions_many, app))
+    yield
+
+
+async def on_worker_ready(app):
+    app["ready_at"] = time.time()
+    logger.info(f"Worker {os.getpid()} is ready in {app['ready_at'] - app['started_at']:.3f} seconds")
+
+
+async def app_factory(backends: Optional[Dict[str, Any]] = None, binary_port: Optional[int] = BINARY_PORT) -> Application:
+    # The backends ("mongodb", "redis" and "redis_bytes") can be given instead of connecting to MongoDB and Redis,
+    # e.g. the in-process stand-ins of the tests and the scenario runner (see api.sim)
     # We can add other middlewares as well, like authentications, analytics, logs, etc..
-    app = web.Application(middlewares=[safe_execution_middleware])
+    # The admission control is inside the safe execution, so its rejections are returned as errors responses
+    # The tenant is resolved first, so the admission control and the handlers know the request's tenant
+    app = web.Application(middlewares=[safe_execution_middleware, tenant_middleware, admission_control_middleware])
+    app["admission"] = AdmissionController()
+    app["started_at"] = float(os.environ.get("ABAC_WORKER_STARTED_AT", _imported_at))
+    app["binary_port"] = binary_port  # None doesn't listen
+    app.update(backends or {})
 
     app.cleanup_ctx.append(init_mongodb_connection)
     app.cleanup_ctx.append(init_redis_connection)
+    app.cleanup_ctx.append(init_batch_loaders)
+    app.cleanup_ctx.append(binary_handler.init_binary_server)
+    app.cleanup_ctx.append(changes_handlers.init_changes_executor)
+    app.cleanup_ctx.append(changes_handlers.init_changes_relay)
+    app.cleanup_ctx.append(init_writes_executor)
+    app.cleanup_ctx.append(init_backends_monitor)
+    app.on_startup.append(on_worker_ready)  # called after all the cleanup contexts were initialized
 
     app.add_routes(attributes_handlers.routes)
     app.add_routes(users_handlers.routes)
     app.add_routes(policies_handlers.routes)
     app.add_routes(resources_handlers.routes)
     app.add_routes(is_authorized_handler.routes)
+    app.add_routes(pdp_handlers.routes)
+    app.add_routes(changes_handlers.routes)
     app.add_routes(routes)
 
-    setup_swagger(app=app, ui_version=3)
+    if SWAGGER_ENABLED:
+        from aiohttp_swagger import setup_swagger
+        setup_swagger(app=app, ui_version=3)
 
     return app
 
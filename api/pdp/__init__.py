@@ -0,0 +1 @@
+from api.pdp.decision_point import PolicyDecisionPoint, StaleError
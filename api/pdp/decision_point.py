@@ -0,0 +1,221 @@
+"""
+Embeddable policy decision point (PDP).
+
+Services that check authorization at a high rate can decide in process instead of calling /is_authorized over HTTP.
+The PDP keeps the policies (all of them, they are few) and a bounded number of users and resources in memory,
+synced from the service with a snapshot and then the changes feed (see pdp_handlers), and decides with the same
+logic as the service (decide_if_authorized). Users and resources that are not held locally are fetched on demand.
+
+Every write to the service returns a consistency token, a caller that must see its own write passes it as min_token:
+    pdp = PolicyDecisionPoint("http://abac:8080")
+    pdp.start()
+    pdp.is_authorized(user_id, resource_id, min_token=token)
+"""
+import json
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+from bson import ObjectId
+
+from api.common.decision import (
+    PrefetchedConditionsCache,
+    compile_policy_doc,
+    decide_if_authorized,
+)
+from api.common.exceptions import NotFoundError
+
+logger = logging.getLogger("pdp")
+
+class StaleError(Exception):
+    pass
+
+
+class _BoundedMap:
+    """LRU map of entity id -> (version, value)"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key: str):
+        item = self._items.get(key)
+        if item is not None:
+            self._items.move_to_end(key)
+        return item
+
+    def put(self, key: str, version: int, value: Any) -> None:
+        self._items[key] = (version, value)
+        self._items.move_to_end(key)
+        if len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def apply(self, key: str, version: int, value: Any) -> None:
+        # The feed only refreshes the held items, and fills the map while it has room,
+        # so syncing doesn't evict the items that are actually used
+        item = self._items.get(key)
+        if item is None:
+            if len(self._items) < self.max_size:
+                self._items[key] = (version, value)
+        elif version > item[0]:
+            self._items[key] = (version, value)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+def _http_fetch(base_url: str, timeout_seconds: float, tenant: Optional[str]) -> Callable[[str, Dict[str, Any]], Optional[Dict[str, Any]]]:
+    headers = {"X-Tenant-Id": tenant} if tenant else {}
+
+    def fetch(path: str, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        url = base_url.rstrip("/") + path
+        if params:
+            url += "?" + urlencode(params)
+        try:
+            with urlopen(Request(url, headers=headers), timeout=timeout_seconds) as response:
+                return json.load(response)
+        except HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+    return fetch
+
+
+class PolicyDecisionPoint:
+    def __init__(
+            self,
+            base_url: Optional[str] = None,
+            max_users: int = 100000,
+            max_resources: int = 100000,
+            sync_interval_seconds: float = 1,
+            page_size: int = 1000,
+            timeout_seconds: float = 5,
+            tenant: Optional[str] = None,
+            fetch: Optional[Callable[[str, Dict[str, Any]], Optional[Dict[str, Any]]]] = None
+    ):
+        # fetch(path, query params) returns the response's JSON, or None for 404
+        self._fetch = fetch or _http_fetch(base_url, timeout_seconds, tenant)
+        self.sync_interval_seconds = sync_interval_seconds
+        self.page_size = page_size
+        self.token: Optional[int] = None
+        self._users = _BoundedMap(max_users)
+        self._resources = _BoundedMap(max_resources)
+        self._policies: Dict[ObjectId, Dict[str, Any]] = {}
+        self._policies_versions: Dict[ObjectId, int] = {}
+        self._lock = threading.RLock()  # guards the maps, the decisions are made outside of it
+        self._sync_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _apply(self, entity: str, item: Dict[str, Any]) -> None:
+        version = item["version"]
+        if entity == "users":
+            self._users.apply(item["user_id"], version, item["attributes"])
+        elif entity == "resources":
+            self._resources.apply(item["resource_id"], version, [ObjectId(p) for p in item["policy_ids"]])
+        else:
+            policy_id = ObjectId(item["policy_id"])
+            if version > self._policies_versions.get(policy_id, -1):
+                self._policies[policy_id] = compile_policy_doc(item)
+                self._policies_versions[policy_id] = version
+
+    def _load_snapshot(self) -> int:
+        token = None
+        for entity in ("policies", "users", "resources"):
+            after = None
+            while True:
+                params = {"limit": self.page_size, **({"after": after} if after else {})}
+                page = self._fetch(f"/pdp/snapshot/{entity}", params)
+                # the feed continues from the oldest page, so nothing that changed while loading is missed
+                token = page["token"] if token is None else min(token, page["token"])
+                with self._lock:
+                    for item in page["items"]:
+                        self._apply(entity, item)
+                after = page["next"]
+                if after is None:
+                    break
+        return token
+
+    def sync(self) -> int:
+        """Loads the changes since the last sync (or the snapshot on the first sync), returns the token reached"""
+        with self._sync_lock:
+            if self.token is None:
+                self.token = self._load_snapshot()
+            # the feed returns only committed versions (see committed_version), so nothing is missed below the token
+            since = self.token
+            while True:
+                page = self._fetch("/pdp/feed", {"since": since, "limit": self.page_size})
+                with self._lock:
+                    for entity in ("policies", "users", "resources"):
+                        for item in page[entity]:
+                            self._apply(entity, item)
+                self.token = max(self.token, page["token"])
+                if page["complete"]:
+                    return self.token
+                since = page["token"]
+
+    def start(self) -> None:
+        self.sync()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="pdp-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.sync_interval_seconds):
+            try:
+                self.sync()
+            except Exception:
+                # keeping the last synced data, the callers that need fresher data pass min_token
+                logger.exception("PDP sync failed")
+
+    def _get_entity(self, entities: _BoundedMap, path: str, key: str, entity_id: str, parse: Callable[[Dict[str, Any]], Any]) -> Any:
+        with self._lock:
+            item = entities.get(entity_id)
+        if item is not None:
+            return item[1]
+        doc = self._fetch(f"{path}/{entity_id}", {})
+        if doc is None:
+            raise NotFoundError(f"{key} {entity_id} not found")
+        value = parse(doc)
+        with self._lock:
+            # the fetched document is at least as fresh as the synced token, so older feed items won't override it
+            entities.put(entity_id, self.token or 0, value)
+        return value
+
+    def _get_policies(self, policy_ids: List[ObjectId]) -> Dict[ObjectId, Dict[str, Any]]:
+        with self._lock:
+            policies = {policy_id: self._policies.get(policy_id) for policy_id in policy_ids}
+        for policy_id, policy in policies.items():
+            if policy is None:
+                doc = self._fetch(f"/policies/{policy_id}", {})
+                if doc is None:
+                    raise NotFoundError(f"policy {policy_id} not found")
+                policies[policy_id] = compile_policy_doc(doc)
+        return policies
+
+    def is_authorized(self, user_id: str, resource_id: str, min_token: Optional[int] = None) -> bool:
+        if min_token is not None and (self.token is None or self.token < min_token):
+            self.sync()
+            if self.token < min_token:
+                raise StaleError(f"PDP is synced up to {self.token}, token {min_token} is not visible yet")
+
+        user_attributes = self._get_entity(self._users, "/users", "user", user_id, lambda doc: doc["attributes"])
+        policy_ids = self._get_entity(
+            self._resources, "/resources", "resource", resource_id,
+            lambda doc: [ObjectId(p) for p in doc["policy_ids"]]
+        )
+        conditions_cache = PrefetchedConditionsCache(self._get_policies(policy_ids))
+        return decide_if_authorized(policy_ids, user_attributes, conditions_cache)
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {"token": self.token, "users": len(self._users), "resources": len(self._resources), "policies": len(self._policies)}
@@ -0,0 +1,15 @@
+from typing import Any, Dict, Optional
+
+from api.sim.fake_mongo import FakeMongoClient
+from api.sim.fake_redis import FakeRedis, FakeRedisServer
+from api.sim.faults import BackendFaults, LatencyModel
+
+
+def stand_in_backends(mongodb_faults: Optional[BackendFaults] = None, redis_faults: Optional[BackendFaults] = None) -> Dict[str, Any]:
+    """The app's backends (see app_factory), in process instead of MongoDB and Redis"""
+    redis_server = FakeRedisServer(redis_faults)
+    return {
+        "mongodb": FakeMongoClient(mongodb_faults),
+        "redis": FakeRedis(redis_server, decode_responses=True),
+        "redis_bytes": FakeRedis(redis_server),
+    }
@@ -0,0 +1,275 @@
+import copy
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import (
+    AutoReconnect,
+    DuplicateKeyError,
+    NetworkTimeout,
+    OperationFailure,
+)
+from pymongo.results import DeleteResult, InsertOneResult, UpdateResult
+
+from api.sim.faults import BackendFaults
+
+# In-process stand-in of MongoDB (pymongo's MongoClient), with the queries and updates that the service uses:
+# equality and $in/$nin/$gt/$gte/$lt/$lte/$ne filters (on dotted paths), inclusion projections,
+# $set/$unset/$inc updates, upserts and sort/limit cursors.
+# The documents are copied in and out, like they are sent to and from the database,
+# and every operation (a cursor is one operation, on its first read) goes through the client's faults (see BackendFaults).
+# The operators and commands that aren't supported fail like MongoDB fails on unknown ones (OperationFailure)
+
+_MISSING = object()
+
+
+def _get_path(doc: Dict[str, Any], path: str) -> Any:
+    value = doc
+    for field in path.split("."):
+        if not isinstance(value, dict) or field not in value:
+            return _MISSING
+        value = value[field]
+    return value
+
+
+def _set_path(doc: Dict[str, Any], path: str, value: Any) -> None:
+    *parents, field = path.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[field] = value
+
+
+def _unset_path(doc: Dict[str, Any], path: str) -> None:
+    *parents, field = path.split(".")
+    for parent in parents:
+        doc = doc.get(parent)
+        if not isinstance(doc, dict):
+            return
+    doc.pop(field, None)
+
+
+def _matches_value(value: Any, condition: Any) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith("$") for k in condition):
+        for operator, operand in condition.items():
+            if operator == "$in":
+                matched = value is not _MISSING and value in operand
+            elif operator == "$nin":
+                matched = value is _MISSING or value not in operand
+            elif operator == "$ne":
+                matched = value is _MISSING or value != operand
+            elif operator in ("$gt", "$gte", "$lt", "$lte"):
+                if value is _MISSING or value is None:
+                    matched = False
+                else:
+                    try:
+                        matched = {"$gt": value > operand, "$gte": value >= operand, "$lt": value < operand, "$lte": value <= operand}[operator]
+                    except TypeError:  # MongoDB compares only values of the same type
+                        matched = False
+            else:
+                raise OperationFailure(f"unknown operator: {operator} (not supported by the stand-in)", code=2)
+            if not matched:
+                return False
+        return True
+    return value is not _MISSING and value == condition
+
+
+def _matches(doc: Dict[str, Any], query: Optional[Dict[str, Any]]) -> bool:
+    return all(_matches_value(_get_path(doc, path), condition) for path, condition in (query or {}).items())
+
+
+def _project(doc: Dict[str, Any], projection: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    doc = copy.deepcopy(doc)
+    if not projection:
+        return doc
+    included = [path for path, include in projection.items() if include and path != "_id"]
+    if not included:  # exclusion projection
+        for path, include in projection.items():
+            if not include:
+                _unset_path(doc, path)
+        return doc
+    projected = {"_id": doc["_id"]} if projection.get("_id", 1) and "_id" in doc else {}
+    for path in included:
+        value = _get_path(doc, path)
+        if value is not _MISSING:
+            _set_path(projected, path, value)
+    return projected
+
+
+def _apply_update(doc: Dict[str, Any], update: Dict[str, Any]) -> None:
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set":
+                _set_path(doc, path, copy.deepcopy(value))
+            elif operator == "$unset":
+                _unset_path(doc, path)
+            elif operator == "$inc":
+                current = _get_path(doc, path)
+                _set_path(doc, path, (0 if current is _MISSING else current) + value)
+            else:
+                raise OperationFailure(f"Unknown modifier: {operator} (not supported by the stand-in)", code=9)
+
+
+class FakeCursor:
+    def __init__(self, collection: "FakeCollection", query: Optional[Dict[str, Any]], projection: Optional[Dict[str, Any]]):
+        self._collection = collection
+        self._query = query
+        self._projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._limit = 0
+        self._results: Optional[Iterator[Dict[str, Any]]] = None
+
+    def sort(self, key: str, direction: int = 1) -> "FakeCursor":
+        self._sort.append((key, direction))
+        return self
+
+    def limit(self, limit: int) -> "FakeCursor":
+        self._limit = limit
+        return self
+
+    def __iter__(self) -> "FakeCursor":
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        if self._results is None:
+            self._results = iter(self._collection._find(self._query, self._projection, self._sort, self._limit))
+        return next(self._results)
+
+
+class FakeCollection:
+    def __init__(self, client: "FakeMongoClient", name: str):
+        self._client = client
+        self.name = name
+        self._docs: Dict[Any, Dict[str, Any]] = {}  # by _id, in insertion order
+        self.indexes: List[Any] = []
+
+    def _find(self, query, projection, sort, limit) -> List[Dict[str, Any]]:
+        self._client._round_trip()
+        with self._client.lock:
+            docs = [doc for doc in self._docs.values() if _matches(doc, query)]
+            for key, direction in reversed(sort):
+                docs.sort(key=lambda doc: _get_path(doc, key), reverse=direction < 0)
+            if limit:
+                docs = docs[:limit]
+            return [_project(doc, projection) for doc in docs]
+
+    def find(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None) -> FakeCursor:
+        return FakeCursor(self, filter, projection)
+
+    def find_one(self, filter: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        docs = self._find(filter, projection, [], 1)
+        return docs[0] if docs else None
+
+    def count_documents(self, filter: Dict[str, Any]) -> int:
+        self._client._round_trip()
+        with self._client.lock:
+            return sum(1 for doc in self._docs.values() if _matches(doc, filter))
+
+    def _insert(self, doc: Dict[str, Any]) -> Any:
+        if doc.get("_id") in self._docs:
+            raise DuplicateKeyError(f"E11000 duplicate key error collection: {self.name} index: _id_ dup key: {{ _id: {doc['_id']!r} }}")
+        self._docs[doc["_id"]] = copy.deepcopy(doc)
+        return doc["_id"]
+
+    def insert_one(self, document: Dict[str, Any]) -> InsertOneResult:
+        self._client._round_trip()
+        # like pymongo, the generated _id is set on the given document
+        document.setdefault("_id", ObjectId())
+        with self._client.lock:
+            return InsertOneResult(self._insert(document), acknowledged=True)
+
+    def delete_many(self, filter: Dict[str, Any]) -> DeleteResult:
+        self._client._round_trip()
+        with self._client.lock:
+            deleted = [_id for _id, doc in self._docs.items() if _matches(doc, filter)]
+            for _id in deleted:
+                del self._docs[_id]
+        return DeleteResult({"n": len(deleted), "ok": 1.0}, acknowledged=True)
+
+    def _update(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]], Any]:
+        """Returns the document before and after the update, and the upserted _id"""
+        for doc in self._docs.values():
+            if _matches(doc, filter):
+                before = copy.deepcopy(doc)
+                _apply_update(doc, update)
+                return before, doc, None
+        if not upsert:
+            return None, None, None
+        doc = {path: value for path, value in filter.items() if not isinstance(value, dict)}
+        doc.setdefault("_id", ObjectId())
+        _apply_update(doc, update)
+        self._insert(doc)
+        return None, self._docs[doc["_id"]], doc["_id"]
+
+    def update_one(self, filter: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> UpdateResult:
+        self._client._round_trip()
+        with self._client.lock:
+            before, after, upserted_id = self._update(filter, update, upsert)
+        raw_result = {"n": int(after is not None), "nModified": int(before is not None and before != after), "ok": 1.0}
+        if upserted_id is not None:
+            raw_result["upserted"] = upserted_id
+        return UpdateResult(raw_result, acknowledged=True)
+
+    def find_one_and_update(
+            self,
+            filter: Dict[str, Any],
+            update: Dict[str, Any],
+            projection: Optional[Dict[str, Any]] = None,
+            upsert: bool = False,
+            return_document: bool = ReturnDocument.BEFORE
+    ) -> Optional[Dict[str, Any]]:
+        self._client._round_trip()
+        with self._client.lock:
+            before, after, _ = self._update(filter, update, upsert)
+            doc = after if return_document == ReturnDocument.AFTER else before
+            return _project(doc, projection) if doc is not None else None
+
+    def create_index(self, keys: Any, **kwargs: Any) -> str:
+        self._client._round_trip()
+        with self._client.lock:
+            if keys not in self.indexes:
+                self.indexes.append(keys)
+        return f"{keys}_1" if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+
+class FakeDatabase:
+    def __init__(self, client: "FakeMongoClient", name: str):
+        self._client = client
+        self.name = name
+        self._collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        with self._client.lock:
+            if name not in self._collections:
+                self._collections[name] = FakeCollection(self._client, name)
+            return self._collections[name]
+
+    def command(self, command: str, *args: Any, **kwargs: Any) -> Dict[str, Any]:
+        if command != "ping":
+            raise OperationFailure(f"no such command: '{command}' (not supported by the stand-in)", code=59)
+        self._client._round_trip()
+        return {"ok": 1.0}
+
+
+class FakeMongoClient:
+    def __init__(self, faults: Optional[BackendFaults] = None):
+        self.faults = faults
+        self.lock = threading.RLock()
+        self._databases: Dict[str, FakeDatabase] = {}
+
+    def _round_trip(self) -> None:
+        if self.faults is not None:
+            self.faults.before_call(AutoReconnect, NetworkTimeout)
+
+    def __getitem__(self, name: str) -> FakeDatabase:
+        with self.lock:
+            if name not in self._databases:
+                self._databases[name] = FakeDatabase(self, name)
+            return self._databases[name]
+
+    @property
+    def admin(self) -> FakeDatabase:
+        return self["admin"]
+
+    def close(self) -> None:
+        pass
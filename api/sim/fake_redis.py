@@ -0,0 +1,532 @@
+import json
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from lupa.lua51 import LuaError, LuaRuntime, lua_type
+from redis.exceptions import ConnectionError, DataError, ResponseError, TimeoutError
+
+from api.sim.faults import BackendFaults
+
+# In-process stand-in of Redis, with the commands (and the Lua scripts) that the service uses.
+# FakeRedisServer holds the data, FakeRedis is a client of it like redis.Redis (bytes, or str with decode_responses),
+# so app["redis"] and app["redis_bytes"] are two clients of the same server.
+# Every call (a command, a pipeline or a script) is one round trip, which goes through the server's faults (see BackendFaults)
+
+STRING, HASH, ZSET, STREAM, JSON = "string", "hash", "zset", "stream", "json"
+
+
+def _encode(value: Any) -> bytes:
+    # the same conversion as redis-py
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, bool):
+        raise DataError("Invalid input of type: 'bool'. Convert to a bytes, string, int or float first.")
+    if isinstance(value, int):
+        return str(value).encode()
+    if isinstance(value, float):
+        return repr(value).encode()
+    raise DataError(f"Invalid input of type: '{type(value).__name__}'. Convert to a bytes, string, int or float first.")
+
+
+def _key(name: Any) -> str:
+    return _encode(name).decode()
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, dict):
+        return {_decode(k): _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_decode(v) for v in value)
+    return value
+
+
+def _json_path(path: Any) -> List[str]:
+    path = str(path)
+    if path in (".", "$"):
+        return []
+    return path.lstrip("$").lstrip(".").split(".")
+
+
+def _stream_id(stream_id: Any) -> Tuple[int, int]:
+    ms, _, seq = _encode(stream_id).decode().partition("-")
+    return int(ms), int(seq or 0)
+
+
+class FakeRedisServer:
+    def __init__(self, faults: Optional[BackendFaults] = None):
+        self.faults = faults
+        self.lock = threading.Lock()
+        self._stream_added = threading.Condition(self.lock)
+        self._data: Dict[str, Tuple[str, Any]] = {}
+        self._expires: Dict[str, float] = {}
+        self._lua_scripts: Optional[_LuaScripts] = None
+        self.max_memory = 0  # the maxmemory config, 0 is unlimited like in Redis
+
+    @staticmethod
+    def clock() -> float:
+        return time.time()
+
+    def _item(self, name: Any) -> Optional[Tuple[str, Any]]:
+        # the keys expire lazily, when they are read
+        key = _key(name)
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key)
+        return self._data.get(key)
+
+    def _get(self, name: Any, value_type: str) -> Optional[Any]:
+        item = self._item(name)
+        if item is None:
+            return None
+        if item[0] != value_type:
+            raise ResponseError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return item[1]
+
+    def _get_or_create(self, name: Any, value_type: str, factory: Callable[[], Any]) -> Any:
+        value = self._get(name, value_type)
+        if value is None:
+            value = factory()
+            self._data[_key(name)] = (value_type, value)
+        return value
+
+    def _drop_if_empty(self, name: Any, value: Any) -> None:
+        # like Redis, empty hashes and sorted sets don't exist
+        if not value:
+            self.cmd_delete(name)
+
+    # The commands, called with the server's lock held (see FakeRedis._run)
+
+    def cmd_ping(self) -> bool:
+        return True
+
+    def cmd_time(self) -> Tuple[int, int]:
+        now = self.clock()
+        return int(now), int((now % 1) * 1000000)
+
+    def cmd_config_get(self, pattern: Any = "*") -> Dict[str, str]:
+        if _decode(pattern) != "maxmemory":
+            raise ResponseError("ERR only CONFIG GET maxmemory is supported by the stand-in")
+        return {"maxmemory": str(self.max_memory)}  # redis-py returns str for both kinds of clients
+
+    def cmd_exists(self, *names: Any) -> int:
+        return sum(1 for name in names if self._item(name) is not None)
+
+    def cmd_delete(self, *names: Any) -> int:
+        deleted = 0
+        for name in names:
+            key = _key(name)
+            self._expires.pop(key, None)
+            deleted += self._data.pop(key, None) is not None
+        return deleted
+
+    def cmd_expire(self, name: Any, seconds: int) -> bool:
+        if not self.cmd_exists(name):
+            return False
+        self._expires[_key(name)] = time.monotonic() + seconds
+        return True
+
+    def cmd_get(self, name: Any) -> Optional[bytes]:
+        return self._get(name, STRING)
+
+    def cmd_mget(self, keys: List[Any], *args: Any) -> List[Optional[bytes]]:
+        return [self.cmd_get(name) for name in [*keys, *args]]
+
+    def cmd_set(self, name: Any, value: Any, ex: Optional[int] = None) -> bool:
+        self.cmd_delete(name)
+        self._data[_key(name)] = (STRING, _encode(value))
+        if ex is not None:
+            self._expires[_key(name)] = time.monotonic() + ex
+        return True
+
+    def cmd_hgetall(self, name: Any) -> Dict[bytes, bytes]:
+        return dict(self._get(name, HASH) or {})
+
+    def cmd_hget(self, name: Any, key: Any) -> Optional[bytes]:
+        return (self._get(name, HASH) or {}).get(_encode(key))
+
+    def cmd_hmget(self, name: Any, keys: List[Any], *args: Any) -> List[Optional[bytes]]:
+        mapping = self._get(name, HASH) or {}
+        return [mapping.get(_encode(key)) for key in [*keys, *args]]
+
+    def cmd_hset(self, name: Any, key: Any = None, value: Any = None, mapping: Optional[Dict[Any, Any]] = None) -> int:
+        items = list((mapping or {}).items())
+        if key is not None:
+            items.append((key, value))
+        if not items:
+            raise DataError("'hset' with no key value pairs")
+        hash_value = self._get_or_create(name, HASH, dict)
+        added = 0
+        for k, v in items:
+            added += _encode(k) not in hash_value
+            hash_value[_encode(k)] = _encode(v)
+        return added
+
+    def cmd_hdel(self, name: Any, *keys: Any) -> int:
+        hash_value = self._get(name, HASH)
+        if hash_value is None:
+            return 0
+        deleted = sum(hash_value.pop(_encode(key), None) is not None for key in keys)
+        self._drop_if_empty(name, hash_value)
+        return deleted
+
+    def cmd_zadd(self, name: Any, mapping: Dict[Any, float]) -> int:
+        zset = self._get_or_create(name, ZSET, dict)
+        added = 0
+        for member, score in mapping.items():
+            added += _encode(member) not in zset
+            zset[_encode(member)] = float(score)
+        return added
+
+    def cmd_zpopmin(self, name: Any, count: Optional[int] = None) -> List[Tuple[bytes, float]]:
+        zset = self._get(name, ZSET)
+        if not zset:
+            return []
+        popped = sorted(zset.items(), key=lambda item: (item[1], item[0]))[:count or 1]
+        for member, _ in popped:
+            del zset[member]
+        self._drop_if_empty(name, zset)
+        return popped
+
+    # A stream is {"last": last id, "entries": [(id, fields)]}, the ids are (ms, seq) tuples
+    def _stream_entries(self, name: Any) -> List[Tuple[Tuple[int, int], Dict[bytes, bytes]]]:
+        stream = self._get(name, STREAM)
+        return stream["entries"] if stream else []
+
+    def cmd_xadd(self, name: Any, fields: Dict[Any, Any], id: str = "*", maxlen: Optional[int] = None, approximate: bool = True) -> bytes:
+        stream = self._get_or_create(name, STREAM, lambda: {"last": (0, 0), "entries": []})
+        ms = int(self.clock() * 1000)
+        last_ms, last_seq = stream["last"]
+        stream_id = stream["last"] = (ms, 0) if ms > last_ms else (last_ms, last_seq + 1)
+        stream["entries"].append((stream_id, {_encode(k): _encode(v) for k, v in fields.items()}))
+        if maxlen is not None and len(stream["entries"]) > maxlen:
+            # trimming exactly, Redis with approximate=True keeps a bit more
+            del stream["entries"][:len(stream["entries"]) - maxlen]
+        self._stream_added.notify_all()
+        return f"{stream_id[0]}-{stream_id[1]}".encode()
+
+    @staticmethod
+    def _entries(entries: List[Tuple[Tuple[int, int], Dict[bytes, bytes]]]) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        return [(f"{ms}-{seq}".encode(), dict(fields)) for (ms, seq), fields in entries]
+
+    def cmd_xrange(self, name: Any, min: str = "-", max: str = "+", count: Optional[int] = None) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        entries = [
+            (stream_id, fields) for stream_id, fields in self._stream_entries(name)
+            if (min == "-" or stream_id >= _stream_id(min)) and (max == "+" or stream_id <= _stream_id(max))
+        ]
+        return self._entries(entries[:count])
+
+    def cmd_xrevrange(self, name: Any, max: str = "+", min: str = "-", count: Optional[int] = None) -> List[Tuple[bytes, Dict[bytes, bytes]]]:
+        entries = self.cmd_xrange(name, min, max)
+        return entries[::-1][:count]
+
+    def cmd_xread(self, streams: Dict[Any, Any], count: Optional[int] = None, block: Optional[int] = None) -> List[List[Any]]:
+        since = {
+            name: (self._get(name, STREAM) or {"last": (0, 0)})["last"] if _encode(stream_id) == b"$" else _stream_id(stream_id)
+            for name, stream_id in streams.items()
+        }
+        deadline = time.monotonic() + block / 1000 if block else None
+        while True:
+            response = []
+            for name, since_id in since.items():
+                entries = [(i, f) for i, f in self._stream_entries(name) if i > since_id][:count]
+                if entries:
+                    response.append([_encode(name), self._entries(entries)])
+            if response or block is None:
+                return response
+            # waiting for xadd (block=0 waits forever), the lock is released while waiting
+            remaining = deadline - time.monotonic() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                return []
+            self._stream_added.wait(remaining)
+
+    def cmd_json_get(self, name: Any, *paths: Any) -> Any:
+        document = self._get(name, JSON)
+        if document is None:
+            return None
+        document = json.loads(document)  # a copy, like reading it from Redis
+
+        def at(path: Any) -> Any:
+            value = document
+            for field in _json_path(path):
+                if not isinstance(value, dict) or field not in value:
+                    raise ResponseError(f"Path '{path}' does not exist")
+                value = value[field]
+            return value
+        if len(paths) > 1:
+            return {str(path): at(path) for path in paths}
+        return at(paths[0] if paths else ".")
+
+    def cmd_json_mget(self, keys: List[Any], path: Any) -> List[Any]:
+        values = []
+        for name in keys:
+            try:
+                values.append(self.cmd_json_get(name, path))
+            except ResponseError:
+                values.append(None)
+        return values
+
+    def cmd_json_set(self, name: Any, path: Any, obj: Any) -> bool:
+        fields = _json_path(path)
+        if not fields:
+            self.cmd_delete(name)
+            self._data[_key(name)] = (JSON, json.dumps(obj))
+            return True
+        document = self._get(name, JSON)
+        if document is None:
+            raise ResponseError("new objects must be created at the root")
+        document = json.loads(document)
+        parent = document
+        for field in fields[:-1]:
+            parent = parent[field]
+        parent[fields[-1]] = obj
+        self._data[_key(name)] = (JSON, json.dumps(document))
+        return True
+
+    def cmd_evalscript(self, script: str, keys: List[Any], args: List[Any]) -> Any:
+        if self._lua_scripts is None:
+            self._lua_scripts = _LuaScripts(self)
+        return self._lua_scripts.run(script, keys, args)
+
+
+class _FakeJSON:
+    def __init__(self, client: "_Commands"):
+        self._client = client
+
+    def get(self, name: Any, *paths: Any) -> Any:
+        return self._client._call("json_get", name, *paths)
+
+    def mget(self, keys: List[Any], path: Any) -> Any:
+        return self._client._call("json_mget", keys, path)
+
+    def set(self, name: Any, path: Any, obj: Any) -> Any:
+        return self._client._call("json_set", name, path, obj)
+
+
+class _FakeScript:
+    def __init__(self, client: "FakeRedis", script: str):
+        self._client = client
+        self.script = script
+
+    def __call__(self, keys: Optional[List[Any]] = None, args: Optional[List[Any]] = None, client: Optional["_Commands"] = None) -> Any:
+        return (client or self._client)._call("evalscript", self.script, list(keys or []), list(args or []))
+
+
+# The client's commands (see FakeRedisServer's cmd_ methods), sent with the given send function:
+# right away by FakeRedis, or queued by FakePipeline
+class _Commands:
+    def __init__(self, send: Callable[[str, tuple, dict], Any]):
+        self._send = send
+
+    def _call(self, command: str, *args: Any, **kwargs: Any) -> Any:
+        if not hasattr(FakeRedisServer, f"cmd_{command}"):
+            raise ResponseError(f"ERR unknown command '{command}', it's not supported by the stand-in")
+        return self._send(command, args, kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for the missing attributes, so a command that the stand-in doesn't have fails explicitly
+        if name.startswith("_"):
+            raise AttributeError(name)
+        raise AttributeError(f"the Redis command '{name}' is not supported by the stand-in (see FakeRedisServer)")
+
+    def json(self) -> _FakeJSON:
+        return _FakeJSON(self)
+
+
+def _command(name: str) -> Callable[..., Any]:
+    def command(self: _Commands, *args: Any, **kwargs: Any) -> Any:
+        return self._call(name, *args, **kwargs)
+    command.__name__ = name
+    return command
+
+
+for _name in [name[len("cmd_"):] for name in dir(FakeRedisServer) if name.startswith("cmd_") and not name.startswith("cmd_json_")]:
+    setattr(_Commands, _name, _command(_name))
+
+
+class FakeRedis(_Commands):
+    def __init__(self, server: Optional[FakeRedisServer] = None, decode_responses: bool = False):
+        super().__init__(lambda command, args, kwargs: self._run([(command, args, kwargs)])[0])
+        self.server = server or FakeRedisServer()
+        self.decode_responses = decode_responses
+
+    def _run(self, commands: List[Tuple[str, tuple, dict]]) -> List[Any]:
+        if self.server.faults is not None:
+            self.server.faults.before_call(ConnectionError, TimeoutError)
+        with self.server.lock:
+            results = [getattr(self.server, f"cmd_{name}")(*args, **kwargs) for name, args, kwargs in commands]
+        return [_decode(result) for result in results] if self.decode_responses else results
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self)
+
+    def register_script(self, script: str) -> _FakeScript:
+        return _FakeScript(self, script)
+
+    def close(self) -> None:
+        pass
+
+
+# The queued commands are sent in one round trip, and executed without other clients' commands in between
+# (which is what MULTI/EXEC guarantees, and more than a pipeline without a transaction does)
+class FakePipeline(_Commands):
+    def __init__(self, client: FakeRedis):
+        super().__init__(self._queue)
+        self._client = client
+        self._commands: List[Tuple[str, tuple, dict]] = []
+
+    def _queue(self, command: str, args: tuple, kwargs: dict) -> "FakePipeline":
+        self._commands.append((command, args, kwargs))
+        return self
+
+    def execute(self) -> List[Any]:
+        commands, self._commands = self._commands, []
+        if not commands:
+            return []
+        return self._client._run(commands)
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def __enter__(self) -> "FakePipeline":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._commands = []
+
+
+# The Lua scripts run as they are (in Lua 5.1, like in Redis), with redis.call() on the server's commands.
+# The replies are converted like Redis does: integers to numbers, nil to false, arrays to tables and status replies to {ok=...},
+# and the script's result back: numbers are truncated to integers, false to nil, and tables to arrays (up to the first nil).
+# Only the commands that the service's scripts call are supported (see _LUA_COMMANDS)
+
+def _lua_arg(value: Any) -> bytes:
+    if isinstance(value, float) and value == int(value):
+        return str(int(value)).encode()  # Lua numbers are floats, Redis converts the integral ones without a fraction
+    return _encode(value)
+
+
+def _flatten(pairs: List[Tuple[Any, Any]]) -> List[Any]:
+    return [item for pair in pairs for item in pair]
+
+
+def _score(score: float) -> bytes:
+    return str(int(score)).encode() if score == int(score) else repr(score).encode()
+
+
+def _lua_xadd(server: FakeRedisServer, name: bytes, *args: bytes) -> bytes:
+    maxlen = None
+    if args[0].upper() == b"MAXLEN":
+        args = args[2:] if args[1] in (b"~", b"=") else args[1:]
+        maxlen, args = int(args[0]), args[1:]
+    if args[0] != b"*":
+        raise ResponseError("ERR syntax error (only XADD key [MAXLEN [~] count] * field value ... is supported by the stand-in)")
+    return server.cmd_xadd(name, dict(zip(args[1::2], args[2::2])), maxlen=maxlen)
+
+
+def _lua_xrevrange(server: FakeRedisServer, name: bytes, max: bytes, min: bytes, *options: bytes) -> List[Any]:
+    count = int(options[1]) if options and options[0].upper() == b"COUNT" else None
+    return [[stream_id, _flatten(list(fields.items()))] for stream_id, fields in server.cmd_xrevrange(name, _decode(max), _decode(min), count)]
+
+
+def _lua_set(server: FakeRedisServer, name: bytes, value: bytes, *options: bytes) -> Dict[str, str]:
+    ex = None
+    if options:
+        if len(options) != 2 or options[0].upper() != b"EX":
+            raise ResponseError("ERR syntax error (only SET key value [EX seconds] is supported by the stand-in)")
+        ex = int(options[1])
+    server.cmd_set(name, value, ex=ex)
+    return {"ok": "OK"}
+
+
+_LUA_COMMANDS: Dict[str, Callable[..., Any]] = {
+    "TIME": lambda server: [str(part).encode() for part in server.cmd_time()],
+    "EXISTS": lambda server, *names: server.cmd_exists(*names),
+    "DEL": lambda server, *names: server.cmd_delete(*names),
+    "EXPIRE": lambda server, name, seconds: int(server.cmd_expire(name, int(seconds))),
+    "GET": lambda server, name: server.cmd_get(name),
+    "SET": _lua_set,
+    "HGET": lambda server, name, key: server.cmd_hget(name, key),
+    "HMGET": lambda server, name, *keys: server.cmd_hmget(name, list(keys)),
+    "HGETALL": lambda server, name: _flatten(list(server.cmd_hgetall(name).items())),
+    "HEXISTS": lambda server, name, key: int(server.cmd_hget(name, key) is not None),
+    "HSET": lambda server, name, *items: server.cmd_hset(name, mapping=dict(zip(items[::2], items[1::2]))),
+    "HDEL": lambda server, name, *keys: server.cmd_hdel(name, *keys),
+    "ZADD": lambda server, name, *items: server.cmd_zadd(name, {member: float(score) for score, member in zip(items[::2], items[1::2])}),
+    "XADD": _lua_xadd,
+    "XREVRANGE": _lua_xrevrange,
+    "ZPOPMIN": lambda server, name, count=b"1": _flatten([(member, _score(score)) for member, score in server.cmd_zpopmin(name, int(count))]),
+}
+
+# The commands that don't take a key, and the ones that all their arguments are keys (the others take a key first)
+_LUA_KEYLESS_COMMANDS = {"TIME"}
+_LUA_ALL_KEYS_COMMANDS = {"DEL", "EXISTS"}
+
+
+class _LuaScripts:
+    def __init__(self, server: FakeRedisServer):
+        self._server = server
+        self._lua = LuaRuntime(encoding=None)  # the Lua strings are bytes, like in Redis
+        self._lua.globals().redis = self._lua.table_from({b"call": self._redis_call})
+        self._compiled: Dict[str, Any] = {}
+        self._keys: Set[bytes] = set()  # the KEYS of the running script
+
+    def _to_lua(self, value: Any) -> Any:
+        if value is None:
+            return False
+        if isinstance(value, dict):  # a status reply
+            return self._lua.table_from({_encode(k): _encode(v) for k, v in value.items()})
+        if isinstance(value, list):
+            return self._lua.table_from([self._to_lua(v) for v in value])
+        return value
+
+    def _from_lua(self, value: Any) -> Any:
+        if value is None or value is False:
+            return None
+        if value is True:
+            return 1
+        if isinstance(value, (int, float)):
+            return int(value)
+        if lua_type(value) == "table":
+            if value[b"err"] is not None:
+                raise ResponseError(_decode(value[b"err"]))
+            if value[b"ok"] is not None:
+                return value[b"ok"]
+            items = []
+            for i in range(1, len(value) + 1):
+                if value[i] is None:
+                    break
+                items.append(self._from_lua(value[i]))
+            return items
+        return value
+
+    def _redis_call(self, command: bytes, *args: Any) -> Any:
+        name = _decode(command).upper()
+        implementation = _LUA_COMMANDS.get(name)
+        if implementation is None:
+            raise ResponseError(f"ERR command {_decode(command)} is not supported by the stand-in in scripts (see _LUA_COMMANDS)")
+        # A script may access only the keys it was given in KEYS, Redis Cluster routes the script by them
+        keys = [] if name in _LUA_KEYLESS_COMMANDS else args if name in _LUA_ALL_KEYS_COMMANDS else args[:1]
+        undeclared = [_decode(_lua_arg(key)) for key in keys if _lua_arg(key) not in self._keys]
+        if undeclared:
+            raise ResponseError(f"ERR Script attempted to access keys that are not in KEYS: {undeclared}")
+        return self._to_lua(implementation(self._server, *[_lua_arg(arg) for arg in args]))
+
+    def run(self, script: str, keys: List[Any], args: List[Any]) -> Any:
+        function = self._compiled.get(script)
+        if function is None:
+            # KEYS and ARGV are the function's arguments instead of globals, so the compiled script can be reused
+            function = self._compiled[script] = self._lua.eval(f"function(KEYS, ARGV)\n{script}\nend")
+        self._keys = {_encode(k) for k in keys}
+        try:
+            result = function(self._lua.table_from([_encode(k) for k in keys]), self._lua.table_from([_encode(a) for a in args]))
+        except LuaError as e:
+            raise ResponseError(f"ERR Error running script: {e}") from e
+        return self._from_lua(result)
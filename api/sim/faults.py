@@ -0,0 +1,108 @@
+import math
+import random
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Type
+
+
+# Latency of one round trip to a backend: log-normal with the given median and p99 (constant when p99 is not given),
+# plus rare spikes (e.g. a GC pause or a slow disk), so the tail can be modeled separately from the typical latency
+class LatencyModel:
+    _Z_99 = 2.326  # the 99th percentile of the standard normal distribution
+
+    def __init__(self, median_ms: float = 0.0, p99_ms: Optional[float] = None, spike_rate: float = 0.0, spike_ms: float = 0.0):
+        if p99_ms is not None and median_ms > 0 and p99_ms < median_ms:
+            raise ValueError("p99_ms should be at least median_ms")
+        self.median_ms = median_ms
+        self.p99_ms = p99_ms
+        self.spike_rate = spike_rate
+        self.spike_ms = spike_ms
+        self._mu = math.log(median_ms) if median_ms > 0 else None
+        self._sigma = (math.log(p99_ms) - self._mu) / self._Z_99 if p99_ms is not None and self._mu is not None else 0.0
+
+    def sample(self, rng: random.Random) -> float:
+        """Returns the latency in seconds"""
+        latency_ms = rng.lognormvariate(self._mu, self._sigma) if self._mu is not None else 0.0
+        if self.spike_rate and rng.random() < self.spike_rate:
+            latency_ms += self.spike_ms
+        return latency_ms / 1000
+
+    @classmethod
+    def from_dict(cls, conf: Dict[str, Any]) -> "LatencyModel":
+        return cls(conf.get("median_ms", 0.0), conf.get("p99_ms"), conf.get("spike_rate", 0.0), conf.get("spike_ms", 0.0))
+
+
+# The faults of one backend (see FakeRedis and FakeMongoClient), applied on each round trip:
+# a latency from the latency model, failures at error_rate (the backend client's connection error),
+# and partitions, during which the calls hang for timeout_seconds and then fail with the client's timeout error.
+# Partitions are given as (start, end) seconds since start() was called, or turned on and off with partition()/heal().
+# The random choices of each call come from a generator seeded by the seed and the call's number (the backend's n-th call),
+# so the same seed gives the same sequence of latencies and failures. When the calls are made from many threads at once,
+# which request makes the n-th call depends on the threads scheduling, so across such runs only the distribution is reproducible
+class BackendFaults:
+    def __init__(
+            self,
+            latency: Optional[LatencyModel] = None,
+            error_rate: float = 0.0,
+            partitions: Iterable[Tuple[float, float]] = (),
+            timeout_seconds: float = 1.0,
+            seed: int = 0
+    ):
+        self.latency = latency or LatencyModel()
+        self.error_rate = error_rate
+        self.partitions: List[Tuple[float, float]] = [tuple(p) for p in partitions]
+        self.timeout_seconds = timeout_seconds
+        self.started_at = time.monotonic()
+        self.partitioned = False
+        self.stats = {"calls": 0, "errors": 0, "timeouts": 0}
+        self.seed = seed
+        self._lock = threading.Lock()  # the backends are called from the executor threads
+
+    @classmethod
+    def from_dict(cls, conf: Dict[str, Any], seed: int = 0) -> "BackendFaults":
+        return cls(
+            latency=LatencyModel.from_dict(conf.get("latency", {})),
+            error_rate=conf.get("error_rate", 0.0),
+            partitions=conf.get("partitions", ()),
+            timeout_seconds=conf.get("timeout_seconds", 1.0),
+            seed=conf.get("seed", seed)
+        )
+
+    def start(self) -> None:
+        """The partitions times are counted from now"""
+        self.started_at = time.monotonic()
+
+    def partition(self) -> None:
+        self.partitioned = True
+
+    def heal(self) -> None:
+        self.partitioned = False
+
+    def in_partition(self) -> bool:
+        if self.partitioned:
+            return True
+        elapsed = time.monotonic() - self.started_at
+        return any(start <= elapsed < end for start, end in self.partitions)
+
+    def call_rng(self, call_number: int) -> random.Random:
+        return random.Random(hash((self.seed, call_number)))
+
+    def before_call(self, error: Type[Exception], timeout_error: Type[Exception]) -> None:
+        """Called before each round trip, sleeps for its latency and raises its failure"""
+        with self._lock:
+            self.stats["calls"] += 1
+            partitioned = self.in_partition()
+            rng = self.call_rng(self.stats["calls"])
+            latency = self.latency.sample(rng)
+            failed = self.error_rate > 0 and rng.random() < self.error_rate
+            if partitioned:
+                self.stats["timeouts"] += 1
+            elif failed:
+                self.stats["errors"] += 1
+        if partitioned:
+            time.sleep(self.timeout_seconds)
+            raise timeout_error("Timeout (injected partition)")
+        if latency:
+            time.sleep(latency)
+        if failed:
+            raise error("Connection error (injected)")
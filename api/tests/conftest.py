@@ -3,6 +3,7 @@ from aiohttp.test_utils import TestClient
 from pytest_aiohttp.plugin import AiohttpClient
 
 from api.main import app_factory
+from api.sim import stand_in_backends
 
 
 def pytest_configure() -> None:
@@ -10,7 +11,8 @@ def pytest_configure() -> None:
 
 
 @pytest_asyncio.fixture
-async def api_client(aiohttp_client: AiohttpClient, loop) -> TestClient:
-    app = await app_factory()
+async def api_client(aiohttp_client: AiohttpClient) -> TestClient:
+    # in-process MongoDB and Redis (see api.sim), without the binary protocol listener
+    app = await app_factory(backends=stand_in_backends(), binary_port=None)
     client = await aiohttp_client(app)
     return client
@@ -0,0 +1,138 @@
+import asyncio
+import time
+
+import pytest
+
+from api.common.admission import (
+    AUTHORIZATION,
+    READ,
+    WRITE,
+    AdmissionController,
+    RateLimiter,
+)
+from api.common.exceptions import OverloadedError, RateLimitedError
+from api.sim import BackendFaults, FakeRedis
+
+
+@pytest.mark.asyncio
+async def test_admission_limits_concurrency():
+    controller = AdmissionController(max_concurrency=2, max_write_concurrency=1, queue_timeout_seconds=0.01, max_queue_size=10)
+    await controller.acquire(AUTHORIZATION)
+    await controller.acquire(WRITE)
+    assert controller.in_flight == 2
+
+    with pytest.raises(OverloadedError):
+        await controller.acquire(AUTHORIZATION)
+    assert controller.queued == 0
+    assert controller.rejected == 1
+
+    controller.release(WRITE)
+    await controller.acquire(READ)
+    # the write slots are limited even when there are free slots
+    controller.release(READ)
+    await controller.acquire(WRITE)
+    with pytest.raises(OverloadedError):
+        await controller.acquire(WRITE)
+
+
+@pytest.mark.asyncio
+async def test_admission_prefers_authorization_requests():
+    controller = AdmissionController(max_concurrency=1, max_write_concurrency=1, queue_timeout_seconds=1, max_queue_size=10)
+    await controller.acquire(READ)
+
+    admitted = []
+
+    async def request(priority: int):
+        await controller.acquire(priority)
+        admitted.append(priority)
+
+    tasks = [asyncio.create_task(request(priority)) for priority in (WRITE, READ, AUTHORIZATION)]
+    await asyncio.sleep(0)
+    assert controller.queued == 3
+
+    for _ in range(3):
+        controller.release(admitted[-1] if admitted else READ)
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    assert admitted == [AUTHORIZATION, READ, WRITE]
+
+
+@pytest.mark.asyncio
+async def test_admission_rejects_when_queue_is_full():
+    controller = AdmissionController(max_concurrency=1, max_write_concurrency=1, queue_timeout_seconds=1, max_queue_size=1)
+    await controller.acquire(READ)
+    waiting = asyncio.create_task(controller.acquire(READ))
+    await asyncio.sleep(0)
+    with pytest.raises(OverloadedError):
+        await controller.acquire(READ)
+
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert controller.queued == 0
+    assert controller.in_flight == 1
+
+
+class _Request(dict):
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self.headers = {"X-Client-Id": "client"}
+        self.remote = None
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_fails_open_when_redis_is_slow():
+    redis = FakeRedis(decode_responses=True)
+    request = _Request({"redis": redis})
+    limiter = RateLimiter(rate_per_second=1, burst=1, timeout_seconds=0.05)
+    await limiter.check(request)
+    with pytest.raises(RateLimitedError):
+        await limiter.check(request)
+
+    redis.server.faults = BackendFaults(timeout_seconds=0.5)
+    redis.server.faults.partition()
+    started = time.monotonic()
+    await limiter.check(request)  # admitted without waiting for Redis
+    assert time.monotonic() - started < 0.3
+
+
+@pytest.mark.asyncio
+async def test_writes_dont_block_the_event_loop(api_client):
+    faults = api_client.app["mongodb"].faults = BackendFaults(timeout_seconds=0.3)
+    faults.partition()
+    write = asyncio.create_task(api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"}))
+    # the loop keeps running (e.g. the admission queue timeouts) while the write waits for MongoDB
+    ticks = 0
+    while not write.done():
+        await asyncio.sleep(0.01)
+        ticks += 1
+    assert (await write).status == 500
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_reads_dont_block_the_event_loop(api_client):
+    faults = api_client.app["mongodb"].faults = BackendFaults(timeout_seconds=0.3)
+    faults.partition()
+    read = asyncio.create_task(api_client.get("/users/65b26f8cbd9ef108620e18f8"))
+    ticks = 0
+    while not read.done():
+        await asyncio.sleep(0.01)
+        ticks += 1
+    assert (await read).status == 500
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_checks_dont_pile_up_while_redis_is_slow():
+    redis = FakeRedis(decode_responses=True)
+    redis.server.faults = BackendFaults(timeout_seconds=0.3)
+    redis.server.faults.partition()
+    limiter = RateLimiter(rate_per_second=1, burst=1, timeout_seconds=0.01, max_checks=2)
+    for _ in range(10):
+        await limiter.check(_Request({"redis": redis}))
+    # the checks that timed out hold their threads, the rest are skipped instead of queued
+    assert limiter.checks_in_flight == 2
+    await asyncio.sleep(0.4)
+    assert limiter.checks_in_flight == 0
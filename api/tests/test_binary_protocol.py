@@ -0,0 +1,123 @@
+import asyncio
+from functools import partial
+
+import pytest
+from bson import ObjectId
+
+from api.common.admission import AdmissionController
+from api.common.binary_protocol import (
+    ALLOWED,
+    BAD_REQUEST,
+    BATCH,
+    CHECK,
+    DENIED,
+    ERROR,
+    FRAME_HEADER_SIZE,
+    NOT_FOUND,
+    BinaryClient,
+    ProtocolError,
+    decode_request,
+    decode_response,
+    encode_batch_request,
+    encode_check_request,
+    encode_error,
+    encode_response,
+)
+from api.common.coalescing import BatchLoader
+from api.common.decision import compile_policy
+from api.handlers.binary_handler import handle_connection
+
+user_id, young_user_id, resource_id, policy_id = ObjectId(), ObjectId(), ObjectId(), ObjectId()
+
+
+def test_requests_round_trip():
+    frame = encode_check_request(7, user_id, resource_id)
+    assert len(frame) == FRAME_HEADER_SIZE + 5 + 24
+    assert decode_request(frame[FRAME_HEADER_SIZE:]) == (CHECK, 7, [(user_id, resource_id)])
+
+    pairs = [(user_id, resource_id), (young_user_id, resource_id)]
+    frame = encode_batch_request(8, pairs)
+    assert decode_request(frame[FRAME_HEADER_SIZE:]) == (BATCH, 8, pairs)
+
+
+def test_responses_round_trip():
+    assert decode_response(encode_response(CHECK, 1, [ALLOWED])[FRAME_HEADER_SIZE:]) == (CHECK, 1, [ALLOWED], "")
+    assert decode_response(encode_response(BATCH, 2, [ALLOWED, DENIED])[FRAME_HEADER_SIZE:]) == (BATCH, 2, [ALLOWED, DENIED], "")
+    _, request_id, [status], message = decode_response(encode_error(3, NOT_FOUND, "oops")[FRAME_HEADER_SIZE:])
+    assert (request_id, status, message) == (3, NOT_FOUND, "oops")
+
+
+def test_malformed_requests():
+    frame = encode_check_request(1, user_id, resource_id)
+    with pytest.raises(ProtocolError):
+        decode_request(frame[FRAME_HEADER_SIZE:-1])
+    with pytest.raises(ProtocolError):
+        decode_request(b"\x09" + frame[FRAME_HEADER_SIZE + 1:])
+    with pytest.raises(ProtocolError):
+        encode_batch_request(1, [(user_id, resource_id)] * 1001)
+
+
+def _app() -> dict:
+    policies = {policy_id: compile_policy([{"attribute_name": "age", "operator": ">", "value": 30}])}
+    users = {("default", user_id): {"age": 31}, ("default", young_user_id): {"age": 20}, ("acme", user_id): {"age": 20}}
+    return {
+        "admission": AdmissionController(),
+        "users_loader": BatchLoader(lambda keys: {k: users[k] for k in keys if k in users}),
+        "resources_loader": BatchLoader(lambda keys: {k: [policy_id] for k in keys if k[1] == resource_id}),
+        "signatures_loader": BatchLoader(lambda keys: {k: policies[k[1]]["signature"] for k in keys if k[1] in policies}),
+        "conditions_loader": BatchLoader(lambda keys: {k: policies[k[1]]["conditions"] for k in keys if k[1] in policies}),
+    }
+
+
+@pytest.mark.asyncio
+async def test_checks_over_one_connection():
+    server = await asyncio.start_server(partial(handle_connection, _app()), host="127.0.0.1", port=0)
+    client = BinaryClient("127.0.0.1", server.sockets[0].getsockname()[1])
+    await client.connect()
+    try:
+        # many checks in flight over the same connection
+        statuses = await asyncio.gather(*(client.check(u, resource_id) for u in [user_id, young_user_id] * 50))
+        assert statuses == [ALLOWED, DENIED] * 50
+        assert await client.check_many([(user_id, resource_id), (young_user_id, resource_id), (user_id, ObjectId())]) == [ALLOWED, DENIED, NOT_FOUND]
+    finally:
+        await client.close()
+
+    # the same user id is another user in another tenant
+    tenant_client = BinaryClient("127.0.0.1", server.sockets[0].getsockname()[1], tenant="acme")
+    await tenant_client.connect()
+    try:
+        assert await tenant_client.check(user_id, resource_id) == DENIED
+        assert await tenant_client.check(young_user_id, resource_id) == NOT_FOUND
+    finally:
+        await tenant_client.close()
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_malformed_requests_are_answered_with_their_request_id():
+    server = await asyncio.start_server(partial(handle_connection, _app()), host="127.0.0.1", port=0)
+    reader, writer = await asyncio.open_connection("127.0.0.1", server.sockets[0].getsockname()[1])
+
+    async def read_response():
+        length = int.from_bytes(await reader.readexactly(FRAME_HEADER_SIZE), "big")
+        return decode_response(await reader.readexactly(length))
+
+    try:
+        frame = encode_check_request(42, user_id, resource_id)
+        truncated = (len(frame) - FRAME_HEADER_SIZE - 1).to_bytes(FRAME_HEADER_SIZE, "big") + frame[FRAME_HEADER_SIZE:-1]
+        writer.write(truncated)
+        assert (await read_response())[:3] == (ERROR, 42, [BAD_REQUEST])
+
+        # the connection is still usable
+        writer.write(encode_check_request(43, user_id, resource_id))
+        assert await read_response() == (CHECK, 43, [ALLOWED], "")
+
+        # a frame without a request id can't be answered, the connection is closed
+        writer.write((2).to_bytes(FRAME_HEADER_SIZE, "big") + b"\x01\x00")
+        assert (await read_response())[:3] == (ERROR, 0, [BAD_REQUEST])
+        assert await reader.read() == b""
+    finally:
+        writer.close()
+        server.close()
+        await server.wait_closed()
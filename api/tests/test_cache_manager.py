@@ -0,0 +1,117 @@
+import time
+
+from bson import ObjectId
+
+from api.common.cache_manager import (
+    LocalLRUCache,
+    ResourcePoliciesCacheLoader,
+    UserAttributesCacheLoader,
+)
+from api.common.configs import RESOURCES_COL, USERS_COL
+from api.common.tenants import default_tenant
+from api.sim import FakeMongoClient, FakeRedis
+
+
+def test_local_lru_cache_evicts_least_recently_used() -> None:
+    cache = LocalLRUCache(max_size=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_local_lru_cache_expires() -> None:
+    cache = LocalLRUCache(max_size=2, ttl_seconds=0)
+    cache.set("a", 1)
+    time.sleep(0.001)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_local_lru_cache_disabled() -> None:
+    cache = LocalLRUCache(max_size=0, ttl_seconds=60)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_user_attributes_encoding_keeps_types() -> None:
+    attributes = {"age": 30, "is_manager": False, "name": "John", "title": "30"}
+    encoded = UserAttributesCacheLoader.encode(attributes)
+    assert all(type(v) is str for v in encoded.values())
+    assert UserAttributesCacheLoader.decode(encoded) == attributes
+
+
+def test_resource_policy_ids_packing() -> None:
+    policy_ids = [ObjectId(), ObjectId(), ObjectId()]
+    packed = ResourcePoliciesCacheLoader.pack(policy_ids)
+    assert len(packed) == 12 * len(policy_ids)
+    assert ResourcePoliciesCacheLoader.unpack(packed) == policy_ids
+    assert ResourcePoliciesCacheLoader.unpack(ResourcePoliciesCacheLoader.pack([])) == []
+    # the cached value starts with the revision it reflects
+    encoded = ResourcePoliciesCacheLoader.encode({"policy_ids": policy_ids, "revision": 3})
+    assert encoded[:8] == (3).to_bytes(8, "big")
+    assert ResourcePoliciesCacheLoader.decode(encoded) == policy_ids
+
+
+class _Request(dict):
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+
+def test_users_cache_never_goes_back_to_an_older_revision() -> None:
+    app = {"redis": FakeRedis(decode_responses=True), "mongodb": FakeMongoClient()}
+    request = _Request(app)
+    users = UserAttributesCacheLoader(local_cache_size=0)
+    user_id = app["mongodb"][default_tenant.db_name][USERS_COL].insert_one({"attributes": {"age": 30, "title": "dev"}}).inserted_id
+    key = users.build_key(default_tenant, user_id)
+
+    # a reader loaded revision 0, then an update of revision 1 was written before the reader filled the cache
+    stale = app["mongodb"][default_tenant.db_name][USERS_COL].find_one({"_id": user_id}, {"attributes": 1, "revision": 1})
+    app["mongodb"][default_tenant.db_name][USERS_COL].update_one({"_id": user_id}, {"$set": {"attributes.age": 31}, "$inc": {"revision": 1}})
+    users.set_attribute(request, user_id, 1, "age", 31)
+    users._fill_many(app, default_tenant, {user_id: stale})
+    assert users.FILLED_FIELD not in app["redis"].hgetall(key)
+    assert users.get_many(app, default_tenant, [user_id]) == {user_id: {"age": 31, "title": "dev"}}
+
+    # the next revisions are applied on the cached user
+    users.delete_attribute(request, user_id, 2, "title")
+    assert users.get_many(app, default_tenant, [user_id]) == {user_id: {"age": 31}}
+    users.override(request, user_id, 3, {})
+    assert users.get_many(app, default_tenant, [user_id]) == {user_id: {}}
+
+    # an update that isn't the next revision (revision 4 wasn't applied yet) leaves the user uncached
+    users.set_attribute(request, user_id, 5, "age", 33)
+    users.set_attribute(request, user_id, 4, "age", 32)
+    assert app["redis"].hgetall(key) == {users.REVISION_FIELD: "5"}
+
+
+def test_resources_cache_never_goes_back_to_an_older_revision() -> None:
+    app = {"redis": FakeRedis(decode_responses=True), "mongodb": FakeMongoClient()}
+    app["redis_bytes"] = FakeRedis(app["redis"].server)
+    request = _Request(app)
+    resources = ResourcePoliciesCacheLoader()
+    resources_col = app["mongodb"][default_tenant.db_name][RESOURCES_COL]
+    old_policy_id, new_policy_id = ObjectId(), ObjectId()
+    resource_id = resources_col.insert_one({"policy_ids": [old_policy_id], "revision": 1}).inserted_id
+
+    # a reader loaded revision 1, then a write of revision 2 was cached before the reader filled the cache
+    stale = resources_col.find_one({"_id": resource_id}, {"policy_ids": 1, "revision": 1})
+    resources_col.update_one({"_id": resource_id}, {"$set": {"policy_ids": [new_policy_id]}, "$inc": {"revision": 1}})
+    resources.set(request, resource_id, 2, [new_policy_id])
+    resources._fill_many(app, default_tenant, {resource_id: stale})
+    assert resources.get_many(app, default_tenant, [resource_id]) == {resource_id: [new_policy_id]}
+
+    # writes that are cached out of order keep the newest one
+    resources.set(request, resource_id, 4, [old_policy_id])
+    resources.set(request, resource_id, 3, [new_policy_id])
+    assert resources.get_many(app, default_tenant, [resource_id]) == {resource_id: [old_policy_id]}
+
+    # resources that were written before the revisions were added are filled with revision 0
+    legacy_id = resources_col.insert_one({"policy_ids": [old_policy_id]}).inserted_id
+    assert resources.get_many(app, default_tenant, [legacy_id]) == {legacy_id: [old_policy_id]}
+    resources.set(request, legacy_id, 1, [new_policy_id])
+    assert resources.get_many(app, default_tenant, [legacy_id]) == {legacy_id: [new_policy_id]}
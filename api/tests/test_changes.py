@@ -0,0 +1,144 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+from marshmallow import ValidationError
+
+from api.common.changes import INSERT, UPDATE, ChangeLog
+from api.common.configs import CHANGES_COL, CHANGES_MAX_LONG_POLLS
+from api.common.tenants import default_tenant
+from api.common.versions import new_version
+from api.sim import BackendFaults, FakeMongoClient, FakeRedis
+
+
+class _Request(dict):
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+
+def _app() -> dict:
+    return {"redis": FakeRedis(decode_responses=True), "mongodb": FakeMongoClient()}
+
+
+def _write(change_log: ChangeLog, app: dict, entity: str, entity_id, operation: str, set_fields=None, unset_fields=None) -> int:
+    """Like the write handlers: the change is recorded in the write's version block, and relayed after it"""
+    request = _Request(app)
+    with new_version(request) as version:
+        change_log.record(request, entity, entity_id, version, operation, set_fields, unset_fields)
+    change_log.publish(request)
+    return version
+
+
+def _versions(change_log: ChangeLog, app: dict, since: str = "0-0") -> list:
+    return [change["version"] for change in change_log.read(app["redis"], default_tenant, since, 10, None)["changes"]]
+
+
+def test_publish_and_read():
+    app = _app()
+    change_log = ChangeLog()
+    policy_id = ObjectId()
+    _write(change_log, app, "resource", "r1", INSERT, {"policy_ids": [policy_id]})
+    _write(change_log, app, "user", "u1", UPDATE, unset_fields=["attributes.age"])
+
+    result = change_log.read(app["redis"], default_tenant, "0-0", 10, None)
+    ids = [change.pop("id") for change in result["changes"]]
+    assert result["next"] == ids[-1]
+    assert not result["truncated"]
+    assert result["changes"] == [
+        {"entity": "resource", "entity_id": "r1", "version": 1, "op": INSERT, "set": {"policy_ids": [str(policy_id)]}, "unset": []},
+        {"entity": "user", "entity_id": "u1", "version": 2, "op": UPDATE, "set": {}, "unset": ["attributes.age"]},
+    ]
+    # the relayed changes are removed from the outbox
+    assert app["mongodb"][default_tenant.db_name][CHANGES_COL].count_documents({}) == 0
+
+    # polling from the last change, with nothing new
+    assert change_log.read(app["redis"], default_tenant, result["next"], 10, None) == {"changes": [], "next": ids[-1], "truncated": False}
+
+
+def test_read_after_trimmed_changes():
+    app = _app()
+    change_log = ChangeLog(max_len=2)
+    ids = []
+    for age in range(1, 5):
+        _write(change_log, app, "user", "u1", UPDATE, {"attributes.age": age})
+        ids.append(app["redis"].xrevrange(change_log.build_key(default_tenant), count=1)[0][0])
+
+    result = change_log.read(app["redis"], default_tenant, ids[0], 10, None)
+    assert result["truncated"]
+    assert [change["version"] for change in result["changes"]] == [3, 4]
+
+    # read up to the change right before the first retained one, nothing was missed
+    result = change_log.read(app["redis"], default_tenant, ids[1], 10, None)
+    assert not result["truncated"]
+    assert [change["version"] for change in result["changes"]] == [3, 4]
+
+
+def test_changes_are_relayed_in_versions_order():
+    app = _app()
+    change_log = ChangeLog()
+    request = _Request(app)
+    with new_version(request) as first:
+        # a write with a higher version that's done first isn't relayed before the pending one
+        second = _write(change_log, app, "user", "u2", INSERT, {"attributes": {}})
+        assert _versions(change_log, app) == []
+        assert default_tenant.name in change_log.unrelayed
+        change_log.record(request, "user", "u1", first, INSERT, {"attributes": {}})
+    change_log.publish(request)
+    assert _versions(change_log, app) == [first, second]
+    assert not change_log.unrelayed
+
+    # a change that's relayed again (e.g. the relay failed before removing it from the outbox) isn't duplicated
+    change_log.record(request, "user", "u1", first, INSERT, {"attributes": {}})
+    change_log.publish(request)
+    assert _versions(change_log, app) == [first, second]
+
+
+def test_changes_are_kept_while_redis_is_down():
+    app = _app()
+    change_log = ChangeLog()
+    faults = app["redis"].server.faults = BackendFaults(timeout_seconds=0.01)
+    faults.partition()
+    # the write doesn't fail on the changes log
+    version = _write(change_log, app, "user", "u1", INSERT, {"attributes": {}})
+    assert default_tenant.name in change_log.unrelayed
+
+    faults.heal()
+    change_log.try_relay(app, default_tenant)
+    assert _versions(change_log, app) == [version]
+    assert not change_log.unrelayed
+
+
+@pytest.mark.asyncio
+async def test_writes_changes_are_read(api_client):
+    await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"})
+    user = await (await api_client.post("/users", json={"attributes": {"age": 30}})).json()
+    await api_client.patch(f"/users/{user['user_id']}/attributes/age", json={"attribute_value": 31})
+
+    result = await (await api_client.get("/changes", params={"wait": "0"})).json()
+    assert [(change["entity"], change["set"]) for change in result["changes"]] == [
+        ("attribute", {"attribute_type": "integer"}), ("user", {"attributes": {"age": 30}}), ("user", {"attributes.age": 31})
+    ]
+
+
+def test_read_invalid_change_id():
+    with pytest.raises(ValidationError):
+        ChangeLog().read(FakeRedis(decode_responses=True), default_tenant, "abc", 10, None)
+
+
+@pytest.mark.asyncio
+async def test_long_polls_dont_take_admission_slots(api_client):
+    controller = api_client.app["admission"]
+    controller.max_concurrency, controller.queue_timeout_seconds = 1, 0.01
+    poll = asyncio.create_task(api_client.get("/changes", params={"wait": "0.3"}))
+    await asyncio.sleep(0.05)
+    assert not poll.done()
+    # admitted while the long poll waits
+    assert (await api_client.get("/attributes/age")).status == 404
+    assert (await poll).status == 200
+
+    # the polls above their own limit are rejected
+    long_polls = api_client.app["changes_long_polls"]
+    for _ in range(CHANGES_MAX_LONG_POLLS):
+        await long_polls.acquire()
+    assert (await api_client.get("/changes", params={"wait": "0"})).status == 503
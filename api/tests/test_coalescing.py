@@ -0,0 +1,58 @@
+import asyncio
+from typing import Dict, List
+
+import pytest
+
+from api.common.coalescing import BatchLoader
+
+
+class RecordingBatchFn:
+    def __init__(self):
+        self.batches: List[List[str]] = []
+
+    def __call__(self, keys: List[str]) -> Dict[str, str]:
+        self.batches.append(list(keys))
+        return {key: key.upper() for key in keys if key != "missing"}
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_coalesces_identical_keys():
+    batch_fn = RecordingBatchFn()
+    loader = BatchLoader(batch_fn, window_seconds=0.01, max_batch_size=100)
+    results = await asyncio.gather(*(loader.load("a") for _ in range(10)))
+    assert results == ["A"] * 10
+    assert batch_fn.batches == [["a"]]
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_batches_distinct_keys():
+    batch_fn = RecordingBatchFn()
+    loader = BatchLoader(batch_fn, window_seconds=0.01, max_batch_size=2)
+    results = await asyncio.gather(loader.load("a"), loader.load("b"), loader.load("c"), loader.load("missing"))
+    assert results == ["A", "B", "C", None]
+    assert batch_fn.batches == [["a", "b"], ["c", "missing"]]
+
+    # a key is read again once its batch was resolved
+    assert await loader.load("a") == "A"
+    assert batch_fn.batches[-1] == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_propagates_errors():
+    def failing_batch_fn(keys: List[str]) -> Dict[str, str]:
+        raise ConnectionError("backend is down")
+
+    loader = BatchLoader(failing_batch_fn, window_seconds=0.001)
+    results = await asyncio.gather(loader.load("a"), loader.load("b"), return_exceptions=True)
+    assert all(isinstance(res, ConnectionError) for res in results)
+
+
+@pytest.mark.asyncio
+async def test_batch_loader_reads_right_away_when_idle():
+    batch_fn = RecordingBatchFn()
+    # a window that would time out the test if the first read waited for it
+    loader = BatchLoader(batch_fn, window_seconds=60)
+    assert await asyncio.wait_for(loader.load("a"), 1) == "A"
+    # the keys of the same loop iteration are still read together
+    assert await asyncio.wait_for(loader.load_many(["b", "c"]), 1) == ["B", "C"]
+    assert batch_fn.batches == [["a"], ["b", "c"]]
@@ -0,0 +1,43 @@
+from api.common.health import BackendsMonitor
+
+
+class _Mongo:
+    def __init__(self, ok: bool):
+        self.ok = ok
+        self.admin = self
+
+    def command(self, name: str):
+        if not self.ok:
+            raise ConnectionError("mongodb is down")
+        return {"ok": 1}
+
+
+class _Redis:
+    def ping(self):
+        return True
+
+    def exists(self, key: str) -> int:
+        return 1
+
+
+def test_backends_monitor_ready():
+    monitor = BackendsMonitor(interval_seconds=1, stale_seconds=60)
+    assert not monitor.ready  # nothing was checked yet
+
+    monitor.check_once({"mongodb": _Mongo(ok=True), "redis": _Redis()})
+    assert monitor.ready
+    assert monitor.attributes_cache_loaded
+
+
+def test_backends_monitor_backend_down():
+    monitor = BackendsMonitor(interval_seconds=1, stale_seconds=60)
+    monitor.check_once({"mongodb": _Mongo(ok=False), "redis": _Redis()})
+    assert not monitor.ready
+    assert monitor.backends["mongodb"].error == "mongodb is down"
+    assert monitor.backends["redis"].ok
+
+
+def test_backends_monitor_stale_status():
+    monitor = BackendsMonitor(interval_seconds=1, stale_seconds=0)
+    monitor.check_once({"mongodb": _Mongo(ok=True), "redis": _Redis()})
+    assert not monitor.ready
@@ -1,71 +1,169 @@
 from typing import Any, Dict, List
 
-from aiohttp import web
+import pytest
 from bson import ObjectId
 
-from api.common.cache_manager import ConditionsCacheLoader
-from api.common.utils import decide_if_authorized
+from api.common.coalescing import BatchLoader
+from api.common.configs import POLICIES_COL, RESOURCES_COL, USERS_COL
+from api.common.decision import (
+    PrefetchedConditionsCache,
+    build_policy_signature,
+    compile_policy,
+    decide_if_authorized,
+)
+from api.common.exceptions import NotFoundError
+from api.common.tenants import by_tenant, default_tenant, get_tenant
+from api.common.trace import DecisionTrace
+from api.handlers.is_authorized_handler import authorize
+from api.sim import stand_in_backends
 
-mocked_request = object()
 age_policy = ObjectId()
 age_and_is_manager_policy = ObjectId()
 john_is_manager_policy = ObjectId()
 
+policies_conditions = {
+    age_policy: [
+        {
+            "attribute_name": "age",
+            "operator": ">",
+            "value": 30
+        }
+    ],
+    age_and_is_manager_policy: [
+        {
+            "attribute_name": "age",
+            "operator": "<",
+            "value": 50
+        },
+        {
+            "attribute_name": "is_manager",
+            "operator": "=",
+            "value": True
+        }
+    ],
+    john_is_manager_policy: [
+        {
+            "attribute_name": "is_manager",
+            "operator": "=",
+            "value": True
+        },
+        {
+            "attribute_name": "name",
+            "operator": "=",
+            "value": "John"
+        },
+    ]
+}
+policies = {policy_id: compile_policy(conditions) for policy_id, conditions in policies_conditions.items()}
 
-class MockedConditionCache(ConditionsCacheLoader):
-
-    def get(self, request: web.Request, policy_id: ObjectId) -> List[Dict[str, Any]]:
-        if policy_id == age_policy:
-            return [
-                {
-                    "attribute_name": "age",
-                    "operator": ">",
-                    "value": 30
-                }
-            ]
-        elif policy_id == age_and_is_manager_policy:
-            return [
-                {
-                    "attribute_name": "age",
-                    "operator": "<",
-                    "value": 50
-                },
-                {
-                    "attribute_name": "is_manager",
-                    "operator": "=",
-                    "value": True
-                }
-            ]
-        elif policy_id == john_is_manager_policy:
-            return [
-                {
-                    "attribute_name": "is_manager",
-                    "operator": "=",
-                    "value": True
-                },
-                {
-                    "attribute_name": "name",
-                    "operator": "=",
-                    "value": "John"
-                },
-            ]
-        else:
-            return []
-
-
-mocked_conditions_cache = MockedConditionCache()
+
+# Fails on any attempt to fetch the conditions, so we can tell that a policy was rejected by its signature
+class SignaturesOnlyConditionCache(PrefetchedConditionsCache):
+
+    def get_conditions(self, policy_ids: List[ObjectId]) -> Dict[ObjectId, List[Dict[str, Any]]]:
+        raise AssertionError(f"conditions of policies {policy_ids} were fetched")
+
+
+mocked_conditions_cache = PrefetchedConditionsCache(policies)
 
 
 def test_decide_if_authorized():
-    assert decide_if_authorized([age_policy], {"age": 31}, mocked_conditions_cache, mocked_request)
-    assert decide_if_authorized([age_and_is_manager_policy], {"age": 31, "is_manager": True}, mocked_conditions_cache, mocked_request)
-    assert decide_if_authorized([john_is_manager_policy, age_policy], {"age": 31, "is_manager": True, "name": "John"}, mocked_conditions_cache, mocked_request)
+    assert decide_if_authorized([age_policy], {"age": 31}, mocked_conditions_cache)
+    assert decide_if_authorized([age_and_is_manager_policy], {"age": 31, "is_manager": True}, mocked_conditions_cache)
+    assert decide_if_authorized([john_is_manager_policy, age_policy], {"age": 31, "is_manager": True, "name": "John"}, mocked_conditions_cache)
 
     # one of the policies are true
-    assert decide_if_authorized([age_policy, age_and_is_manager_policy], {"age": 51}, mocked_conditions_cache, mocked_request)
+    assert decide_if_authorized([age_policy, age_and_is_manager_policy], {"age": 51}, mocked_conditions_cache)
 
     # Condition attribute does not exist on user's attribute
-    assert not decide_if_authorized([age_policy], {"name": "John"}, mocked_conditions_cache, mocked_request)
+    assert not decide_if_authorized([age_policy], {"name": "John"}, mocked_conditions_cache)
 
     # all policies are false
-    assert not decide_if_authorized([john_is_manager_policy, age_policy], {"age": 10, "is_manager": False, "name": "John"}, mocked_conditions_cache, mocked_request)
+    assert not decide_if_authorized([john_is_manager_policy, age_policy], {"age": 10, "is_manager": False, "name": "John"}, mocked_conditions_cache)
+
+
+def test_decide_if_authorized_rejects_by_signature():
+    cache = SignaturesOnlyConditionCache(policies)
+    # missing attributes
+    assert not decide_if_authorized([john_is_manager_policy, age_and_is_manager_policy], {"age": 31}, cache)
+    # "=" conditions that can't hold
+    assert not decide_if_authorized([john_is_manager_policy, age_and_is_manager_policy], {"age": 31, "is_manager": False, "name": "John"}, cache)
+
+
+def test_build_policy_signature():
+    conditions = [
+        {"attribute_name": "age", "operator": ">", "value": 30},
+        {"attribute_name": "is_manager", "operator": "=", "value": True},
+        {"attribute_name": "age", "operator": "<", "value": 50},
+    ]
+    assert build_policy_signature(conditions) == {"attributes": ["age", "is_manager"], "equals": [["is_manager", True]]}
+    assert build_policy_signature([]) == {"attributes": [], "equals": []}
+
+
+@pytest.mark.asyncio
+async def test_explain_decision():
+    app = stand_in_backends()
+    db = default_tenant.db(app)
+    for policy_id, conditions in policies_conditions.items():
+        db[POLICIES_COL].insert_one({"_id": policy_id, "conditions": conditions})
+    user_id = db[USERS_COL].insert_one({"attributes": {"age": 31, "is_manager": True, "name": "Smith"}}).inserted_id
+    resource_id = db[RESOURCES_COL].insert_one({"policy_ids": [john_is_manager_policy, age_and_is_manager_policy]}).inserted_id
+
+    trace = DecisionTrace()
+    assert await authorize(app, default_tenant, user_id, resource_id, trace)
+    john_trace, age_and_is_manager_trace = trace.to_dict()["policies"]
+    assert john_trace["prefilter"] == "rejected"
+    assert not john_trace["passed"]
+    assert "conditions" not in john_trace  # rejected by its signature, so it wasn't fetched
+    assert age_and_is_manager_trace["prefilter"] == "passed"
+    assert age_and_is_manager_trace["passed"]
+    assert [c["result"] for c in age_and_is_manager_trace["conditions"]] == [True, True]
+    # the same reads as is_authorized, the conditions only of the policy that passed its signature
+    assert [(stage["name"], stage["source"]) for stage in trace.stages] == [
+        ("users", "mongodb"), ("resources", "mongodb"), ("signatures", "mongodb"), ("conditions", "redis")
+    ]
+    # per policy, the signatures were loaded from MongoDB (and cached with the conditions)
+    assert john_trace["sources"] == {"signature": "mongodb"}
+    assert age_and_is_manager_trace["sources"] == {"signature": "mongodb", "conditions": "redis"}
+
+    user_id = db[USERS_COL].insert_one({"attributes": {"age": 51, "is_manager": True}}).inserted_id
+    resource_id = db[RESOURCES_COL].insert_one({"policy_ids": [age_and_is_manager_policy]}).inserted_id
+    trace = DecisionTrace()
+    assert not await authorize(app, default_tenant, user_id, resource_id, trace)
+    [policy_trace] = trace.to_dict()["policies"]
+    assert policy_trace["prefilter"] == "skipped"
+    assert policy_trace["failed_condition"] == {"attribute_name": "age", "operator": "<", "value": 50}
+    assert policy_trace["sources"] == {"conditions": "redis"}
+    assert [stage["name"] for stage in trace.stages] == ["users", "resources", "conditions"]
+
+
+@pytest.mark.asyncio
+async def test_authorize_with_batch_loaders():
+    user_id, resource_id, unknown_id = ObjectId(), ObjectId(), ObjectId()
+    fetched_conditions = []
+
+    def get_conditions_many(_, tenant, ids):
+        fetched_conditions.extend(ids)
+        return {k: policies[k]["conditions"] for k in ids if k in policies and tenant.is_default}
+
+    app = {}
+    # the batch functions are called per tenant (see by_tenant), only the default tenant has data
+    app["users_loader"] = BatchLoader(by_tenant(
+        lambda _, tenant, ids: {k: {"age": 31} for k in ids if k == user_id and tenant.is_default}, app
+    ))
+    app["resources_loader"] = BatchLoader(by_tenant(
+        lambda _, tenant, ids: {k: [john_is_manager_policy, age_policy] for k in ids if k == resource_id and tenant.is_default}, app
+    ))
+    app["signatures_loader"] = BatchLoader(by_tenant(
+        lambda _, tenant, ids: {k: policies[k]["signature"] for k in ids if k in policies and tenant.is_default}, app
+    ))
+    app["conditions_loader"] = BatchLoader(by_tenant(get_conditions_many, app))
+    assert await authorize(app, default_tenant, user_id, resource_id)
+    # the John policy was rejected by its signature, so only the conditions of the age policy were read
+    assert fetched_conditions == [age_policy]
+    with pytest.raises(NotFoundError):
+        await authorize(app, default_tenant, unknown_id, resource_id)
+    with pytest.raises(NotFoundError):
+        await authorize(app, default_tenant, user_id, unknown_id)
+    with pytest.raises(NotFoundError):
+        await authorize(app, get_tenant("other"), user_id, resource_id)
@@ -3,7 +3,16 @@ from typing import Any, Dict
 import pytest
 from marshmallow import ValidationError
 
-from api.common.utils import apply, validate_conditions_types, validate_values_types
+from api.common import decision
+from api.common.decision import (
+    apply,
+    compile_conditions,
+    compile_policy,
+    parse_timestamp,
+    validate_conditions_types,
+    validate_values_types,
+)
+from api.common.models import PolicySchema
 
 
 @pytest.mark.parametrize("age", [None, "", "some string", {}, {"k": "v"}, True, False])
@@ -162,3 +171,134 @@ def test_apply_true(condition: Dict[str, Any], attributes: Dict[str, Any]) -> No
 )
 def test_apply_false(condition: Dict[str, Any], attributes: Dict[str, Any]) -> None:
     assert not apply(condition, attributes)
+
+
+def test_validate_values_types_list() -> None:
+    attributes_conf = {
+        "groups": "list"
+    }
+    validate_values_types(attributes_conf, {"groups": ["a", 1, True]})
+    with pytest.raises(ValidationError) as err:
+        validate_values_types(attributes_conf, {"groups": "a"})
+    assert str(err.value) == "attribute 'groups' is not list of string, integer or boolean"
+
+    attributes_conf = {
+        "groups": "list[string]"
+    }
+    validate_values_types(attributes_conf, {"groups": ["a", "b"]})
+    with pytest.raises(ValidationError) as err:
+        validate_values_types(attributes_conf, {"groups": ["a", 1]})
+    assert str(err.value) == "attribute 'groups' is not list of string"
+
+
+@pytest.mark.parametrize(
+    "attributes_conf,condition,error",
+    [
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "in", "value": []}, 'operator "in" on attribute \'age\' requires a non empty list'),
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "not_in", "value": 30}, 'operator "not_in" on attribute \'age\' requires a non empty list'),
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "in", "value": [30, "31"]}, "attribute 'age' is not integer"),
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "between", "value": [30]}, 'operator "between" on attribute \'age\' requires a list of [min, max]'),
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "between", "value": [40, 30]}, 'operator "between" on attribute \'age\' requires min <= max'),
+        ({"age": "integer"}, {"attribute_name": "age", "operator": "regex", "value": "3."}, 'Cant apply operator "regex" on integer'),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "(John"}, "attribute 'name' has invalid regex: missing ), unterminated subpattern at position 0"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "contains", "value": "J"}, 'Cant apply operator "contains" on string'),
+        ({"groups": "list"}, {"attribute_name": "groups", "operator": "contains", "value": ["a"]}, "attribute 'groups' value is not string, integer or boolean"),
+        ({"groups": "list"}, {"attribute_name": "groups", "operator": "=", "value": "a"}, 'Cant apply operator "=" on list'),
+        ({"groups": "list[string]"}, {"attribute_name": "groups", "operator": "contains", "value": 1}, "attribute 'groups' is not string"),
+        ({"levels": "list[integer]"}, {"attribute_name": "levels", "operator": "contains", "value": True}, "attribute 'levels' is not integer"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "^(a+)+$"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "(a)\\1"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "(a|a)+$"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "(a|aa)+$"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "(\\w|\\d)+$"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "[\\w\\d]*$"}, "attribute 'name' regex can't have nested repetitions, alternations under repetitions or backreferences"),
+        ({"name": "string"}, {"attribute_name": "name", "operator": "regex", "value": "a" * 257}, "attribute 'name' regex is longer than 256 characters"),
+        ({"is_manager": "boolean"}, {"attribute_name": "is_manager", "operator": "in", "value": [True]}, 'Cant apply operator "in" on boolean'),
+    ]
+)
+def test_validate_conditions_types_set_operators(attributes_conf: Dict[str, str], condition: Dict[str, Any], error: str) -> None:
+    with pytest.raises(ValidationError) as err:
+        validate_conditions_types(attributes_conf, [condition])
+    assert str(err.value) == error
+
+
+@pytest.mark.parametrize(
+    "condition,attributes,expected",
+    [
+        ({"attribute_name": "department", "operator": "in", "value": ["a", "b", "c"]}, {"department": "b"}, True),
+        ({"attribute_name": "department", "operator": "in", "value": ["a", "b", "c"]}, {"department": "d"}, False),
+        ({"attribute_name": "department", "operator": "not_in", "value": ["a", "b"]}, {"department": "d"}, True),
+        ({"attribute_name": "department", "operator": "not_in", "value": ["a", "b"]}, {"department": "a"}, False),
+        ({"attribute_name": "department", "operator": "not_in", "value": ["a", "b"]}, {}, False),
+        ({"attribute_name": "age", "operator": "in", "value": [30, 40]}, {"age": 40}, True),
+        ({"attribute_name": "age", "operator": "in", "value": [30, 40]}, {"age": 41}, False),
+        ({"attribute_name": "age", "operator": "between", "value": [30, 40]}, {"age": 30}, True),
+        ({"attribute_name": "age", "operator": "between", "value": [30, 40]}, {"age": 40}, True),
+        ({"attribute_name": "age", "operator": "between", "value": [30, 40]}, {"age": 41}, False),
+        ({"attribute_name": "groups", "operator": "contains", "value": "admins"}, {"groups": ["users", "admins"]}, True),
+        ({"attribute_name": "groups", "operator": "contains", "value": "admins"}, {"groups": ["users"]}, False),
+        ({"attribute_name": "email", "operator": "regex", "value": "@example\\.com$"}, {"email": "john@example.com"}, True),
+        ({"attribute_name": "email", "operator": "regex", "value": "@example\\.com$"}, {"email": "john@example.org"}, False),
+    ]
+)
+def test_apply_set_operators(condition: Dict[str, Any], attributes: Dict[str, Any], expected: bool) -> None:
+    assert apply(condition, attributes) is expected
+    # same result after preprocessing the condition
+    [compiled] = compile_conditions([condition])
+    assert apply(compiled, attributes) is expected
+
+
+def test_compile_conditions() -> None:
+    conditions = [
+        {"attribute_name": "age", "operator": "in", "value": [30, 40]},
+        {"attribute_name": "age", "operator": ">", "value": 20},
+    ]
+    compiled = compile_conditions(conditions)
+    assert compiled[0]["lookup"] == {"30": True, "40": True}
+    assert compiled[1] == conditions[1]
+    assert "lookup" not in conditions[0]  # the original conditions are not modified
+
+
+def _passes(policy: Dict[str, Any], attributes: Dict[str, Any]) -> bool:
+    return all(apply(cond, attributes) for cond in policy["conditions"])
+
+
+@pytest.mark.parametrize("now,expected", [(99, False), (100, True), (199, True), (200, False)])
+def test_time_bounded_policy(monkeypatch, now: float, expected: bool) -> None:
+    policy = compile_policy([{"attribute_name": "age", "operator": ">", "value": 30}], not_before=100, not_after=200)
+    monkeypatch.setattr(decision, "_now", lambda: now)
+    assert _passes(policy, {"age": 31}) is expected
+    assert not _passes(policy, {"age": 20})
+
+
+@pytest.mark.parametrize("now,department,expected", [
+    (50, "a", True), (50, "b", False),
+    (150, "a", False), (150, "b", True),
+    (250, "b", False),  # after not_after
+])
+def test_scheduled_conditions(monkeypatch, now: float, department: str, expected: bool) -> None:
+    policy = compile_policy(
+        [{"attribute_name": "department", "operator": "=", "value": "a"}, {"attribute_name": "age", "operator": ">", "value": 30}],
+        not_after=200,
+        schedule=[{"at": 100, "conditions": [{"attribute_name": "department", "operator": "in", "value": ["b"]}, {"attribute_name": "age", "operator": ">", "value": 30}]}]
+    )
+    monkeypatch.setattr(decision, "_now", lambda: now)
+    assert _passes(policy, {"department": department, "age": 31}) is expected
+    # the signature holds only what every phase requires
+    assert policy["signature"] == {"attributes": ["age", "department"], "equals": []}
+
+
+def test_policy_schema_times() -> None:
+    schema = PolicySchema()
+    policy = schema.loads('{"conditions": [], "not_before": "2026-01-01T00:00:00Z", "schedule": [{"at": 1767312000, "conditions": []}]}')
+    assert policy["not_before"] == parse_timestamp("2026-01-01T00:00:00+00:00") == 1767225600
+    assert schema.dump(policy)["schedule"] == [{"at": "2026-01-02T00:00:00+00:00", "conditions": []}]
+    with pytest.raises(ValidationError):
+        schema.loads('{"conditions": [], "not_before": 200, "not_after": 100}')
+    with pytest.raises(ValidationError):
+        schema.loads('{"conditions": [], "not_before": "tomorrow"}')
+
+
+@pytest.mark.parametrize("pattern", ["^[a-z0-9._]+@(example|test)\\.com$", "(?:ab)+", "[\\w-]+$", "\\d{3}-\\d{4}"])
+def test_validate_regex_allows_unambiguous_repetitions(pattern: str) -> None:
+    validate_conditions_types({"name": "string"}, [{"attribute_name": "name", "operator": "regex", "value": pattern}])
@@ -0,0 +1,93 @@
+import pytest
+from bson import ObjectId
+
+from api.common.exceptions import NotFoundError
+from api.pdp import PolicyDecisionPoint, StaleError
+
+user_id = str(ObjectId())
+other_user_id = str(ObjectId())
+resource_id = str(ObjectId())
+policy_id = str(ObjectId())
+
+
+class FakeService:
+    """Serves the snapshot and feed endpoints from in memory documents, each document keeps its last version"""
+    def __init__(self):
+        self.version = 0
+        self.docs = {"users": {}, "resources": {}, "policies": {}}
+        self.calls = []
+
+    def write(self, entity: str, doc_id: str, doc: dict) -> int:
+        self.version += 1
+        self.docs[entity][doc_id] = {**doc, "version": self.version}
+        return self.version
+
+    def fetch(self, path: str, params: dict):
+        self.calls.append(path)
+        parts = path.strip("/").split("/")
+        if parts[0] == "pdp" and parts[1] == "snapshot":
+            items = sorted(self.docs[parts[2]].values(), key=lambda d: d["version"])
+            return {"token": self.version, "items": items, "next": None}
+        if parts[0] == "pdp" and parts[1] == "feed":
+            return {
+                "token": self.version,
+                "complete": True,
+                **{entity: [d for d in docs.values() if d["version"] > params["since"]] for entity, docs in self.docs.items()}
+            }
+        return self.docs[parts[0]].get(parts[1])
+
+
+@pytest.fixture
+def service():
+    service = FakeService()
+    service.write("users", user_id, {"user_id": user_id, "attributes": {"age": 31}})
+    service.write("users", other_user_id, {"user_id": other_user_id, "attributes": {"age": 20}})
+    service.write("policies", policy_id, {"policy_id": policy_id, "conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})
+    service.write("resources", resource_id, {"resource_id": resource_id, "policy_ids": [policy_id]})
+    return service
+
+
+def test_decides_locally_after_sync(service):
+    pdp = PolicyDecisionPoint(fetch=service.fetch)
+    assert pdp.sync() == service.version
+    service.calls.clear()
+
+    assert pdp.is_authorized(user_id, resource_id) is True
+    assert pdp.is_authorized(other_user_id, resource_id) is False
+    assert service.calls == []
+
+
+def test_feed_applies_changes(service):
+    pdp = PolicyDecisionPoint(fetch=service.fetch)
+    pdp.sync()
+    service.write("policies", policy_id, {"policy_id": policy_id, "conditions": [{"attribute_name": "age", "operator": "<", "value": 30}]})
+    pdp.sync()
+
+    assert pdp.is_authorized(user_id, resource_id) is False
+    assert pdp.is_authorized(other_user_id, resource_id) is True
+
+
+def test_min_token_syncs_before_deciding(service):
+    pdp = PolicyDecisionPoint(fetch=service.fetch)
+    pdp.sync()
+    token = service.write("users", other_user_id, {"user_id": other_user_id, "attributes": {"age": 40}})
+
+    assert pdp.is_authorized(other_user_id, resource_id, min_token=token) is True
+    with pytest.raises(StaleError):
+        pdp.is_authorized(other_user_id, resource_id, min_token=token + 1)
+
+
+def test_bounded_users_are_fetched_on_demand(service):
+    pdp = PolicyDecisionPoint(fetch=service.fetch, max_users=1)
+    pdp.sync()
+    assert pdp.stats["users"] == 1
+    service.calls.clear()
+
+    assert pdp.is_authorized(other_user_id, resource_id) is False
+    assert pdp.is_authorized(user_id, resource_id) is True
+    assert pdp.stats["users"] == 1
+    # the fetched user took the place of the synced one
+    assert [c for c in service.calls if c.startswith("/users")] == [f"/users/{other_user_id}", f"/users/{user_id}"]
+
+    with pytest.raises(NotFoundError):
+        pdp.is_authorized(str(ObjectId()), resource_id)
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from bson import ObjectId
+
+from api.common.versions import new_version
+from api.sim import BackendFaults
+
+
+class _Request(dict):
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+
+async def _create_users(api_client, count: int) -> list:
+    users = []
+    for age in range(count):
+        res = await (await api_client.post("/users", json={"attributes": {"age": age}})).json()
+        users.append(res)
+    return users
+
+
+async def _get(api_client, path: str, **params) -> dict:
+    res = await api_client.get(path, params={k: str(v) for k, v in params.items()})
+    assert res.status == 200
+    return await res.json()
+
+
+@pytest_asyncio.fixture
+async def pdp_client(api_client):
+    await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"})
+    return api_client
+
+
+@pytest.mark.asyncio
+async def test_snapshot_pages(pdp_client):
+    users = await _create_users(pdp_client, 4)
+
+    first = await _get(pdp_client, "/pdp/snapshot/users", limit=2)
+    second = await _get(pdp_client, "/pdp/snapshot/users", limit=2, after=first["next"])
+    # a full last page doesn't know that it's the last one, the next page is empty
+    last = await _get(pdp_client, "/pdp/snapshot/users", limit=2, after=second["next"])
+    assert [len(page["items"]) for page in (first, second, last)] == [2, 2, 0]
+    assert last["next"] is None
+    assert [item["user_id"] for page in (first, second) for item in page["items"]] == [user["user_id"] for user in users]
+    assert first["token"] == users[-1]["consistency_token"]
+
+
+@pytest.mark.asyncio
+async def test_changes_between_snapshot_pages_come_from_the_feed(pdp_client):
+    users = await _create_users(pdp_client, 3)
+    first = await _get(pdp_client, "/pdp/snapshot/users", limit=2)
+
+    # the first page was already read, so these changes are not in the snapshot pages that follow it
+    patched = await (await pdp_client.patch(f"/users/{users[0]['user_id']}/attributes/age", json={"attribute_value": 40})).json()
+    created = (await _create_users(pdp_client, 1))[0]
+    second = await _get(pdp_client, "/pdp/snapshot/users", limit=2, after=first["next"])
+
+    feed = await _get(pdp_client, "/pdp/feed", since=min(first["token"], second["token"]))
+    assert feed["complete"]
+    assert {item["user_id"]: item["attributes"]["age"] for item in feed["users"]} == {users[0]["user_id"]: 40, created["user_id"]: 0}
+    assert feed["token"] == created["consistency_token"] > patched["consistency_token"]
+
+
+@pytest.mark.asyncio
+async def test_feed_pages_end_at_the_first_full_page(pdp_client):
+    users = await _create_users(pdp_client, 3)
+    policy = await (await pdp_client.post("/policies", json={"conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})).json()
+    resource = await (await pdp_client.post("/resources", json={"policy_ids": [policy["policy_id"]]})).json()
+
+    first = await _get(pdp_client, "/pdp/feed", since=0, limit=2)
+    # the users page is full at the second user, the policy and the resource come after it
+    assert not first["complete"]
+    assert first["token"] == users[1]["consistency_token"]
+    assert [item["user_id"] for item in first["users"]] == [user["user_id"] for user in users[:2]]
+    assert first["policies"] == first["resources"] == []
+
+    # a change that lands between the pages is in a later page
+    patched = await (await pdp_client.patch(f"/users/{users[0]['user_id']}/attributes/age", json={"attribute_value": 40})).json()
+    second = await _get(pdp_client, "/pdp/feed", since=first["token"], limit=2)
+    assert [item["user_id"] for item in second["users"]] == [users[2]["user_id"], users[0]["user_id"]]
+    assert [item["policy_id"] for item in second["policies"]] == [policy["policy_id"]]
+    assert [item["resource_id"] for item in second["resources"]] == [resource["resource_id"]]
+    assert not second["complete"]  # the users page is full again
+    assert second["token"] == patched["consistency_token"]
+
+    last = await _get(pdp_client, "/pdp/feed", since=second["token"], limit=2)
+    assert last["complete"]
+    assert last["token"] == second["token"]
+    assert last["users"] == last["policies"] == last["resources"] == []
+
+
+@pytest.mark.asyncio
+async def test_feed_stops_below_pending_versions(pdp_client):
+    before = await _create_users(pdp_client, 1)
+    # a write that took its version and wasn't committed yet
+    with new_version(_Request(pdp_client.app)) as pending:
+        after = await _create_users(pdp_client, 1)
+        assert after[0]["consistency_token"] > pending
+
+        feed = await _get(pdp_client, "/pdp/feed", since=0)
+        assert feed["token"] == pending - 1
+        assert [item["user_id"] for item in feed["users"]] == [before[0]["user_id"]]
+        snapshot = await _get(pdp_client, "/pdp/snapshot/users")
+        assert snapshot["token"] == pending - 1
+
+    feed = await _get(pdp_client, "/pdp/feed", since=pending - 1)
+    assert feed["token"] == after[0]["consistency_token"]
+    assert [item["user_id"] for item in feed["users"]] == [after[0]["user_id"]]
+
+
+@pytest.mark.asyncio
+async def test_writes_of_missing_entities_get_no_token(pdp_client):
+    policy = await (await pdp_client.post("/policies", json={"conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})).json()
+    res = await pdp_client.put(f"/resources/{ObjectId()}", json={"policy_ids": [policy["policy_id"]]})
+    assert res.status == 404
+    assert "consistency_token" not in await res.json()
+    res = await pdp_client.put(f"/policies/{ObjectId()}", json={"conditions": [{"attribute_name": "age", "operator": "<", "value": 30}]})
+    assert res.status == 404
+
+    # the versions they took are released, so the feed isn't held back by them
+    feed = await _get(pdp_client, "/pdp/feed", since=0)
+    assert feed["token"] > policy["consistency_token"]
+
+
+@pytest.mark.asyncio
+async def test_feed_doesnt_block_the_event_loop(pdp_client):
+    faults = pdp_client.app["mongodb"].faults = BackendFaults(timeout_seconds=0.3)
+    faults.partition()
+    feed = asyncio.create_task(pdp_client.get("/pdp/feed"))
+    ticks = 0
+    while not feed.done():
+        await asyncio.sleep(0.01)
+        ticks += 1
+    assert (await feed).status == 500
+    assert ticks >= 10
@@ -0,0 +1,71 @@
+import json
+from pathlib import Path
+
+from bson import ObjectId
+
+from api.tools.replay import parse_line, run_replay
+
+user_id = str(ObjectId())
+manager_id = str(ObjectId())
+resource_id = str(ObjectId())
+age_policy = str(ObjectId())
+
+
+def _write_snapshot(tmp_path: Path) -> str:
+    snapshot = {
+        "users": [
+            {"user_id": user_id, "attributes": {"age": 31, "is_manager": False}},
+            {"user_id": manager_id, "attributes": {"age": 25, "is_manager": True}},
+        ],
+        "resources": [{"resource_id": resource_id, "policy_ids": [age_policy]}],
+        "policies": [{"policy_id": age_policy, "conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]}],
+    }
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps(snapshot))
+    return str(path)
+
+
+def _write_candidate(tmp_path: Path) -> str:
+    candidate = {
+        "policies": [{"policy_id": age_policy, "conditions": [{"attribute_name": "is_manager", "operator": "=", "value": True}]}],
+    }
+    path = tmp_path / "candidate.json"
+    path.write_text(json.dumps(candidate))
+    return str(path)
+
+
+def _traffic():
+    return [
+        f'12 10.0.0.1 [19/Oct/2026:10:00:00 +0000] "GET /is_authorized?user_id={user_id}&resource_id={resource_id} HTTP/1.1" 200 0.001',
+        json.dumps({"user_id": manager_id, "resource_id": resource_id}),
+        f'12 10.0.0.1 [19/Oct/2026:10:00:00 +0000] "GET /is_authorized?user_id={user_id}&resource_id={ObjectId()} HTTP/1.1" 404 0.001',
+        '12 10.0.0.1 [19/Oct/2026:10:00:00 +0000] "POST /users HTTP/1.1" 200 0.001',
+    ]
+
+
+def test_parse_line():
+    assert parse_line(f'"GET /is_authorized?user_id={user_id}&resource_id={resource_id} HTTP/1.1"') == (user_id, resource_id)
+    assert parse_line(json.dumps({"user_id": user_id, "resource_id": resource_id})) == (user_id, resource_id)
+    assert parse_line('"GET /is_authorized?user_id=1 HTTP/1.1"') is None
+    assert parse_line('"GET /health-check HTTP/1.1"') is None
+    assert parse_line("") is None
+
+
+def test_run_replay(tmp_path: Path):
+    report = run_replay(_traffic(), _write_snapshot(tmp_path), _write_candidate(tmp_path), workers=1)
+    assert report["requests"] == 3
+    assert report["skipped_lines"] == 1
+    assert report["allowed"] == 1
+    assert report["denied"] == 1
+    assert report["errors"] == {"not_found": 1}
+    assert report["diffs"] == 2
+    assert report["hot_users"][0] == (user_id, 2)
+    assert report["hot_policies"] == [(age_policy, 2)]
+
+
+def test_run_replay_process_pool(tmp_path: Path):
+    report = run_replay(_traffic() * 10, _write_snapshot(tmp_path), workers=2, chunk_size=3)
+    assert report["requests"] == 30
+    assert report["allowed"] == 10
+    assert report["denied"] == 10
+    assert report["diffs"] is None
@@ -0,0 +1,234 @@
+import time
+
+import pytest
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import AutoReconnect, DuplicateKeyError, OperationFailure
+from redis.exceptions import ResponseError, TimeoutError
+
+from api.common.admission import RateLimiter
+from api.common.cache_manager import CacheBudget
+from api.common.changes import UPDATE, ChangeLog
+from api.common.tenants import Tenant, default_tenant
+from api.common.versions import new_version
+from api.sim import (
+    BackendFaults,
+    FakeMongoClient,
+    FakeRedis,
+    LatencyModel,
+    stand_in_backends,
+)
+from api.tools.scenario import build_scenario, run_scenario
+
+
+def test_redis_clients_share_the_server():
+    redis = FakeRedis(decode_responses=True)
+    redis_bytes = FakeRedis(redis.server)
+    redis_bytes.set("resource", b"\x00\x01", ex=60)
+    assert redis_bytes.mget(["resource", "missing"]) == [b"\x00\x01", None]
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.delete("user")
+    pipe.hset("user", mapping={"age": "30"})
+    pipe.expire("user", 60)
+    assert pipe.execute() == [0, 1, True]
+    assert redis.hgetall("user") == {"age": "30"}
+    assert redis_bytes.hgetall("user") == {b"age": b"30"}
+
+    redis.json().set("policy", ".", {"conditions": [{"operator": "="}], "signature": {"attributes": []}})
+    assert redis.json().get("policy", ".conditions") == [{"operator": "="}]
+    assert redis.json().mget(["policy", "missing"], ".signature") == [{"attributes": []}, None]
+
+
+def test_redis_keys_expire():
+    redis = FakeRedis()
+    redis.set("key", "value", ex=0)
+    time.sleep(0.001)
+    assert redis.get("key") is None
+    assert redis.exists("key") == 0
+
+
+def test_redis_scripts():
+    redis = FakeRedis(decode_responses=True)
+    app = {"redis": redis}
+
+    # the oldest entries of the tenant are evicted once it's over its budget
+    tenant = Tenant("small")
+    tenant.cache_budget_bytes = 400  # each entry is 100 bytes, plus its key and the entry overhead
+    cache_budget = CacheBudget(tenants={"small"})
+    for key in ("a", "b", "c"):
+        redis.set(key, "x" * 100)
+        cache_budget.admit(app, tenant, {key: 100})
+    assert redis.exists("a", "b", "c") == 2
+    assert not redis.exists("a")
+    assert CacheBudget.usage(app, tenant) <= 400
+
+    # and in the pipeline of the fill
+    pipe = redis.pipeline(transaction=False)
+    pipe.set("d", "x" * 100)
+    cache_budget.admit(app, tenant, {"d": 100}, pipe)
+    assert cache_budget.execute(app, pipe) == [True]
+    assert redis.exists("b", "c", "d") == 2
+    assert not redis.exists("b")
+
+    token_bucket = redis.register_script(RateLimiter.TOKEN_BUCKET_SCRIPT)
+    assert [token_bucket(keys=["bucket"], args=[1, 2]) for _ in range(3)] == [1, 1, 0]
+
+
+def test_redis_scripts_access_only_their_keys():
+    redis = FakeRedis(decode_responses=True)
+    redis.set("other", "value")
+    with pytest.raises(ResponseError, match="not in KEYS"):
+        redis.register_script("return redis.call('GET', 'other')")(keys=["key"])
+    with pytest.raises(ResponseError, match="not in KEYS"):
+        redis.register_script("return redis.call('DEL', KEYS[1], 'other')")(keys=["key"])
+    assert redis.register_script("return redis.call('GET', KEYS[1])")(keys=["other"]) == "value"
+
+
+def test_cache_budgets():
+    redis = FakeRedis(decode_responses=True)
+    app = {"redis": redis}
+    tenant = Tenant("small")
+
+    # without a tenants list (e.g. a single tenant) the fills aren't registered
+    CacheBudget(tenants=None).admit(app, tenant, {"a": 100})
+    assert CacheBudget.usage(app, tenant) == 0
+    assert not redis.exists(*CacheBudget.build_keys(tenant))
+
+    # the budgets are capped at the tenants' shares of maxmemory (the listed tenants and the default one)
+    cache_budget = CacheBudget(tenants={"small", "big", "other"})
+    cache_budget.load_max_memory(redis)
+    assert cache_budget.budget_bytes(tenant) == tenant.cache_budget_bytes
+    redis.server.max_memory = 1000
+    cache_budget.load_max_memory(redis)
+    assert cache_budget.budget_bytes(tenant) == 200
+
+
+def test_lua_replies_are_converted_like_redis():
+    redis = FakeRedis(decode_responses=True)
+    script = redis.register_script("""
+local status = redis.call('SET', KEYS[1], ARGV[1], 'EX', 60)
+redis.call('ZADD', KEYS[2], 1.5, 'a', 2, 'b')
+return {status['ok'], tostring(redis.call('GET', KEYS[3])), redis.call('GET', KEYS[1]), 3.7, redis.call('ZPOPMIN', KEYS[2]), nil, 5}
+""")
+    assert script(keys=["key", "zset", "missing"], args=[5]) == ["OK", "false", "5", 3, ["a", "1.5"]]
+
+    with pytest.raises(ResponseError, match="WRONGTYPE"):
+        redis.register_script("return redis.call('HGET', KEYS[1], 'field')")(keys=["key"])
+    with pytest.raises(ResponseError, match="not supported"):
+        redis.register_script("return redis.call('LPUSH', KEYS[1], 'x')")(keys=["list"])
+    with pytest.raises(AttributeError, match="not supported"):
+        redis.lpush("list", "x")
+
+
+def test_changes_on_the_stand_in():
+    redis = FakeRedis(decode_responses=True)
+    change_log = ChangeLog()
+
+    class _Request(dict):
+        app = {"redis": redis, "mongodb": FakeMongoClient()}
+    with new_version(_Request()) as version:
+        change_log.record(_Request(), "user", "u1", version, UPDATE, {"attributes.age": 30})
+    change_log.publish(_Request())
+    result = change_log.read(redis, default_tenant, "0-0", 10, None)
+    assert [change["entity_id"] for change in result["changes"]] == ["u1"]
+
+    # waits for new changes up to the block time
+    started = time.monotonic()
+    assert change_log.read(redis, default_tenant, result["next"], 10, 50)["changes"] == []
+    assert time.monotonic() - started >= 0.05
+
+
+def test_mongo_queries_and_updates():
+    col = FakeMongoClient()["db"]["users"]
+    ids = [col.insert_one({"attributes": {"age": age}, "version": age}).inserted_id for age in (20, 30, 40)]
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": ids[0]})
+
+    assert [d["attributes"]["age"] for d in col.find({"_id": {"$in": ids[1:]}}, {"attributes": 1})] == [30, 40]
+    assert [d["version"] for d in col.find({"version": {"$gt": 20}}).sort("version", -1).limit(1)] == [40]
+    assert col.count_documents({"_id": {"$in": [ids[0], ObjectId()]}}) == 1
+
+    res = col.update_one({"_id": ids[0]}, {"$unset": {"attributes.age": ""}, "$set": {"version": 50}})
+    assert res.matched_count == 1
+    assert col.find_one({"_id": ids[0]}, {"attributes": 1}) == {"_id": ids[0], "attributes": {}}
+    assert col.update_one({"_id": ObjectId()}, {"$set": {"version": 1}}).matched_count == 0
+
+    counters = FakeMongoClient()["db"]["counters"]
+    for seq in (1, 2):
+        counter = counters.find_one_and_update({"_id": "versions"}, {"$inc": {"seq": 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        assert counter == {"_id": "versions", "seq": seq}
+
+    # unsupported operators and commands fail like MongoDB's unknown ones
+    with pytest.raises(OperationFailure, match="not supported"):
+        col.find_one({"age": {"$regex": "^3"}})
+    with pytest.raises(OperationFailure, match="not supported"):
+        col.update_one({}, {"$push": {"groups": "a"}})
+    with pytest.raises(OperationFailure, match="not supported"):
+        FakeMongoClient()["db"].command("dbStats")
+
+
+def test_faults_are_deterministic():
+    latency = LatencyModel(median_ms=1, p99_ms=10, spike_rate=0.1, spike_ms=100)
+    # the faults of a call depend only on the seed and the call's number
+    samples = [[latency.sample(faults.call_rng(n)) for n in range(100)] for faults in (BackendFaults(seed=7), BackendFaults(seed=7))]
+    assert samples[0] == samples[1]
+    assert samples[0] != [latency.sample(BackendFaults(seed=8).call_rng(n)) for n in range(100)]
+    assert sorted(samples[0])[50] < 0.005
+
+
+    faults = BackendFaults(error_rate=1)
+    with pytest.raises(AutoReconnect):
+        FakeMongoClient(faults)["db"]["users"].find_one({})
+    assert faults.stats == {"calls": 1, "errors": 1, "timeouts": 0}
+
+
+def test_partitions():
+    backends = stand_in_backends(redis_faults=BackendFaults(partitions=[(0, 0.05)], timeout_seconds=0.01))
+    with pytest.raises(TimeoutError):
+        backends["redis"].get("key")
+    time.sleep(0.05)
+    assert backends["redis_bytes"].get("key") is None
+
+    faults = backends["redis"].server.faults
+    faults.partition()
+    with pytest.raises(TimeoutError):
+        backends["redis"].ping()
+    faults.heal()
+    assert backends["redis"].ping()
+
+
+@pytest.mark.asyncio
+async def test_api_on_stand_ins(api_client):
+    assert (await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"})).status == 200
+    policy = await (await api_client.post("/policies", json={"conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})).json()
+    user = await (await api_client.post("/users", json={"attributes": {"age": 31}})).json()
+    resource = await (await api_client.post("/resources", json={"policy_ids": [policy["policy_id"]]})).json()
+
+    params = {"user_id": user["user_id"], "resource_id": resource["resource_id"]}
+    for _ in range(2):  # from MongoDB, and then from the caches
+        assert await (await api_client.get("/is_authorized", params=params)).json() == {"is_authorized": True}
+    await api_client.patch(f"/users/{user['user_id']}/attributes/age", json={"attribute_value": 20})
+    assert await (await api_client.get("/is_authorized", params=params)).json() == {"is_authorized": False}
+
+    # Redis is down
+    api_client.app["redis"].server.faults = BackendFaults(error_rate=1)
+    assert (await api_client.get("/is_authorized", params=params)).status == 500
+    api_client.app["redis"].server.faults = None
+    assert (await api_client.get("/is_authorized", params=params)).status == 200
+
+
+def test_scenario_runner():
+    scenario = build_scenario({
+        "duration_seconds": 1,
+        "rate": 50,
+        "dataset": {"users": 20, "resources": 20, "policies": 5},
+        "mongodb": {"latency": {"median_ms": 1}, "error_rate": 0.5},
+    })
+    report = run_scenario(scenario, seed=3)
+    assert report["requests"] == 50
+    assert sum(report["outcomes"].values()) == 50
+    assert report["backends"]["mongodb"]["errors"] > 0
+    assert report["backends"]["redis"]["calls"] > 0
+    assert report["latency_ms"]["p50"] is not None
+    assert len(report["timeline"]) == 1
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+from marshmallow import ValidationError
+
+from api.common.cache_manager import CacheBudget, UserAttributesCacheLoader
+from api.common.configs import DB, USERS_COL
+from api.common.tenants import by_tenant, default_tenant, get_tenant
+
+
+def test_tenant_namespaces():
+    tenant = get_tenant("acme")
+    assert tenant.db_name == f"{DB}-acme"
+    assert UserAttributesCacheLoader.build_key(tenant, "u1").startswith("Tenants:acme:")
+    # one hash tag, so the budget script's keys are in the same Redis Cluster slot
+    assert CacheBudget.build_keys(tenant) == ["Tenants:acme:CacheBudget:{acme}:Index", "Tenants:acme:CacheBudget:{acme}:Sizes", "Tenants:acme:CacheBudget:{acme}:Usage"]
+
+    # the default tenant keeps the original database and keys
+    assert default_tenant.db_name == DB
+    assert not UserAttributesCacheLoader.build_key(default_tenant, "u1").startswith("Tenants:")
+
+
+@pytest.mark.parametrize("name", ["", "Acme", "a" * 33, "acme:other", "-acme"])
+def test_invalid_tenant(name):
+    with pytest.raises(ValidationError):
+        get_tenant(name)
+
+
+def test_by_tenant_groups_the_keys():
+    calls = []
+
+    def get_many(app, tenant, ids):
+        calls.append((tenant.name, ids))
+        return {i: f"{tenant.name}/{i}" for i in ids if i != "missing"}
+
+    batch_fn = by_tenant(get_many, {})
+    assert batch_fn([("acme", "1"), ("default", "1"), ("acme", "2"), ("acme", "missing")]) == {
+        ("acme", "1"): "acme/1", ("default", "1"): "default/1", ("acme", "2"): "acme/2"
+    }
+    assert calls == [("acme", ["1", "2", "missing"]), ("default", ["1"])]
+
+
+@pytest.mark.asyncio
+async def test_tenant_indexes_are_created_on_its_first_write(api_client):
+    users = get_tenant("indexes-test").db(api_client.app)[USERS_COL]
+    headers = {"X-Tenant-Id": "indexes-test"}
+    assert (await api_client.get("/users/65b26f8cbd9ef108620e18f8", headers=headers)).status == 404
+    await asyncio.sleep(0.05)
+    assert users.indexes == []  # an unknown tenant's reads don't create its database
+
+    await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"}, headers=headers)
+    for _ in range(100):  # in the background
+        if users.indexes:
+            break
+        await asyncio.sleep(0.01)
+    assert users.indexes == ["version"]
@@ -0,0 +1,41 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.mark.asyncio
+async def test_updates_of_missing_users_are_not_cached(api_client):
+    await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"})
+    policy = await (await api_client.post("/policies", json={"conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})).json()
+    resource = await (await api_client.post("/resources", json={"policy_ids": [policy["policy_id"]]})).json()
+    user_id = str(ObjectId())
+
+    assert (await api_client.put(f"/users/{user_id}", json={"attributes": {"age": 40}})).status == 404
+    assert (await api_client.patch(f"/users/{user_id}/attributes/age", json={"attribute_value": 40})).status == 404
+    assert (await api_client.delete(f"/users/{user_id}/attributes/age")).status == 404
+    res = await api_client.get("/is_authorized", params={"user_id": user_id, "resource_id": resource["resource_id"]})
+    assert res.status == 404
+
+
+@pytest.mark.asyncio
+async def test_updates_are_applied_on_the_cached_user(api_client):
+    await api_client.post("/attributes", json={"attribute_name": "age", "attribute_type": "integer"})
+    policy = await (await api_client.post("/policies", json={"conditions": [{"attribute_name": "age", "operator": ">", "value": 30}]})).json()
+    resource = await (await api_client.post("/resources", json={"policy_ids": [policy["policy_id"]]})).json()
+    user = await (await api_client.post("/users", json={"attributes": {"age": 20}})).json()
+    params = {"user_id": user["user_id"], "resource_id": resource["resource_id"]}
+
+    async def is_authorized() -> bool:
+        return (await (await api_client.get("/is_authorized", params=params)).json())["is_authorized"]
+
+    assert not await is_authorized()
+    assert (await api_client.patch(f"/users/{user['user_id']}/attributes/age", json={"attribute_value": 31})).status == 200
+    assert await is_authorized()
+    assert (await api_client.delete(f"/users/{user['user_id']}/attributes/age")).status == 200
+    assert not await is_authorized()
+    assert (await api_client.put(f"/users/{user['user_id']}", json={"attributes": {"age": 35}})).status == 200
+    assert await is_authorized()
+
+
+@pytest.mark.asyncio
+async def test_attribute_names_cant_start_with_dollar(api_client):
+    assert (await api_client.post("/attributes", json={"attribute_name": "$revision", "attribute_type": "integer"})).status == 400
@@ -0,0 +1,122 @@
+"""
+Benchmark of the authorization checks over HTTP (/is_authorized) against the binary protocol (see binary_protocol).
+
+Usage:
+    python -m api.tools.benchmark --user-id <id> --resource-id <id> [--requests 100000] [--concurrency 64] [--batch-size 100]
+
+Both protocols are called with the same user and resource against a running server, over persistent connections,
+and the throughput and latency percentiles of each are reported.
+With --batch-size the binary protocol is measured once more, sending the checks in batches.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+from bson import ObjectId
+
+from api.common.binary_protocol import BinaryClient
+from api.common.configs import BINARY_PORT, SERVER_PORT
+
+
+async def _measure(call: Callable[[], Awaitable[int]], requests: int, concurrency: int) -> Dict[str, Any]:
+    """call() makes one round trip and returns the number of checks it made"""
+    latencies: List[float] = []
+    checks = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal checks, remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            checks += await call()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall_seconds = time.perf_counter() - started
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+    return {
+        "round_trips": len(latencies),
+        "checks": checks,
+        "wall_seconds": round(wall_seconds, 3),
+        "checks_per_second": round(checks / wall_seconds, 1),
+        "latency_ms": {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)}
+    }
+
+
+async def run_benchmark(
+        host: str,
+        user_id: ObjectId,
+        resource_id: ObjectId,
+        requests: int = 100000,
+        concurrency: int = 64,
+        batch_size: Optional[int] = None,
+        http_port: int = SERVER_PORT,
+        binary_port: int = BINARY_PORT,
+        tenant: Optional[str] = None
+) -> Dict[str, Any]:
+    report = {}
+
+    url = f"http://{host}:{http_port}/is_authorized"
+    params = {"user_id": str(user_id), "resource_id": str(resource_id)}
+    headers = {"X-Tenant-Id": tenant} if tenant else {}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency), headers=headers) as session:
+        async def http_check() -> int:
+            async with session.get(url, params=params) as response:
+                response.raise_for_status()
+                await response.json()
+            return 1
+        report["http"] = await _measure(http_check, requests, concurrency)
+
+    client = BinaryClient(host, binary_port, tenant)
+    await client.connect()
+    try:
+        async def binary_check() -> int:
+            await client.check(user_id, resource_id)
+            return 1
+        report["binary"] = await _measure(binary_check, requests, concurrency)
+
+        if batch_size:
+            pairs = [(user_id, resource_id)] * batch_size
+
+            async def binary_batch() -> int:
+                return len(await client.check_many(pairs))
+            report["binary_batch"] = await _measure(binary_batch, max(1, requests // batch_size), concurrency)
+    finally:
+        await client.close()
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark /is_authorized over HTTP against the binary protocol")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--http-port", type=int, default=SERVER_PORT)
+    parser.add_argument("--binary-port", type=int, default=BINARY_PORT)
+    parser.add_argument("--tenant", help="X-Tenant-Id of the checks (default tenant when not given)")
+    parser.add_argument("--user-id", required=True)
+    parser.add_argument("--resource-id", required=True)
+    parser.add_argument("--requests", type=int, default=100000, help="round trips per protocol")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight")
+    parser.add_argument("--batch-size", type=int, help="also measure the binary protocol with batches of this size")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(
+        args.host, ObjectId(args.user_id), ObjectId(args.resource_id), args.requests, args.concurrency,
+        args.batch_size, args.http_port, args.binary_port, args.tenant
+    ))
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
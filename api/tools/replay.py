@@ -0,0 +1,265 @@
+"""
+Offline replay of recorded /is_authorized traffic against a dataset snapshot.
+
+The decisions are calculated in process using the same logic as the server (decide_if_authorized),
+without HTTP, MongoDB or Redis, so it can be used for capacity planning and for checking
+a policy change before rolling it out.
+
+Usage:
+    python -m api.tools.replay --snapshot snapshot.json [--candidate-policies policies.json] [--workers 8] access.log
+
+The traffic is read as a stream (a file or "-" for stdin), each line is either a gunicorn access log line
+(see access_log_format in gunicorn.conf.py) or a JSON object with "user_id" and "resource_id".
+The snapshot is a JSON object with the documents as returned from the API:
+    {"users": [{"user_id": ..., "attributes": {...}}],
+     "resources": [{"resource_id": ..., "policy_ids": [...]}],
+     "policies": [{"policy_id": ..., "conditions": [...], "not_before": ..., "not_after": ..., "schedule": [...]}]}
+The time bounded and scheduled policies are decided by the time of the replay, not the time of the recorded requests.
+The candidate policies file has only the "policies" list, it overrides the snapshot's policies with the same ids,
+and every request is decided with both versions in order to report the decisions that have changed.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from api.common.decision import (
+    PrefetchedConditionsCache,
+    compile_policy_doc,
+    decide_if_authorized,
+)
+
+_ACCESS_LOG_REQUEST = re.compile(r'(?:GET|HEAD) /is_authorized\?([^ "]+)')
+MAX_DIFFS_PER_CHUNK = 100
+
+
+# Serves the policies from the snapshot instead of Redis/MongoDB, and counts the policies that were fetched
+class SnapshotConditionsCache(PrefetchedConditionsCache):
+    def __init__(self, policies: Dict[ObjectId, Dict[str, Any]]):
+        super().__init__({
+            policy_id: compile_policy_doc(doc)
+            for policy_id, doc in policies.items()
+        })
+        self.fetched: Counter = Counter()
+
+    def get_conditions(self, policy_ids: List[ObjectId]) -> Dict[ObjectId, List[Dict[str, Any]]]:
+        self.fetched.update(policy_ids)
+        return super().get_conditions(policy_ids)
+
+
+class Snapshot:
+    def __init__(self, users: Dict[ObjectId, Dict[str, Any]], resources: Dict[ObjectId, List[ObjectId]], policies: Dict[ObjectId, Dict[str, Any]]):
+        self.users = users
+        self.resources = resources
+        self.policies = policies
+
+    @staticmethod
+    def parse_policies(docs: List[Dict[str, Any]]) -> Dict[ObjectId, Dict[str, Any]]:
+        return {ObjectId(d["policy_id"]): d for d in docs}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Snapshot":
+        return cls(
+            users={ObjectId(d["user_id"]): d["attributes"] for d in data.get("users", [])},
+            resources={ObjectId(d["resource_id"]): [ObjectId(p) for p in d["policy_ids"]] for d in data.get("resources", [])},
+            policies=cls.parse_policies(data.get("policies", []))
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> "Snapshot":
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def parse_line(line: str) -> Optional[Tuple[str, str]]:
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith("{"):
+        try:
+            doc = json.loads(line)
+        except ValueError:
+            return None
+        if isinstance(doc, dict) and "user_id" in doc and "resource_id" in doc:
+            return str(doc["user_id"]), str(doc["resource_id"])
+        return None
+    match = _ACCESS_LOG_REQUEST.search(line)
+    if not match:
+        return None
+    query = parse_qs(match.group(1))
+    if "user_id" not in query or "resource_id" not in query:
+        return None
+    return query["user_id"][0], query["resource_id"][0]
+
+
+class _Evaluator:
+    def __init__(self, snapshot: Snapshot, candidate_policies: Optional[Dict[ObjectId, Dict[str, Any]]]):
+        self.snapshot = snapshot
+        self.baseline = SnapshotConditionsCache(snapshot.policies)
+        self.candidate = SnapshotConditionsCache({**snapshot.policies, **candidate_policies}) if candidate_policies is not None else None
+
+    def evaluate(self, lines: List[str]) -> Dict[str, Any]:
+        requests = [parsed for parsed in map(parse_line, lines) if parsed is not None]
+        stats = {
+            "requests": len(requests),
+            "skipped_lines": len(lines) - len(requests),
+            "allowed": 0,
+            "denied": 0,
+            "errors": Counter(),
+            "diffs": 0,
+            "diff_samples": [],
+            "users": Counter(),
+            "resources": Counter(),
+            "policies": Counter(),
+            "cpu_seconds": 0.0
+        }
+        self.baseline.fetched = stats["policies"]
+        started = time.process_time()
+        for user_id, resource_id in requests:
+            stats["users"][user_id] += 1
+            stats["resources"][resource_id] += 1
+            try:
+                user_attributes = self.snapshot.users[ObjectId(user_id)]
+                policy_ids = self.snapshot.resources[ObjectId(resource_id)]
+                is_auth = decide_if_authorized(policy_ids, user_attributes, self.baseline)
+            except InvalidId:
+                stats["errors"]["invalid_id"] += 1
+                continue
+            except KeyError:
+                # a user, resource or policy that is not in the snapshot
+                stats["errors"]["not_found"] += 1
+                continue
+            stats["allowed" if is_auth else "denied"] += 1
+
+            if self.candidate is not None:
+                try:
+                    candidate_is_auth = decide_if_authorized(policy_ids, user_attributes, self.candidate)
+                except KeyError:
+                    stats["errors"]["candidate_not_found"] += 1
+                    continue
+                if candidate_is_auth != is_auth:
+                    stats["diffs"] += 1
+                    if len(stats["diff_samples"]) < MAX_DIFFS_PER_CHUNK:
+                        stats["diff_samples"].append({"user_id": user_id, "resource_id": resource_id, "before": is_auth, "after": candidate_is_auth})
+        stats["cpu_seconds"] = time.process_time() - started
+        stats["policies"] = Counter({str(k): v for k, v in stats["policies"].items()})
+        return stats
+
+
+# Each process of the pool loads the snapshot once, instead of receiving it with every chunk
+_evaluator: Optional[_Evaluator] = None
+
+
+def _init_worker(snapshot_path: str, candidate_path: Optional[str]) -> None:
+    global _evaluator
+    candidate_policies = None
+    if candidate_path:
+        with open(candidate_path) as f:
+            candidate_policies = Snapshot.parse_policies(json.load(f)["policies"])
+    _evaluator = _Evaluator(Snapshot.from_file(snapshot_path), candidate_policies)
+
+
+def _evaluate_chunk(lines: List[str]) -> Dict[str, Any]:
+    return _evaluator.evaluate(lines)
+
+
+# The lines are parsed by the processes of the pool as well, so the main process only reads the stream
+def _chunks(lines: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    it = iter(lines)
+    while True:
+        chunk = list(islice(it, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _merge(total: Dict[str, Any], stats: Dict[str, Any]) -> None:
+    for key in ("requests", "skipped_lines", "allowed", "denied", "diffs", "cpu_seconds"):
+        total[key] += stats[key]
+    for key in ("errors", "users", "resources", "policies"):
+        total[key].update(stats[key])
+    total["diff_samples"].extend(stats["diff_samples"][:MAX_DIFFS_PER_CHUNK - len(total["diff_samples"])])
+
+
+def run_replay(
+        lines: Iterable[str],
+        snapshot_path: str,
+        candidate_path: Optional[str] = None,
+        workers: int = 1,
+        chunk_size: int = 10000,
+        top: int = 10
+) -> Dict[str, Any]:
+    total = {
+        "requests": 0, "skipped_lines": 0, "allowed": 0, "denied": 0, "diffs": 0, "cpu_seconds": 0.0, "diff_samples": [],
+        "errors": Counter(), "users": Counter(), "resources": Counter(), "policies": Counter()
+    }
+    chunks = _chunks(lines, chunk_size)
+    started = time.perf_counter()
+
+    if workers <= 1:
+        _init_worker(snapshot_path, candidate_path)
+        for chunk in chunks:
+            _merge(total, _evaluate_chunk(chunk))
+    else:
+        # Keeping only a few chunks in flight, so the log is read as a stream and not loaded to memory
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(snapshot_path, candidate_path)) as pool:
+            in_flight: Set[Future] = set()
+            for chunk in chunks:
+                if len(in_flight) >= workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _merge(total, future.result())
+                in_flight.add(pool.submit(_evaluate_chunk, chunk))
+            for future in in_flight:
+                _merge(total, future.result())
+
+    wall_seconds = time.perf_counter() - started
+    return {
+        "requests": total["requests"],
+        "skipped_lines": total["skipped_lines"],
+        "allowed": total["allowed"],
+        "denied": total["denied"],
+        "errors": dict(total["errors"]),
+        "wall_seconds": round(wall_seconds, 3),
+        "throughput_per_second": round(total["requests"] / wall_seconds, 1) if wall_seconds else None,
+        "throughput_per_core_per_second": round(total["requests"] / total["cpu_seconds"], 1) if total["cpu_seconds"] else None,
+        "diffs": total["diffs"] if candidate_path else None,
+        "diff_samples": total["diff_samples"] if candidate_path else None,
+        "hot_users": total["users"].most_common(top),
+        "hot_resources": total["resources"].most_common(top),
+        "hot_policies": total["policies"].most_common(top),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded /is_authorized traffic against a dataset snapshot")
+    parser.add_argument("log", help='access log or JSON lines file, "-" for stdin')
+    parser.add_argument("--snapshot", required=True, help="JSON file with the users, resources and policies")
+    parser.add_argument("--candidate-policies", help="JSON file with policies to compare the decisions against")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of processes (default: number of cpus)")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="requests per task sent to a process")
+    parser.add_argument("--top", type=int, default=10, help="number of hot users/resources/policies to report")
+    args = parser.parse_args(argv)
+
+    lines = sys.stdin if args.log == "-" else open(args.log)
+    try:
+        report = run_replay(lines, args.snapshot, args.candidate_policies, args.workers, args.chunk_size, args.top)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
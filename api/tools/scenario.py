@@ -0,0 +1,284 @@
+"""
+Scenario runner: load against the service running in process on stand-in MongoDB and Redis (see api.sim),
+with injected latency, failures and partitions, to see how the caches, the timeouts and the load shedding behave.
+
+Usage:
+    python -m api.tools.scenario --scenario mongo_stall [--duration 6] [--rate 200] [--seed 1]
+    python -m api.tools.scenario --scenario-file scenario.json
+    python -m api.tools.scenario --list
+
+A scenario is a JSON object (see SCENARIOS), e.g.:
+    {"duration_seconds": 6, "rate": 200, "mix": {"is_authorized": 0.9, "get_user": 0.05, "patch_user": 0.05},
+     "dataset": {"users": 1000, "resources": 1000, "policies": 100},
+     "mongodb": {"latency": {"median_ms": 1, "p99_ms": 5}, "partitions": [[2, 4]], "timeout_seconds": 1},
+     "redis": {"latency": {"median_ms": 0.2, "p99_ms": 1, "spike_rate": 0.001, "spike_ms": 50}, "error_rate": 0.01}}
+The partitions are [start, end] seconds since the load started.
+
+The dataset is generated from the seed and written to the stand-ins before the faults are turned on, the caches start cold.
+The requests are sent at a fixed rate (open loop) and their latency is measured from the time they should have been sent,
+so a stalled server shows up as latency instead of slowing down the load. The server runs on its own event loop thread,
+as the handlers call the backends synchronously. The report has the outcomes (status codes, or "timeout"/"error"),
+the latency percentiles overall and by request kind, a per second timeline, and the faults injected in each backend.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from bson import ObjectId
+
+from api.common.configs import (
+    ATTRIBUTES_COL,
+    POLICIES_COL,
+    RESOURCES_COL,
+    USERS_COL,
+)
+from api.common.decision import build_policy_signature
+from api.common.tenants import default_tenant
+from api.main import app_factory
+from api.sim import BackendFaults, stand_in_backends
+
+_DEFAULTS = {
+    "duration_seconds": 6,
+    "rate": 200,
+    "request_timeout_seconds": 2,
+    "mix": {"is_authorized": 0.9, "get_user": 0.05, "patch_user": 0.05},
+    "dataset": {"users": 1000, "resources": 1000, "policies": 100},
+    "mongodb": {"latency": {"median_ms": 1, "p99_ms": 5}},
+    "redis": {"latency": {"median_ms": 0.2, "p99_ms": 1}},
+}
+
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "baseline": {},
+    "slow_redis": {"redis": {"latency": {"median_ms": 5, "p99_ms": 50}}},
+    "redis_spikes": {"redis": {"latency": {"median_ms": 0.2, "p99_ms": 1, "spike_rate": 0.01, "spike_ms": 200}}},
+    "flaky_mongo": {"mongodb": {"latency": {"median_ms": 1, "p99_ms": 5}, "error_rate": 0.05}},
+    "mongo_stall": {"mongodb": {"latency": {"median_ms": 1, "p99_ms": 5}, "partitions": [[2, 4]], "timeout_seconds": 1}},
+    "redis_partition": {"redis": {"latency": {"median_ms": 0.2, "p99_ms": 1}, "partitions": [[2, 4]], "timeout_seconds": 1}},
+}
+
+_ATTRIBUTES = {"age": "integer", "department": "string", "is_manager": "boolean"}
+_DEPARTMENTS = ["rnd", "sales", "support", "finance"]
+
+
+def build_scenario(overrides: Dict[str, Any]) -> Dict[str, Any]:
+    return {**_DEFAULTS, **overrides}
+
+
+def _random_attributes(rng: random.Random) -> Dict[str, Any]:
+    return {"age": rng.randint(18, 70), "department": rng.choice(_DEPARTMENTS), "is_manager": rng.random() < 0.2}
+
+
+def _random_conditions(rng: random.Random) -> List[Dict[str, Any]]:
+    conditions = [{"attribute_name": "age", "operator": ">", "value": rng.randint(18, 50)}]
+    if rng.random() < 0.5:
+        conditions.append({"attribute_name": "department", "operator": "in", "value": rng.sample(_DEPARTMENTS, 2)})
+    if rng.random() < 0.2:
+        conditions.append({"attribute_name": "is_manager", "operator": "=", "value": True})
+    return conditions
+
+
+def seed_dataset(backends: Dict[str, Any], dataset: Dict[str, int], rng: random.Random) -> Tuple[List[ObjectId], List[ObjectId]]:
+    """Writes the documents like the API does, returns the users and the resources ids"""
+    db = backends["mongodb"][default_tenant.db_name]
+    for name, attribute_type in _ATTRIBUTES.items():
+        db[ATTRIBUTES_COL].insert_one({"_id": name, "attribute_type": attribute_type})
+    policy_ids = []
+    for _ in range(dataset["policies"]):
+        conditions = _random_conditions(rng)
+        doc = {"conditions": conditions, "signature": build_policy_signature(conditions), "version": 0}
+        policy_ids.append(db[POLICIES_COL].insert_one(doc).inserted_id)
+    user_ids = [
+        db[USERS_COL].insert_one({"attributes": _random_attributes(rng), "version": 0}).inserted_id
+        for _ in range(dataset["users"])
+    ]
+    resource_ids = [
+        db[RESOURCES_COL].insert_one({"policy_ids": rng.sample(policy_ids, rng.randint(1, 3)), "version": 0}).inserted_id
+        for _ in range(dataset["resources"])
+    ]
+    return user_ids, resource_ids
+
+
+class _ServerThread:
+    """Runs the app on its own event loop, like a server process"""
+    def __init__(self, app: web.Application):
+        self.app = app
+        self.port: Optional[int] = None
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(app, access_log=None)
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="scenario-server", daemon=True)
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self) -> None:
+        self._thread.start()
+        self._started.wait()
+
+    def stop(self) -> None:
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def _percentiles(latencies: List[float]) -> Dict[str, Optional[float]]:
+    if not latencies:
+        return {"p50": None, "p90": None, "p99": None, "p999": None, "max": None}
+    latencies = sorted(latencies)
+
+    def percentile(p: float) -> float:
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+    return {"p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99), "p999": percentile(0.999), "max": round(latencies[-1] * 1000, 3)}
+
+
+def _is_error(outcome: Any) -> bool:
+    return not (isinstance(outcome, int) and outcome < 500 and outcome != 429)
+
+
+def _summary(results: List[Tuple[float, str, Any, float]]) -> Dict[str, Any]:
+    outcomes = Counter(str(outcome) for _, _, outcome, _ in results)
+    errors = sum(1 for _, _, outcome, _ in results if _is_error(outcome))
+    return {
+        "requests": len(results),
+        "outcomes": dict(outcomes),
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "latency_ms": _percentiles([latency for _, _, _, latency in results])
+    }
+
+
+async def _send(session: aiohttp.ClientSession, base_url: str, kind: str, user_id: ObjectId, resource_id: ObjectId, rng_value: int) -> Any:
+    if kind == "is_authorized":
+        call = session.get(f"{base_url}/is_authorized", params={"user_id": str(user_id), "resource_id": str(resource_id)})
+    elif kind == "get_user":
+        call = session.get(f"{base_url}/users/{user_id}")
+    elif kind == "patch_user":
+        call = session.patch(f"{base_url}/users/{user_id}/attributes/age", json={"attribute_value": rng_value})
+    else:
+        raise ValueError(f"unknown request kind {kind}")
+    async with call as response:
+        await response.read()
+        return response.status
+
+
+async def _drive_load(base_url: str, scenario: Dict[str, Any], user_ids: List[ObjectId], resource_ids: List[ObjectId], rng: random.Random) -> List[Tuple[float, str, Any, float]]:
+    """Returns (seconds since the start, kind, status code or "timeout"/"error", latency seconds) of each request"""
+    rate = scenario["rate"]
+    total = int(rate * scenario["duration_seconds"])
+    kinds, weights = zip(*scenario["mix"].items())
+    # the whole sequence of requests is drawn up front, so it's the same for the same seed
+    requests = [(rng.choices(kinds, weights)[0], rng.choice(user_ids), rng.choice(resource_ids), rng.randint(18, 70)) for _ in range(total)]
+    results = []
+    timeout = aiohttp.ClientTimeout(total=scenario["request_timeout_seconds"])
+
+    async with aiohttp.ClientSession(timeout=timeout, connector=aiohttp.TCPConnector(limit=0)) as session:
+        async def request(offset: float, started: float, kind: str, user_id: ObjectId, resource_id: ObjectId, value: int) -> None:
+            try:
+                outcome = await _send(session, base_url, kind, user_id, resource_id, value)
+            except asyncio.TimeoutError:
+                outcome = "timeout"
+            except aiohttp.ClientError:
+                outcome = "error"
+            results.append((offset, kind, outcome, time.perf_counter() - started))
+
+        tasks = []
+        started = time.perf_counter()
+        for i, (kind, user_id, resource_id, value) in enumerate(requests):
+            scheduled = started + i / rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(request(i / rate, scheduled, kind, user_id, resource_id, value)))
+        await asyncio.gather(*tasks)
+    return results
+
+
+def run_scenario(scenario: Dict[str, Any], seed: int = 1) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    backends = stand_in_backends()
+    user_ids, resource_ids = seed_dataset(backends, scenario["dataset"], rng)
+
+    # the faults are turned on after the dataset is written
+    faults = {
+        "mongodb": BackendFaults.from_dict(scenario["mongodb"], seed=seed),
+        "redis": BackendFaults.from_dict(scenario["redis"], seed=seed + 1),
+    }
+    backends["mongodb"].faults = faults["mongodb"]
+    backends["redis"].server.faults = faults["redis"]
+
+    app = asyncio.run(app_factory(backends=backends, binary_port=None))
+    server = _ServerThread(app)
+    server.start()
+    try:
+        for backend_faults in faults.values():
+            backend_faults.start()
+        started = time.perf_counter()
+        results = asyncio.run(_drive_load(f"http://127.0.0.1:{server.port}", scenario, user_ids, resource_ids, rng))
+        wall_seconds = time.perf_counter() - started
+    finally:
+        server.stop()
+
+    timeline = []
+    for second in range(int(scenario["duration_seconds"])):
+        window = [result for result in results if second <= result[0] < second + 1]
+        summary = _summary(window)
+        timeline.append({"second": second, "requests": summary["requests"], "error_rate": summary["error_rate"], "p99_ms": summary["latency_ms"]["p99"]})
+
+    return {
+        **_summary(results),
+        "wall_seconds": round(wall_seconds, 3),
+        "by_kind": {kind: _summary([result for result in results if result[1] == kind]) for kind in scenario["mix"]},
+        "timeline": timeline,
+        "backends": {name: backend_faults.stats for name, backend_faults in faults.items()},
+        "admission_rejected": app["admission"].rejected,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Load the service on stand-in backends with injected faults")
+    parser.add_argument("--scenario", default="baseline", choices=sorted(SCENARIOS))
+    parser.add_argument("--scenario-file", help="JSON file of a scenario, overrides --scenario")
+    parser.add_argument("--duration", type=float, help="seconds of load")
+    parser.add_argument("--rate", type=float, help="requests per second")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--list", action="store_true", help="print the built-in scenarios")
+    parser.add_argument("--verbose", action="store_true", help="print the server logs (the injected failures are logged as errors)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    if args.list:
+        json.dump({name: build_scenario(overrides) for name, overrides in SCENARIOS.items()}, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return
+
+    if args.scenario_file:
+        with open(args.scenario_file) as f:
+            scenario = build_scenario(json.load(f))
+    else:
+        scenario = build_scenario(SCENARIOS[args.scenario])
+    if args.duration is not None:
+        scenario["duration_seconds"] = args.duration
+    if args.rate is not None:
+        scenario["rate"] = args.rate
+
+    json.dump(run_scenario(scenario, args.seed), sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Startup time and memory benchmark of the gunicorn workers, with and without preload_app.
+
+Usage:
+    python -m api.tools.startup_benchmark [--workers 8] [--port 19876] [--modes preload,no-preload] [--no-swagger]
+
+For each mode it starts gunicorn (with gunicorn.conf.py) on a local port, polls /health/ready until all the workers answered,
+and reports the time until all the workers were ready, and per worker: the startup time (from the fork, or from the process
+start without preload), and the RSS/PSS memory. PSS divides the shared pages between the processes that share them,
+so it's the per worker cost that preload_app reduces. The memory is read from /proc, so it's reported on linux only.
+MongoDB and Redis don't have to be up, the workers are ready to serve before the backends are checked.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+
+def _memory_mb(pid: int) -> Dict[str, Optional[float]]:
+    memory = {"rss_mb": None, "pss_mb": None}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    memory[f"{name.lower()}_mb"] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return memory
+
+
+def _worker_report(port: int) -> Optional[Dict[str, Any]]:
+    # a new connection on every call, so the kernel balances the calls between the workers
+    try:
+        with urlopen(f"http://127.0.0.1:{port}/health/ready", timeout=1) as response:
+            return json.load(response)["worker"]
+    except HTTPError as e:  # 503 when the backends are down, the report is still returned
+        return json.load(e)["worker"]
+    except (URLError, ConnectionError, TimeoutError, ValueError):
+        return None
+
+
+def run_mode(preload: bool, workers: int, port: int, swagger: bool, timeout_seconds: float = 60) -> Dict[str, Any]:
+    env = {
+        **os.environ,
+        "ABAC_PRELOAD_APP": str(preload).lower(),
+        "ABAC_SWAGGER_ENABLED": str(swagger).lower()
+    }
+    command = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+        "--workers", str(workers), "--bind", f"127.0.0.1:{port}", "api.main:app_factory"
+    ]
+    started = time.perf_counter()
+    master = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ready: Dict[int, Dict[str, Any]] = {}
+    try:
+        while len(ready) < workers:
+            if time.perf_counter() - started > timeout_seconds:
+                raise TimeoutError(f"only {len(ready)} of {workers} workers were ready after {timeout_seconds} seconds")
+            if master.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with code {master.returncode}")
+            report = _worker_report(port)
+            if report is not None and report["startup_seconds"] is not None:
+                ready.setdefault(report["pid"], report)
+            else:
+                time.sleep(0.05)
+        all_ready_seconds = time.perf_counter() - started
+
+        per_worker: List[Dict[str, Any]] = [
+            {"pid": pid, "startup_seconds": report["startup_seconds"], **_memory_mb(pid)}
+            for pid, report in sorted(ready.items())
+        ]
+        pss = [w["pss_mb"] for w in per_worker if w["pss_mb"] is not None]
+        return {
+            "preload": preload,
+            "swagger": swagger,
+            "all_workers_ready_seconds": round(all_ready_seconds, 3),
+            "max_worker_startup_seconds": max(w["startup_seconds"] for w in per_worker),
+            "master": _memory_mb(master.pid),
+            "workers_total_pss_mb": round(sum(pss), 1) if pss else None,
+            "workers": per_worker
+        }
+    finally:
+        master.terminate()
+        master.wait()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the workers startup time and memory")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--port", type=int, default=19876)
+    parser.add_argument("--modes", default="preload,no-preload", help="comma separated: preload, no-preload")
+    parser.add_argument("--no-swagger", action="store_true", help="start the workers without the swagger UI")
+    args = parser.parse_args(argv)
+
+    report = [
+        run_mode(mode == "preload", args.workers, args.port, not args.no_swagger)
+        for mode in args.modes.split(",")
+    ]
+    json.dump(report, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
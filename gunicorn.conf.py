@@ -1,7 +1,24 @@
 
+import gc
 import multiprocessing
+import os
+import time
 
 bind = "0.0.0.0:9876"
 worker_class = "aiohttp.GunicornUVLoopWebWorker"
 workers = multiprocessing.cpu_count() * 2 + 1
 access_log_format = "%P %a %t %r %s %Tf"
+
+# Importing the app once in the master, the workers share the imported modules pages (copy on write) and start faster.
+# It's safe since the MongoDB/Redis clients and the background tasks are created by the app factory, which runs in each worker after the fork
+preload_app = os.environ.get("ABAC_PRELOAD_APP", "true").lower() == "true"
+
+
+def pre_fork(server, worker):
+    # Moving the preloaded objects out of the GC generations, so the collections in the workers
+    # don't write to their pages and make the workers copy them
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    os.environ["ABAC_WORKER_STARTED_AT"] = str(time.time())